@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+try:
+    from elasticsearch import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+
+class AsyncSearchBridge:
+    def __init__(self, elastic_url, max_in_flight, es_client):
+        """Stand-in for es_in backed by AsyncElasticsearch. The client lives on an
+        event loop in its own thread, searches from worker threads are scheduled
+        on it and at most max_in_flight of them run at the same time. Every other
+        call goes to es_client.
+        :param elastic_url: url of the Elasticsearch cluster.
+        :param max_in_flight: max number of concurrent search requests.
+        :param es_client: synchronous client of the same cluster.
+        """
+        if AsyncElasticsearch is None:
+            raise ImportError("async mode needs elasticsearch[async] (aiohttp) installed")
+        self.elastic_url = elastic_url
+        self.max_in_flight = max_in_flight
+        self.es_client = es_client
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.run(self.connect())
+
+    def __getattr__(self, name):
+        if name == "es_client":
+            raise AttributeError(name)
+        return getattr(self.es_client, name)
+
+    async def connect(self):
+        is_https = urlparse(self.elastic_url).scheme == 'https'
+        self.es_async = AsyncElasticsearch(self.elastic_url, use_ssl=is_https, verify_certs=False)
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    async def async_search(self, index, body, **kwargs):
+        async with self.semaphore:
+            return await self.es_async.search(index=index, body=body, **kwargs)
+
+    def run(self, coroutine):
+        '''Run coroutine on the event loop and wait for its result'''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def search(self, index=None, body=None, **kwargs):
+        return self.run(self.async_search(index, body, **kwargs))
+
+    def close(self):
+        self.run(self.es_async.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def async_metrics_data(model, metrics, date_list, repos_list, label, max_in_flight):
+    '''Metrics data of date_list in date order, dates are evaluated concurrently
+    with at most max_in_flight searches waiting on Elasticsearch. The results are still
+    yielded in date order, the decay state carried between dates depends on it.
+    es_in points at the async client until the generator is exhausted.'''
+    es_in = model.es_in
+    bridge = AsyncSearchBridge(model.elastic_url, max_in_flight, model.get_run_client())
+    model.es_in = model.wrap_search_client(bridge)
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            futures = [executor.submit(model.get_metrics_data, metrics, date, repos_list, label)
+                       for date in date_list]
+            try:
+                for date, future in zip(date_list, futures):
+                    metrics_data = future.result()
+                    print(date)
+                    yield date, metrics_data
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        model.es_in = es_in
+        bridge.close()
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from elasticsearch.exceptions import NotFoundError
+
+# Largest window used by a metric (recent_releases_count looks back one year)
+MAX_WINDOW_DAYS = 365
+# Days per date_histogram request for metrics that keep a terms bucket per day,
+# keeps the number of buckets below search.max_buckets on big communities
+SET_CHUNK_DAYS = 90
+TERMS_SIZE = 100000
+
+
+def day_millis(date):
+    '''Epoch millis of the UTC day of date, as range filters see "%Y-%m-%d"'''
+    day = datetime.strptime(date.strftime("%Y-%m-%d"), "%Y-%m-%d")
+    return int(day.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+class DailySeries:
+    def __init__(self, buckets, value):
+        """Values of date_histogram day buckets, looked up by window.
+        :param buckets: day buckets sorted by key.
+        :param value: function returning the value kept for a bucket.
+        """
+        self.days = np.array([bucket["key"] for bucket in buckets], dtype=np.int64)
+        self.values = [value(bucket) for bucket in buckets]
+
+    def window(self, from_date, to_date, include_end=False):
+        '''Values of the days in [from_date, to_date), or [from_date, to_date] if include_end'''
+        start = np.searchsorted(self.days, day_millis(from_date), 'left')
+        end = np.searchsorted(self.days, day_millis(to_date), 'right' if include_end else 'left')
+        return self.values[start:end]
+
+    def sum(self, from_date, to_date, include_end=False):
+        return sum(self.window(from_date, to_date, include_end))
+
+    def union(self, from_date, to_date, include_end=False):
+        return set().union(*self.window(from_date, to_date, include_end))
+
+
+class HistogramBackfill:
+    def __init__(self, model, repos_list):
+        """Metrics source for backfill runs. Every metric asks Elasticsearch once for
+        day buckets over the whole date range and builds each 90-day window locally.
+        Metrics that cannot be rebuilt from day buckets are delegated to the model.
+        :param model: the MetricsModel whose metrics are answered.
+        :param repos_list: repos of the label being enriched.
+        """
+        self.model = model
+        self.repos_list = repos_list
+        self.series = {}
+        if model.date_list:
+            self.from_date = model.date_list[0] - timedelta(days=MAX_WINDOW_DAYS)
+            self.to_date = model.date_list[-1] + timedelta(days=1)
+        else:
+            self.from_date = self.to_date = None
+
+    def __getattr__(self, name):
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def get_daily_series(self, name, index, get_query, date_field, aggs, value, chunk_days=None):
+        '''Fetch the day buckets of a metric once, get_query(from_date, to_date) builds the window query'''
+        if name in self.series:
+            return self.series[name]
+        spans = []
+        chunk_from = self.from_date
+        while chunk_from < self.to_date:
+            chunk_to = self.to_date if chunk_days is None else min(chunk_from + timedelta(days=chunk_days), self.to_date)
+            spans.append((chunk_from, chunk_to))
+            chunk_from = chunk_to
+        buckets = []
+        for chunk_from, chunk_to in spans:
+            query = get_query(chunk_from, chunk_to)
+            query["size"] = 0
+            query["aggs"] = {
+                "days": {
+                    "date_histogram": {
+                        "field": date_field,
+                        "calendar_interval": "day",
+                        "min_doc_count": 1
+                    },
+                    "aggs": aggs
+                }
+            }
+            buckets += self.model.es_in.search(index=index, body=query)["aggregations"]["days"]["buckets"]
+        self.series[name] = DailySeries(buckets, value)
+        return self.series[name]
+
+    def get_count_series(self, name, index, get_query, date_field, option="cardinality", field="uuid"):
+        '''Day buckets of the count_of_uuid aggregation the window queries use'''
+        aggs = {"count_of_uuid": {option: {"field": field}}}
+        return self.get_daily_series(name, index, get_query, date_field, aggs,
+                                     lambda bucket: bucket["count_of_uuid"]["value"] or 0)
+
+    def get_sum_series(self, name, index, get_query, date_field, field):
+        '''Day buckets of (sum of field, number of docs, number of docs with field)'''
+        aggs = {"sum_of_field": {"sum": {"field": field}},
+                "count_of_field": {"value_count": {"field": field}}}
+        return self.get_daily_series(name, index, get_query, date_field, aggs,
+                                     lambda bucket: (bucket["sum_of_field"]["value"],
+                                                     bucket["doc_count"],
+                                                     bucket["count_of_field"]["value"]))
+
+    def get_author_series(self, name, index, get_query):
+        '''Day buckets of author_name sets'''
+        aggs = {"authors": {"terms": {"field": "author_name", "size": TERMS_SIZE}}}
+        return self.get_daily_series(name, index, get_query, "grimoire_creation_date", aggs,
+                                     lambda bucket: {i["key"] for i in bucket["authors"]["buckets"]},
+                                     chunk_days=SET_CHUNK_DAYS)
+
+    def window_sum(self, series, date, days=90, include_end=False):
+        '''(sum, docs, docs with field) of a sum series over the window ending at date'''
+        values = series.window(date - timedelta(days=days), date, include_end)
+        if not values:
+            return 0, 0, 0
+        return tuple(sum(column) for column in zip(*values))
+
+    def contributor_count(self, date, repos_list):
+        series = self.get_author_series(
+            "contributor_count", self.contributor_indexes,
+            lambda from_date, to_date: self.model.get_uuid_count_contribute_query(
+                self.repos_list, company=None, from_date=from_date, to_date=to_date))
+        return len(series.union(date - timedelta(days=90), date))
+
+    def active_C2_contributor_count(self, date, repos_list):
+        series = self.get_author_series(
+            "active_C2_contributor_count", self.model.git_index,
+            lambda from_date, to_date: self.model.get_uuid_count_contribute_query(
+                self.repos_list, company=None, from_date=from_date, to_date=to_date))
+        return len(series.union(date - timedelta(days=90), date))
+
+    def active_C1_pr_create_contributor(self, date, repos_list):
+        series = self.get_author_series(
+            "active_C1_pr_create_contributor", self.model.pr_index,
+            lambda from_date, to_date: self.model.get_all_CX_contributors_query(
+                self.repos_list, pr=True, from_date=from_date, to_date=to_date))
+        return len(series.union(date - timedelta(days=90), date, include_end=True))
+
+    def active_C1_pr_comments_contributor(self, date, repos_list):
+        series = self.get_author_series(
+            "active_C1_pr_comments_contributor", self.model.pr_comments_index,
+            lambda from_date, to_date: self.model.get_all_CX_comments_contributors_query(
+                self.repos_list, pr=True, from_date=from_date, to_date=to_date))
+        return len(series.union(date - timedelta(days=90), date, include_end=True))
+
+    def comment_frequency(self, date, repos_list):
+        def get_query(from_date, to_date):
+            query = self.model.get_uuid_count_query(
+                "sum", self.repos_list, "num_of_comments_without_bot", date_field='grimoire_creation_date', size=0, from_date=from_date, to_date=to_date)
+            query["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "false" }})
+            return query
+        series = self.get_sum_series("comment_frequency", self.model.issue_index, get_query,
+                                     "grimoire_creation_date", "num_of_comments_without_bot")
+        comments, issues, _ = self.window_sum(series, date)
+        try:
+            return float(comments/issues)
+        except ZeroDivisionError:
+            return None
+
+    def updated_issue_count(self, date, repos_list):
+        def get_query(from_date, to_date):
+            query = self.model.get_uuid_count_query(
+                "cardinality", self.repos_list, "uuid", date_field='metadata__updated_on', size=0, from_date=from_date, to_date=to_date)
+            query["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "false" }})
+            return query
+        series = self.get_count_series("updated_issue_count", self.model.issue_index, get_query, "metadata__updated_on")
+        return series.sum(date - timedelta(days=90), date)
+
+
+class ActivityHistogramBackfill(HistogramBackfill):
+    @property
+    def contributor_indexes(self):
+        return (self.model.git_index, self.model.issue_index, self.model.pr_index,
+                self.model.issue_comments_index, self.model.pr_comments_index)
+
+    def commit_frequency(self, date, repos_list):
+        series = self.get_count_series(
+            "commit_frequency", self.model.git_index,
+            lambda from_date, to_date: self.model.get_uuid_count_query(
+                "cardinality", self.repos_list, "hash", "grimoire_creation_date", size=0, from_date=from_date, to_date=to_date),
+            "grimoire_creation_date", field="hash")
+        return series.sum(date - timedelta(days=90), date)/12.85
+
+    def closed_issue_count(self, date, repos_list):
+        def get_query(from_date, to_date):
+            query = self.model.get_issue_closed_uuid_count(
+                "cardinality", self.repos_list, "uuid", from_date=from_date, to_date=to_date)
+            query["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "false" }})
+            return query
+        series = self.get_count_series("closed_issue_count", self.model.issue_index, get_query, "closed_at")
+        return series.sum(date - timedelta(days=90), date)
+
+    def code_review_count(self, date, repos_list):
+        def get_query(from_date, to_date):
+            query = self.model.get_uuid_count_query(
+                "sum", self.repos_list, "num_review_comments_without_bot", size=0, from_date=from_date, to_date=to_date)
+            query["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "true" }})
+            return query
+        series = self.get_sum_series("code_review_count", self.model.pr_index, get_query,
+                                     "grimoire_creation_date", "num_review_comments_without_bot")
+        comments, prs, _ = self.window_sum(series, date)
+        try:
+            return comments/prs
+        except ZeroDivisionError:
+            return None
+
+    def recent_releases_count(self, date, repos_list):
+        try:
+            series = self.get_daily_series(
+                "recent_releases_count", self.model.release_index,
+                lambda from_date, to_date: self.model.get_recent_releases_uuid_count(
+                    "cardinality", self.repos_list, "uuid", from_date=from_date, to_date=to_date),
+                "grimoire_creation_date", {"count_of_uuid": {"cardinality": {"field": "uuid.keyword"}}},
+                lambda bucket: bucket["count_of_uuid"]["value"] or 0)
+        except NotFoundError:
+            return 0
+        return series.sum(date - timedelta(days=365), date)
+
+    def active_C1_issue_create_contributor(self, date, repos_list):
+        series = self.get_author_series(
+            "active_C1_issue_create_contributor", self.model.issue_index,
+            lambda from_date, to_date: self.model.get_all_CX_contributors_query(
+                self.repos_list, issue=True, from_date=from_date, to_date=to_date))
+        return len(series.union(date - timedelta(days=90), date, include_end=True))
+
+    def active_C1_issue_comments_contributor(self, date, repos_list):
+        series = self.get_author_series(
+            "active_C1_issue_comments_contributor", self.model.issue_comments_index,
+            lambda from_date, to_date: self.model.get_all_CX_comments_contributors_query(
+                self.repos_list, issue=True, from_date=from_date, to_date=to_date))
+        return len(series.union(date - timedelta(days=90), date, include_end=True))
+
+
+class CommunitySupportHistogramBackfill(HistogramBackfill):
+    def code_review_count(self, date, repos_list):
+        def get_query(from_date, to_date):
+            query = self.model.get_uuid_count_query(
+                "avg", self.repos_list, "num_review_comments_without_bot", size=0, from_date=from_date, to_date=to_date)
+            query["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "true" }})
+            return query
+        series = self.get_sum_series("code_review_count", self.model.pr_index, get_query,
+                                     "grimoire_creation_date", "num_review_comments_without_bot")
+        comments, prs, reviewed_prs = self.window_sum(series, date)
+        if prs == 0:
+            return None
+        return comments/reviewed_prs if reviewed_prs else None
+
+    def closed_pr_count(self, date, repos_list):
+        series = self.get_count_series(
+            "closed_pr_count", self.model.pr_index,
+            lambda from_date, to_date: self.model.get_pr_closed_uuid_count(
+                "cardinality", self.repos_list, "uuid", from_date=from_date, to_date=to_date),
+            "closed_at")
+        return series.sum(date - timedelta(days=90), date)
+
+
+class CodeQualityHistogramBackfill(HistogramBackfill):
+    @property
+    def contributor_indexes(self):
+        return (self.model.git_index, self.model.pr_comments_index)
+
+    def commit_frequency(self, date, repos_list):
+        def get_query(from_date, to_date):
+            return self.model.get_uuid_count_query(
+                "cardinality", self.repos_list, "hash", "grimoire_creation_date", size=0, from_date=from_date, to_date=to_date)
+
+        def get_company_query(from_date, to_date):
+            query = get_query(from_date, to_date)
+            query["query"]["bool"]["must"].append({ "match": { "author_org_name": self.model.company } })
+            return query
+        series = self.get_count_series("commit_frequency", self.model.git_index, get_query,
+                                       "grimoire_creation_date", field="hash")
+        commit_frequency = series.sum(date - timedelta(days=90), date)
+        commit_frequency_company = 0
+        if self.model.company:
+            series = self.get_count_series("commit_frequency_company", self.model.git_index, get_company_query,
+                                           "grimoire_creation_date", field="hash")
+            commit_frequency_company = series.sum(date - timedelta(days=90), date)
+        return commit_frequency/12.85, commit_frequency_company/12.85
+
+    def LOC_frequency(self, date, repos_list, field='lines_changed'):
+        series = self.get_sum_series(
+            "LOC_frequency_" + field, self.model.git_index,
+            lambda from_date, to_date: self.model.get_uuid_count_query(
+                'sum', self.repos_list, field, 'grimoire_creation_date', size=0, from_date=from_date, to_date=to_date),
+            "grimoire_creation_date", field)
+        return self.window_sum(series, date)[0]/12.85
+
+    def code_review_ratio(self, date, repos_list):
+        pr_series = self.get_count_series(
+            "code_review_ratio_prs", self.model.pr_index,
+            lambda from_date, to_date: self.model.get_uuid_count_query(
+                "cardinality", self.repos_list, "uuid", size=0, from_date=from_date, to_date=to_date),
+            "grimoire_creation_date")
+        reviewed_series = self.get_count_series(
+            "code_review_ratio_reviewed_prs", self.model.pr_index,
+            lambda from_date, to_date: self.model.get_pr_message_count(
+                self.repos_list, "uuid", "grimoire_creation_date", size=0,
+                filter_field="num_review_comments_without_bot", from_date=from_date, to_date=to_date),
+            "grimoire_creation_date")
+        pr_count = pr_series.sum(date - timedelta(days=90), date)
+        prs = reviewed_series.sum(date - timedelta(days=90), date)
+        try:
+            return prs/pr_count
+        except ZeroDivisionError:
+            return None
+
+    def code_merge_ratio(self, date, repos_list):
+        def get_query(from_date, to_date):
+            query = self.model.get_uuid_count_query(
+                "cardinality", self.repos_list, "uuid", size=0, from_date=from_date, to_date=to_date)
+            query["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "true" }})
+            return query
+
+        def get_merged_by_other_query(from_date, to_date):
+            query = get_query(from_date, to_date)
+            query["query"]["bool"]["must"].append(self.model.get_merged_by_other_filter())
+            return query
+        pr_series = self.get_count_series("code_merge_ratio_prs", self.model.pr_index, get_query, "grimoire_creation_date")
+        merged_series = self.get_count_series("code_merge_ratio_merged_prs", self.model.pr_index,
+                                              get_merged_by_other_query, "grimoire_creation_date")
+        pr_count = pr_series.sum(date - timedelta(days=90), date)
+        prs = merged_series.sum(date - timedelta(days=90), date)
+        try:
+            return prs/pr_count, pr_count
+        except ZeroDivisionError:
+            return None, 0
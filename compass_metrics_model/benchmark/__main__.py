@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+from elasticsearch import Elasticsearch, RequestsHttpConnection
+from .corpus import CorpusGenerator
+from .scenarios import LEVELS, MODELS, Scenario, format_report, load_stand_in
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="python -m compass_metrics_model.benchmark",
+                                     description="Time the metrics models on a synthetic corpus without a cluster")
+    parser.add_argument("--docs", type=int, default=10000, help="git, issue, PR and comment docs of the corpus")
+    parser.add_argument("--repos", type=int, default=10, help="repos of the corpus")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--from-date", default="2021-01-01", help="first day of the corpus and of the runs")
+    parser.add_argument("--days", type=int, default=180, help="days of the corpus and of the runs")
+    parser.add_argument("--models", default=",".join(MODELS), help="comma separated keys of MODELS")
+    parser.add_argument("--levels", default="repo,project", help="comma separated levels among " + ",".join(LEVELS))
+    parser.add_argument("--options", default="{}", help="JSON object of MetricsModel options, e.g. '{\"columnar\": true}'")
+    parser.add_argument("--top", type=int, default=None, help="metrics printed per scenario, the slowest first")
+    parser.add_argument("--output", help="JSON file the reports are written to")
+    parser.add_argument("--ndjson", help="only write the corpus as gzipped ndjson files to this directory")
+    parser.add_argument("--load", help="only write the corpus to the cluster of this url, in the indexes of INDEX_NAMES")
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    corpus = CorpusGenerator(docs=args.docs, repos=args.repos, seed=args.seed, from_date=args.from_date, days=args.days)
+    if args.ndjson:
+        corpus.write_ndjson(args.ndjson)
+        corpus.write_json_file(os.path.join(args.ndjson, "projects.json"))
+        print("corpus written to {}".format(args.ndjson))
+        return []
+    if args.load:
+        corpus.bulk_load(Elasticsearch(args.load, verify_certs=False, connection_class=RequestsHttpConnection))
+        print("corpus written to {}".format(args.load))
+        return []
+    options = json.loads(args.options)
+    es = load_stand_in(corpus)
+    reports = []
+    with tempfile.TemporaryDirectory() as directory:
+        json_file = corpus.write_json_file(os.path.join(directory, "projects.json"))
+        for model in args.models.split(","):
+            for level in args.levels.split(","):
+                # the models print every date they compute
+                with contextlib.redirect_stdout(io.StringIO()):
+                    report = Scenario(model, level, options).run(corpus, json_file, es)
+                print(format_report(report, args.top))
+                reports.append(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+    return reports
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import gzip
+import hashlib
+import json
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from elasticsearch import helpers
+
+# Share of the docs of each kind, the repo docs come on top, one per repo
+KIND_SHARES = {
+    "git": 0.4,
+    "issue": 0.2,
+    "pr": 0.2,
+    "issue_comments": 0.1,
+    "pr_comments": 0.1,
+}
+KINDS = list(KIND_SHARES) + ["repo"]
+
+# Index of each kind, the names the scenarios give the models
+INDEX_NAMES = {
+    "git": "gitee_git-enriched",
+    "issue": "gitee_issues-enriched",
+    "pr": "gitee_pulls-enriched",
+    "issue_comments": "gitee_issues_comments-enriched",
+    "pr_comments": "gitee_pulls_comments-enriched",
+    "repo": "gitee_repo-enriched",
+}
+BULK_SIZE = 5000
+
+
+def iso(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+
+class CorpusGenerator:
+    def __init__(self, docs=10000, repos=10, seed=1, from_date="2021-01-01", days=540, repos_per_project=10,
+                 authors_per_repo=20):
+        """Synthetic gitee corpus with the fields the models read. Docs are generated one
+        at a time from seed and their position, so a corpus of any size is streamed with
+        constant memory and the same arguments always give the same docs.
+        :param docs: number of git, issue, PR and comment docs, split by KIND_SHARES.
+        :param repos: number of repos, the docs are spread evenly over them.
+        :param seed: seed of the generated values.
+        :param from_date: day the history of the repos starts on.
+        :param days: length of the history of the repos in days.
+        :param repos_per_project: repos of each project of the json_file.
+        :param authors_per_repo: authors of each repo, a fifth of the docs are by authors
+            shared by every repo.
+        """
+        self.docs = docs
+        self.seed = seed
+        self.start = datetime.strptime(from_date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        self.seconds = days * 86400
+        self.repos = ["https://gitee.com/bench{}/repo{}".format(n // repos_per_project, n) for n in range(repos)]
+        self.repos_per_project = repos_per_project
+        self.authors_per_repo = authors_per_repo
+        self.counts = {kind: max(1, int(docs * share)) for kind, share in KIND_SHARES.items()}
+
+    def get_projects(self):
+        '''Content of the json_file of the corpus, {project: {"gitee": repos}}'''
+        projects = {}
+        for n, repo in enumerate(self.repos):
+            projects.setdefault("bench{}".format(n // self.repos_per_project), {"gitee": []})["gitee"].append(repo)
+        return projects
+
+    def write_json_file(self, path):
+        with open(path, "w") as f:
+            json.dump(self.get_projects(), f)
+        return path
+
+    def get_random(self, kind, n):
+        return random.Random("{}:{}:{}".format(self.seed, kind, n))
+
+    def get_author(self, rnd, repo_n):
+        if rnd.random() < 0.2:
+            return "shared{}".format(rnd.randrange(self.authors_per_repo))
+        return "author{}_{}".format(repo_n, rnd.randrange(self.authors_per_repo))
+
+    def get_date(self, rnd):
+        return self.start + timedelta(seconds=rnd.randrange(self.seconds))
+
+    def get_hash(self, n):
+        return hashlib.sha1("{}:git:{}".format(self.seed, n).encode()).hexdigest()
+
+    def get_base(self, kind, n):
+        '''(random, repo number, creation date) of the doc n of kind'''
+        rnd = self.get_random(kind, n)
+        return rnd, n % len(self.repos), self.get_date(rnd)
+
+    def iter_docs(self, kind):
+        '''Docs of kind, in order of position'''
+        if kind == "repo":
+            for repo_n in range(len(self.repos)):
+                yield self.get_repo_doc(repo_n)
+            return
+        get_doc = getattr(self, "get_{}_doc".format(kind))
+        for n in range(self.counts[kind]):
+            yield get_doc(n)
+
+    def get_git_doc(self, n):
+        rnd, repo_n, date = self.get_base("git", n)
+        lines_added = rnd.randrange(300)
+        lines_removed = rnd.randrange(100)
+        return {
+            "uuid": "git{}".format(n),
+            "hash": self.get_hash(n),
+            "tag": self.repos[repo_n] + ".git",
+            "author_name": self.get_author(rnd, repo_n),
+            "author_domain": rnd.choice(["huawei.com", "gmail.com", "example.org"]),
+            "author_org_name": rnd.choice(["Huawei", "Unknown", "Other"]),
+            "message": rnd.choice(["fix typo", "Merge pull request !{}".format(n), "add feature"]),
+            "lines_added": lines_added,
+            "lines_removed": lines_removed,
+            "lines_changed": lines_added + lines_removed,
+            "grimoire_creation_date": iso(date),
+            "metadata__updated_on": iso(date + timedelta(hours=rnd.randrange(100))),
+            "metadata__enriched_on": iso(date + timedelta(days=1))
+        }
+
+    def get_issue_doc(self, n):
+        rnd, repo_n, date = self.get_base("issue", n)
+        closed_at = date + timedelta(days=rnd.randrange(60)) if rnd.random() < 0.6 else None
+        return {
+            "uuid": "issue{}".format(n),
+            "id": n,
+            "tag": self.repos[repo_n],
+            "pull_request": False,
+            "author_name": self.get_author(rnd, repo_n),
+            "state": rnd.choice(["closed", "rejected"]) if closed_at else rnd.choice(["open", "progressing"]),
+            "closed_at": iso(closed_at) if closed_at else None,
+            "labels": rnd.choice([[], ["bug"], ["feature"], ["缺陷"]]),
+            "issue_type": rnd.choice([[], ["Bug"], ["task"]]),
+            "num_of_comments_without_bot": rnd.randrange(10),
+            "time_to_first_attention_without_bot": round(rnd.random() * 10, 2),
+            "created_at": iso(date),
+            "grimoire_creation_date": iso(date),
+            "metadata__updated_on": iso(date + timedelta(days=rnd.randrange(30))),
+            "metadata__enriched_on": iso(date + timedelta(days=1))
+        }
+
+    def get_pr_doc(self, n):
+        rnd, repo_n, date = self.get_base("pr", n)
+        repo = self.repos[repo_n]
+        author = self.get_author(rnd, repo_n)
+        state = rnd.choice(["merged", "closed", "open"])
+        merged_at = date + timedelta(days=rnd.randrange(30)) if state == "merged" else None
+        closed_at = (merged_at or date + timedelta(days=rnd.randrange(30))) if state != "open" else None
+        # commits of the same repo, git doc n belongs to repo n % repos
+        repo_commits = max(1, self.counts["git"] // len(self.repos))
+        commits = [repo_n + len(self.repos) * rnd.randrange(repo_commits) for _ in range(rnd.randrange(4))]
+        return {
+            "uuid": "pr{}".format(n),
+            "id": 10**9 + n,
+            "tag": repo,
+            "pull_request": True,
+            "author_name": author,
+            "state": state,
+            "merged_at": iso(merged_at) if merged_at else None,
+            "closed_at": iso(closed_at) if closed_at else None,
+            "merged_by_data_name": rnd.choice([author, "maintainer{}".format(repo_n)]) if merged_at else None,
+            "linked_issues_count": rnd.choice([0, 0, 1]),
+            "body": rnd.choice(["refactor", "fixes {}/issues/I{}".format(repo, n), "see {}/issues/x".format(self.repos[0])]),
+            "commits_data": [self.get_hash(c) for c in commits if c < self.counts["git"]],
+            "num_review_comments_without_bot": rnd.choice([0, 1, 2, 5]),
+            "time_to_first_attention_without_bot": round(rnd.random() * 5, 2),
+            "created_at": iso(date),
+            "updated_at": iso(date + timedelta(days=3)),
+            "grimoire_creation_date": iso(date),
+            "metadata__updated_on": iso(date + timedelta(days=rnd.randrange(30))),
+            "metadata__enriched_on": iso(date + timedelta(days=1))
+        }
+
+    def get_comment_doc(self, kind, parent_kind, n):
+        parent = n % self.counts[parent_kind]
+        rnd = self.get_random(kind, n)
+        _, repo_n, parent_date = self.get_base(parent_kind, parent)
+        date = parent_date + timedelta(seconds=rnd.randrange(20 * 86400))
+        return rnd, parent, {
+            "uuid": "{}{}".format(kind, n),
+            "tag": self.repos[repo_n],
+            "item_type": "comment",
+            "author_name": self.get_author(rnd, repo_n),
+            "grimoire_creation_date": iso(date),
+            "metadata__enriched_on": iso(date + timedelta(days=1))
+        }
+
+    def get_issue_comments_doc(self, n):
+        rnd, parent, doc = self.get_comment_doc("issue_comments", "issue", n)
+        doc["issue_pull_request"] = False
+        doc["issue_id"] = parent
+        return doc
+
+    def get_pr_comments_doc(self, n):
+        rnd, parent, doc = self.get_comment_doc("pr_comments", "pr", n)
+        doc["pull_id"] = 10**9 + parent
+        doc["body"] = rnd.choice(["lgtm", "related {}/issues/2".format(doc["tag"])])
+        return doc
+
+    def get_repo_doc(self, repo_n):
+        rnd = self.get_random("repo", repo_n)
+        releases = []
+        for k in range(rnd.randrange(13)):
+            releases.append({
+                "id": repo_n * 1000 + k,
+                "tag_name": "v{}".format(k),
+                "target_commitish": "master",
+                "prerelease": False,
+                "name": "v{}".format(k),
+                "body": "",
+                "author": {"login": "maintainer{}".format(repo_n), "name": "Maintainer {}".format(repo_n)},
+                "created_at": iso(self.get_date(rnd))
+            })
+        return {
+            "uuid": "repo{}".format(repo_n),
+            "tag": self.repos[repo_n],
+            "releases": releases,
+            "grimoire_creation_date": iso(self.start),
+            "metadata__updated_on": iso(self.start + timedelta(seconds=self.seconds))
+        }
+
+    def write_ndjson(self, directory):
+        '''One gzipped ndjson file of docs per kind in directory, {kind: path}'''
+        os.makedirs(directory, exist_ok=True)
+        paths = {}
+        for kind in KINDS:
+            paths[kind] = os.path.join(directory, "{}.ndjson.gz".format(kind))
+            with gzip.open(paths[kind], "wt") as f:
+                for doc in self.iter_docs(kind):
+                    f.write(json.dumps(doc) + "\n")
+        return paths
+
+    def bulk_load(self, es_client, index_names=None):
+        '''Write the corpus to a cluster, the index of each kind from index_names or INDEX_NAMES'''
+        index_names = dict(INDEX_NAMES, **(index_names or {}))
+        for kind in KINDS:
+            actions = ({"_index": index_names[kind], "_id": doc["uuid"], "_source": doc} for doc in self.iter_docs(kind))
+            helpers.bulk(es_client, actions, chunk_size=BULK_SIZE)
+            es_client.indices.refresh(index=index_names[kind])
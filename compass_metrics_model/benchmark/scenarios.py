@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import resource
+import time
+from datetime import timedelta
+from ..metrics_model import (ActivityMetricsModel,
+                             CommunitySupportMetricsModel,
+                             CodeQualityGuaranteeMetricsModel)
+from .corpus import INDEX_NAMES, KINDS
+from .stand_in import StandInElasticsearch
+
+STAND_IN_URL = "http://stand-in:9200"
+RELEASE_INDEX = "gitee_releases-enriched"
+# Calls made outside the metrics, such as the scans of prepare_enrich and the writes
+OUTSIDE_METRICS = "(outside metrics)"
+
+# model: (model class, index kwargs of the model: kind of the index)
+MODELS = {
+    "activity": (ActivityMetricsModel, {
+        "issue_index": "issue", "pr_index": "pr", "git_index": "git", "repo_index": "repo",
+        "issue_comments_index": "issue_comments", "pr_comments_index": "pr_comments"}),
+    "community": (CommunitySupportMetricsModel, {
+        "issue_index": "issue", "pr_index": "pr", "git_index": "git"}),
+    "code_quality": (CodeQualityGuaranteeMetricsModel, {
+        "issue_index": "issue", "pr_index": "pr", "git_index": "git", "repo_index": "repo",
+        "pr_comments_index": "pr_comments"}),
+}
+LEVELS = ("repo", "project", "community")
+
+
+def get_peak_rss():
+    '''Peak resident set size of the process so far, in KB on Linux'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def load_stand_in(corpus):
+    '''StandInElasticsearch holding the docs of corpus in the indexes of INDEX_NAMES'''
+    es = StandInElasticsearch()
+    for kind in KINDS:
+        es.add_docs(INDEX_NAMES[kind], corpus.iter_docs(kind))
+    return es
+
+
+class RunStats:
+    def __init__(self, es):
+        """Wall time, queries, bytes and peak RSS of the metrics of a run, each call of
+        a metric being charged the traffic of es during the call. Metrics called by
+        another metric are charged to the outer one.
+        :param es: StandInElasticsearch the models of the run query.
+        """
+        self.es = es
+        self.metrics = {}
+        self.active = None
+
+    def snapshot(self):
+        return (time.perf_counter(), self.es.requests, self.es.request_bytes, self.es.response_bytes)
+
+    def measure(self, name, method, args, kwargs):
+        if self.active is not None:
+            return method(*args, **kwargs)
+        self.active = name
+        rss = get_peak_rss()
+        start = self.snapshot()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.active = None
+            self.add(name, start, self.snapshot(), rss)
+
+    def add(self, name, start, end, rss):
+        stats = self.metrics.setdefault(name, {"calls": 0, "wall_time": 0.0, "queries": 0, "request_bytes": 0,
+                                               "response_bytes": 0, "peak_rss_kb": 0, "rss_growth_kb": 0})
+        stats["calls"] += 1
+        stats["wall_time"] += end[0] - start[0]
+        stats["queries"] += end[1] - start[1]
+        stats["request_bytes"] += end[2] - start[2]
+        stats["response_bytes"] += end[3] - start[3]
+        peak = get_peak_rss()
+        stats["peak_rss_kb"] = max(stats["peak_rss_kb"], peak)
+        stats["rss_growth_kb"] += peak - rss
+
+
+class TimedMetrics:
+    def __init__(self, metrics, run_stats):
+        """Metrics source measuring every method called on it with run_stats.
+        :param metrics: metrics source of the model, see get_metrics_source.
+        :param run_stats: RunStats of the run.
+        """
+        self.metrics = metrics
+        self.run_stats = run_stats
+
+    def __getattr__(self, name):
+        if name in ("metrics", "run_stats"):
+            raise AttributeError(name)
+        value = getattr(self.metrics, name)
+        if name.startswith("_") or not callable(value):
+            return value
+        return lambda *args, **kwargs: self.run_stats.measure(name, value, args, kwargs)
+
+
+class StandInWriter:
+    def __init__(self, es, index):
+        self.es = es
+        self.index = index
+        self.rows = 0
+
+    def bulk_upload(self, items, field_id):
+        lines = []
+        for item in items:
+            lines += [{"index": {"_index": self.index, "_id": item[field_id]}}, item]
+        if lines:
+            self.es.bulk(lines)
+        self.rows += len(items)
+        return len(items)
+
+
+class StandInModel:
+    '''Mixin of a metrics model class connecting it to stand_in and timing its metrics with run_stats'''
+    stand_in = None
+    run_stats = None
+
+    def get_es_client(self, elastic_url):
+        if self.replay_cassette:
+            # every request, the writes included, is answered by the cassette
+            return super().get_es_client(elastic_url)
+        return self.stand_in
+
+    def get_es_out(self, elastic_url):
+        if self.bulk_writer or self.replay_cassette:
+            return super().get_es_out(elastic_url)
+        return StandInWriter(self.stand_in, self.out_index)
+
+    def get_metrics_source(self, repos_list):
+        return TimedMetrics(super().get_metrics_source(repos_list), self.run_stats)
+
+
+class Scenario:
+    def __init__(self, model, level, options=None):
+        """Timed run of one model at one level on a StandInElasticsearch.
+        :param model: key of MODELS.
+        :param level: repo, project or community.
+        :param options: MetricsModel options of the run, such as {"columnar": True}.
+            processes and async_concurrency need a real cluster and are not supported, nor is
+            record_cassette as the stand-in has no transport to record. With replay_cassette
+            the cassette answers the requests instead of the stand-in.
+        """
+        if model not in MODELS or level not in LEVELS:
+            raise ValueError("unknown scenario {} {}".format(model, level))
+        options = options or {}
+        if options.get("processes") or options.get("async_concurrency") or options.get("record_cassette"):
+            raise ValueError("processes, async_concurrency and record_cassette are not supported by the stand-in")
+        self.model = model
+        self.level = level
+        self.options = options
+        self.name = "{}-{}".format(model, level)
+
+    def build_model(self, corpus, json_file, es, run_stats):
+        model_class, index_kinds = MODELS[self.model]
+        model_class = type("StandIn" + model_class.__name__, (StandInModel, model_class), {})
+        kwargs = {name: INDEX_NAMES[kind] for name, kind in index_kinds.items()}
+        if self.model == "activity":
+            kwargs["release_index"] = RELEASE_INDEX
+        if self.model == "code_quality":
+            kwargs["company"] = "Huawei"
+        end_date = corpus.start + timedelta(seconds=corpus.seconds)
+        model = model_class(json_file=json_file, from_date=corpus.start.strftime("%Y-%m-%d"),
+                            end_date=end_date.strftime("%Y-%m-%d"), out_index="bench_out_" + self.name.replace("-", "_"),
+                            community="bench", level=self.level, **kwargs, **self.options)
+        model.stand_in = es
+        model.run_stats = run_stats
+        return model
+
+    def run(self, corpus, json_file, es):
+        '''Run the model on es, the docs of corpus, and report its totals and per metric stats'''
+        run_stats = RunStats(es)
+        model = self.build_model(corpus, json_file, es, run_stats)
+        rss = get_peak_rss()
+        start = run_stats.snapshot()
+        model.metrics_model_metrics(STAND_IN_URL)
+        end = run_stats.snapshot()
+        report = {
+            "scenario": self.name,
+            "model_name": model.model_name,
+            "level": self.level,
+            "options": self.options,
+            "docs": corpus.docs,
+            "repos": len(corpus.repos),
+            "dates": len(model.date_list),
+            "wall_time": end[0] - start[0],
+            "queries": end[1] - start[1],
+            "request_bytes": end[2] - start[2],
+            "response_bytes": end[3] - start[3],
+            "peak_rss_kb": get_peak_rss(),
+            "rss_growth_kb": get_peak_rss() - rss,
+        }
+        measured = {field: sum(stats[field] for stats in run_stats.metrics.values())
+                    for field in ("wall_time", "queries", "request_bytes", "response_bytes")}
+        run_stats.metrics[OUTSIDE_METRICS] = dict(
+            {field: report[field] - measured[field] for field in measured},
+            calls=1, peak_rss_kb=report["peak_rss_kb"], rss_growth_kb=0)
+        report["metrics"] = run_stats.metrics
+        return report
+
+
+def format_report(report, top=None):
+    '''Text table of the metrics of a scenario report, the slowest first'''
+    lines = ["{scenario} {docs} docs {repos} repos {dates} dates: {wall_time:.2f}s {queries} queries "
+             "{request_bytes} B sent {response_bytes} B received, peak RSS {peak_rss_kb} KB".format(**report),
+             "  {:<40} {:>6} {:>10} {:>8} {:>14} {:>12}".format("metric", "calls", "wall_time", "queries",
+                                                                "bytes", "peak_rss_kb")]
+    metrics = sorted(report["metrics"].items(), key=lambda item: -item[1]["wall_time"])
+    for name, stats in metrics[:top]:
+        lines.append("  {:<40} {:>6} {:>10.3f} {:>8} {:>14} {:>12}".format(
+            name, stats["calls"], stats["wall_time"], stats["queries"],
+            stats["request_bytes"] + stats["response_bytes"], stats["peak_rss_kb"]))
+    return "\n".join(lines)
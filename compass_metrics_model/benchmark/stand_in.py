@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import copy
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.serializer import JSONSerializer
+
+DATE_FIELDS = ("grimoire_creation_date", "metadata__updated_on", "metadata__enriched_on", "closed_at",
+               "created_at", "merged_at", "updated_at")
+DEFAULT_PERCENTS = [1, 5, 25, 50, 75, 95, 99]
+
+
+@lru_cache(maxsize=1 << 20)
+def parse_date(value):
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+    if len(value) == 10:
+        return datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+def millis(date):
+    return int(date.timestamp() * 1000)
+
+
+def is_date_field(field):
+    return field in DATE_FIELDS or field.endswith("_date")
+
+
+def get_values(doc, field):
+    if field.endswith(".keyword"):
+        field = field[:-len(".keyword")]
+    value = doc.get(field)
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def get_minimum_should_match(spec):
+    if "minimum_should_match" in spec:
+        return int(spec["minimum_should_match"])
+    return 0 if spec.get("must") or spec.get("filter") else 1
+
+
+def percentile(values, percent):
+    '''Linear interpolation between the closest ranks, values being sorted'''
+    rank = percent / 100.0 * (len(values) - 1)
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class StandInIndices:
+    def __init__(self, es):
+        self.es = es
+
+    def exists(self, index=None, **kwargs):
+        return index in self.es.indexes
+
+    def create(self, index=None, body=None, **kwargs):
+        self.es.add_docs(index, [])
+        return {"acknowledged": True, "index": index}
+
+    def put_mapping(self, index=None, body=None, **kwargs):
+        return {"acknowledged": True}
+
+    def refresh(self, index=None, **kwargs):
+        return {"_shards": {"failed": 0}}
+
+
+class StandInElasticsearch:
+    # Serializer read by elasticsearch.helpers.bulk
+    transport = type("Transport", (), {"serializer": JSONSerializer()})()
+
+    def __init__(self):
+        """In-process stand-in of an Elasticsearch cluster answering the subset of the
+        query DSL and aggregations the models send, so runs are measured without a cluster.
+        Docs are kept in memory and every query is evaluated on the docs of the tags it
+        selects, the whole index only when it does not select tags. The painless scripts
+        are recognized among the fixed ones of the models, runtime_mappings and the
+        AsyncElasticsearch client of async_concurrency are not supported.
+        requests, request_bytes and response_bytes count the traffic so far.
+        """
+        self.indexes = {}
+        self.postings = {}
+        self.doc_ids = {}
+        self.scrolls = {}
+        self.indices = StandInIndices(self)
+        self.requests = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def add_docs(self, index, docs):
+        '''Add docs to index, a doc with the _id or uuid of a stored one replaces it in place'''
+        stored = self.indexes.setdefault(index, [])
+        postings = self.postings.setdefault(index, {})
+        doc_ids = self.doc_ids.setdefault(index, {})
+        for doc in docs:
+            doc["_index"] = index
+            doc_id = doc.get("_id", doc.get("uuid"))
+            previous = doc_ids.get(str(doc_id)) if doc_id is not None else None
+            if previous is not None:
+                if get_values(previous, "tag") != get_values(doc, "tag"):
+                    self.remove_postings(index, previous)
+                    for tag in get_values(doc, "tag"):
+                        postings.setdefault(tag, []).append(previous)
+                previous.clear()
+                previous.update(doc)
+                continue
+            if doc_id is not None:
+                doc_ids[str(doc_id)] = doc
+            stored.append(doc)
+            for tag in get_values(doc, "tag"):
+                postings.setdefault(tag, []).append(doc)
+
+    def remove_doc(self, index, doc):
+        self.indexes[index].remove(doc)
+        self.remove_postings(index, doc)
+
+    def remove_postings(self, index, doc):
+        for tag in get_values(doc, "tag"):
+            self.postings[index][tag].remove(doc)
+
+    def count_traffic(self, body, response):
+        self.requests += 1
+        self.request_bytes += len(json.dumps(body, default=str))
+        self.response_bytes += len(json.dumps(response, default=str))
+        return response
+
+    def get_index_names(self, index):
+        names = list(index) if isinstance(index, (list, tuple)) else str(index).split(",")
+        found = [name for name in names if name in self.indexes]
+        if not found:
+            raise NotFoundError(404, "index_not_found_exception", {"index": names})
+        return found
+
+    def get_docs(self, index, query):
+        '''Docs of index matching query, evaluated on the docs of the tags it selects'''
+        docs = []
+        for name in self.get_index_names(index):
+            tags = self.get_tags(name, query)
+            if tags is None:
+                candidates = self.indexes[name]
+            else:
+                candidates = [doc for tag in sorted(tags) for doc in self.postings[name].get(tag, [])]
+            docs += [doc for doc in candidates if self.match(doc, query)]
+        return docs
+
+    # ---------------- tag selection
+
+    def get_tags(self, index, query):
+        '''Tags of index the docs matching query have, None if query does not restrict them'''
+        if not query:
+            return None
+        (kind, spec), = query.items()
+        if kind == "bool":
+            tags = None
+            for clause in as_list(spec.get("must")) + as_list(spec.get("filter")):
+                clause_tags = self.get_tags(index, clause)
+                if clause_tags is not None:
+                    tags = clause_tags if tags is None else tags & clause_tags
+            should = as_list(spec.get("should"))
+            if should and get_minimum_should_match(spec) >= 1:
+                should_tags = [self.get_tags(index, clause) for clause in should]
+                if all(clause_tags is not None for clause_tags in should_tags):
+                    union = set().union(*should_tags)
+                    tags = union if tags is None else tags & union
+            return tags
+        known = self.postings[index]
+        if kind == "simple_query_string" and spec["fields"] in (["tag"], ["tag.keyword"]):
+            return {tag for tag in known if self.match_sqs([tag], spec["query"])}
+        if kind in ("match_phrase", "match", "term") and list(spec) in (["tag"], ["tag.keyword"]):
+            value, = spec.values()
+            if isinstance(value, dict):
+                value = value.get("query", value.get("value"))
+            return {tag for tag in known if tag.lower() == str(value).lower()}
+        if kind == "terms" and list(spec) in (["tag"], ["tag.keyword"]):
+            return set(map(str, self.get_terms(spec))) & set(known)
+        return None
+
+    # ---------------- query
+
+    def get_terms(self, spec):
+        (field, values), = spec.items()
+        if isinstance(values, dict):
+            # terms lookup
+            doc = self.doc_ids.get(values["index"], {}).get(str(values["id"]))
+            values = get_values(doc, values["path"]) if doc else []
+        return values
+
+    def match(self, doc, query):
+        if not query:
+            return True
+        (kind, spec), = query.items()
+        if kind == "bool":
+            for clause in as_list(spec.get("must")) + as_list(spec.get("filter")):
+                if not self.match(doc, clause):
+                    return False
+            for clause in as_list(spec.get("must_not")):
+                if self.match(doc, clause):
+                    return False
+            should = as_list(spec.get("should"))
+            if should:
+                minimum = get_minimum_should_match(spec)
+                if minimum and sum(1 for clause in should if self.match(doc, clause)) < minimum:
+                    return False
+            return True
+        if kind == "match_all":
+            return True
+        if kind == "simple_query_string":
+            values = []
+            for field in spec["fields"]:
+                values += [str(value) for value in get_values(doc, field)]
+            return self.match_sqs(values, spec["query"])
+        if kind in ("match_phrase", "match", "term"):
+            (field, value), = spec.items()
+            if isinstance(value, dict):
+                value = value.get("query", value.get("value"))
+            return any(str(v).lower() == str(value).lower() for v in get_values(doc, field))
+        if kind == "terms":
+            (field, _), = spec.items()
+            values = {str(value) for value in self.get_terms(spec)}
+            return any(str(v) in values for v in get_values(doc, field))
+        if kind == "range":
+            (field, condition), = spec.items()
+            return any(self.in_range(value, condition, field) for value in get_values(doc, field))
+        if kind == "ids":
+            return str(doc.get("_id", doc.get("uuid"))) in {str(value) for value in spec["values"]}
+        if kind == "exists":
+            return len(get_values(doc, spec["field"])) > 0
+        if kind == "script":
+            return self.run_script(doc, spec["script"])
+        raise ValueError("query {} is not supported by the stand-in".format(kind))
+
+    def match_sqs(self, values, query):
+        '''simple_query_string of OR'ed "value", "value*" and "value(*)" clauses'''
+        for clause in query.split(" OR "):
+            clause = clause.strip()
+            if clause.endswith("(*)"):
+                if clause[:-3] in values:
+                    return True
+            elif clause.endswith("*"):
+                if any(value.startswith(clause[:-1]) for value in values):
+                    return True
+            elif clause in values:
+                return True
+        return False
+
+    def in_range(self, value, condition, field):
+        if is_date_field(field) or isinstance(value, str):
+            value = parse_date(value)
+            for op, bound in condition.items():
+                if op not in ("gt", "gte", "lt", "lte"):
+                    continue
+                day_only = isinstance(bound, str) and len(bound) == 10
+                bound = parse_date(bound)
+                # a day without time rounds up for gt and lte
+                if op in ("gt", "lte") and day_only:
+                    op, bound = ("gte" if op == "gt" else "lt"), bound + timedelta(days=1)
+                if not {"gt": value > bound, "gte": value >= bound, "lt": value < bound, "lte": value <= bound}[op]:
+                    return False
+            return True
+        for op, bound in condition.items():
+            if op in ("gt", "gte", "lt", "lte") and \
+                    not {"gt": value > bound, "gte": value >= bound, "lt": value < bound, "lte": value <= bound}[op]:
+                return False
+        return True
+
+    def run_script(self, doc, script):
+        '''Result of one of the filter scripts of the models'''
+        source = script if isinstance(script, str) else script.get("source", script.get("script", ""))
+        for field in ("labels", "issue_type"):
+            if "doc['{}']".format(field) in source:
+                return any("bug" in str(value).lower() or "缺陷" in str(value) for value in get_values(doc, field))
+        if "merged_by_data_name" in source:
+            merged_by = get_values(doc, "merged_by_data_name")
+            author = get_values(doc, "author_name")
+            return bool(merged_by and author and merged_by[0] != author[0])
+        if "Merge pull request" in source:
+            message = get_values(doc, "message")
+            return bool(message and "Merge pull request" not in message[0])
+        linked = re.search(r"indexOf\('(.*)/issue'\)", source)
+        if linked:
+            body = get_values(doc, "body")
+            return bool(body and (linked.group(1) + "/issue") in body[0])
+        raise ValueError("script is not supported by the stand-in: " + source[:80])
+
+    # ---------------- aggregations
+
+    def aggregate(self, docs, aggs):
+        result = {}
+        for name, spec in (aggs or {}).items():
+            spec = dict(spec)
+            sub = spec.pop("aggs", None) or spec.pop("aggregations", None)
+            (kind, body), = spec.items()
+            result[name] = self.aggregate_one(docs, kind, body, sub)
+        return result
+
+    def field_values(self, docs, body):
+        if "field" in body:
+            return [value for doc in docs for value in get_values(doc, body["field"])]
+        # the pull_id else id script of pr_issue_linked
+        return [doc["pull_id"] if "pull_id" in doc else doc["id"] for doc in docs if "pull_id" in doc or "id" in doc]
+
+    def aggregate_one(self, docs, kind, body, sub):
+        if kind == "cardinality":
+            return {"value": len({json.dumps(value) for value in self.field_values(docs, body)})}
+        if kind == "value_count":
+            return {"value": len(self.field_values(docs, body))}
+        if kind == "sum":
+            return {"value": float(sum(self.field_values(docs, body)))}
+        if kind in ("avg", "min", "max"):
+            values = self.field_values(docs, body)
+            date_field = is_date_field(body.get("field", ""))
+            if date_field:
+                values = [millis(parse_date(value)) for value in values]
+            if not values:
+                return {"value": None}
+            value = {"avg": lambda x: sum(x) / len(x), "min": min, "max": max}[kind](values)
+            result = {"value": float(value)}
+            if date_field:
+                result["value_as_string"] = datetime.fromtimestamp(value / 1000, tz=timezone.utc).strftime(
+                    "%Y-%m-%dT%H:%M:%S.000Z")
+            return result
+        if kind == "percentiles":
+            values = sorted(self.field_values(docs, body))
+            return {"values": {str(float(percent)): percentile(values, percent) if values else None
+                               for percent in body.get("percents", DEFAULT_PERCENTS)}}
+        if kind == "terms":
+            groups = {}
+            for doc in docs:
+                for value in set(get_values(doc, body["field"])):
+                    groups.setdefault(value, []).append(doc)
+            if isinstance(body.get("include"), list):
+                groups = {key: group for key, group in groups.items() if key in body["include"]}
+            keys = sorted(groups, key=lambda key: (-len(groups[key]), str(key)))[:body.get("size", 10)]
+            return {"buckets": [dict({"key": key, "doc_count": len(groups[key])}, **self.aggregate(groups[key], sub))
+                                for key in keys]}
+        if kind == "top_hits":
+            hits = self.sort_docs(docs, body.get("sort"))[:body.get("size", 3)]
+            return {"hits": {"hits": [{"_source": self.get_source(hit, body.get("_source"))} for hit in hits]}}
+        if kind == "date_histogram":
+            groups = {}
+            for doc in docs:
+                for value in get_values(doc, body["field"]):
+                    day = parse_date(value).replace(hour=0, minute=0, second=0, microsecond=0)
+                    groups.setdefault(millis(day), []).append(doc)
+            return {"buckets": [dict({"key": key, "doc_count": len(groups[key]),
+                                      "key_as_string": datetime.fromtimestamp(key / 1000, tz=timezone.utc).isoformat()},
+                                     **self.aggregate(groups[key], sub))
+                                for key in sorted(groups) if len(groups[key]) >= body.get("min_doc_count", 0)]}
+        if kind == "filter":
+            matched = [doc for doc in docs if self.match(doc, body)]
+            return dict({"doc_count": len(matched)}, **self.aggregate(matched, sub))
+        if kind == "composite":
+            return self.aggregate_composite(docs, body, sub)
+        raise ValueError("aggregation {} is not supported by the stand-in".format(kind))
+
+    def aggregate_composite(self, docs, body, sub):
+        names = [list(source)[0] for source in body["sources"]]
+        groups = {}
+        for doc in docs:
+            keys = [()]
+            for source in body["sources"]:
+                (source_kind, source_body), = list(source.values())[0].items()
+                values = get_values(doc, source_body["field"])
+                if source_kind == "date_histogram":
+                    values = [millis(parse_date(value).replace(hour=0, minute=0, second=0, microsecond=0))
+                              for value in values]
+                keys = [key + (value,) for key in keys for value in set(values)]
+            for key in keys:
+                groups.setdefault(key, []).append(doc)
+        ordered = sorted(groups)
+        if body.get("after"):
+            after = tuple(body["after"][name] for name in names)
+            ordered = [key for key in ordered if key > after]
+        page = ordered[:body.get("size", 10)]
+        result = {"buckets": [dict({"key": dict(zip(names, key)), "doc_count": len(groups[key])},
+                                   **self.aggregate(groups[key], sub)) for key in page]}
+        if page:
+            result["after_key"] = dict(zip(names, page[-1]))
+        return result
+
+    # ---------------- search API
+
+    def sort_docs(self, docs, sort):
+        docs = list(docs)
+        for spec in reversed(as_list(sort)):
+            if spec == "_doc":
+                continue
+            if isinstance(spec, str):
+                spec = {spec: "asc"}
+            (field, order), = spec.items()
+            if isinstance(order, dict):
+                order = order.get("order", "asc")
+            present = [doc for doc in docs if get_values(doc, field)]
+            missing = [doc for doc in docs if not get_values(doc, field)]
+            if is_date_field(field):
+                present.sort(key=lambda doc: parse_date(get_values(doc, field)[0]), reverse=order == "desc")
+            else:
+                present.sort(key=lambda doc: get_values(doc, field)[0], reverse=order == "desc")
+            docs = present + missing
+        return docs
+
+    def get_source(self, doc, fields):
+        if fields is False:
+            return None
+        source = {key: value for key, value in doc.items() if key not in ("_id", "_index")}
+        if isinstance(fields, list):
+            source = {key: value for key, value in source.items() if key in fields}
+        return copy.deepcopy(source)
+
+    def get_hit(self, doc, fields):
+        hit = {"_index": doc["_index"], "_id": str(doc.get("_id", doc.get("uuid"))), "_score": 1.0}
+        source = self.get_source(doc, fields)
+        if source is not None:
+            hit["_source"] = source
+        return hit
+
+    def run_search(self, index, body, size=None, scroll=None):
+        if body.get("runtime_mappings"):
+            raise ValueError("runtime_mappings are not supported by the stand-in")
+        docs = self.get_docs(index, body.get("query"))
+        size = size if size is not None else body.get("size", 10)
+        ordered = self.sort_docs(docs, body.get("sort"))
+        fields = body.get("_source")
+        response = {"took": 0, "timed_out": False, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+                    "hits": {"total": {"value": len(docs), "relation": "eq"}, "max_score": 1.0,
+                             "hits": [self.get_hit(doc, fields) for doc in ordered[:size]]}}
+        if scroll:
+            scroll_id = str(len(self.scrolls))
+            self.scrolls[scroll_id] = (ordered[size:], size, fields)
+            response["_scroll_id"] = scroll_id
+        aggs = body.get("aggs") or body.get("aggregations")
+        if aggs:
+            response["aggregations"] = self.aggregate(docs, aggs)
+        return response
+
+    def search(self, index=None, body=None, size=None, scroll=None, **kwargs):
+        body = body or {}
+        return self.count_traffic(body, self.run_search(index, body, size, scroll))
+
+    def msearch(self, body, index=None, **kwargs):
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.splitlines() if line.strip()]
+        responses = []
+        for header, query in zip(body[0::2], body[1::2]):
+            try:
+                responses.append(dict(self.run_search(header.get("index", index), query), status=200))
+            except NotFoundError as error:
+                responses.append({"error": {"type": "index_not_found_exception", "reason": str(error)}, "status": 404})
+        return self.count_traffic(body, {"took": 0, "responses": responses})
+
+    def scroll(self, body=None, scroll_id=None, **kwargs):
+        scroll_id = scroll_id or body["scroll_id"]
+        rest, size, fields = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (rest[size:], size, fields)
+        return self.count_traffic(body or {"scroll_id": scroll_id}, {
+            "_scroll_id": scroll_id, "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {"hits": [self.get_hit(doc, fields) for doc in rest[:size]]}})
+
+    def clear_scroll(self, body=None, scroll_id=None, **kwargs):
+        for scroll_id in as_list(scroll_id or (body or {}).get("scroll_id")):
+            self.scrolls.pop(scroll_id, None)
+        return {"succeeded": True}
+
+    def index(self, index=None, body=None, id=None, **kwargs):
+        doc = dict(body, _id=id) if id is not None else dict(body)
+        self.add_docs(index, [doc])
+        return self.count_traffic(body, {"_index": index, "_id": id, "result": "created"})
+
+    def get(self, index=None, id=None, **kwargs):
+        doc = self.doc_ids.get(index, {}).get(str(id))
+        if doc is None:
+            raise NotFoundError(404, "not_found", {"_index": index, "_id": id})
+        return self.count_traffic({}, {"_index": index, "_id": id, "found": True, "_source": self.get_source(doc, None)})
+
+    def bulk(self, body, index=None, **kwargs):
+        if isinstance(body, bytes):
+            body = body.decode()
+        lines = body.splitlines() if isinstance(body, str) else \
+            [line.decode() if isinstance(line, bytes) else line for line in body]
+        lines = [json.loads(line) if isinstance(line, str) else line for line in lines if line]
+        items = []
+        n = 0
+        while n < len(lines):
+            (op, meta), = lines[n].items()
+            name = meta.get("_index", index)
+            doc_id = meta.get("_id")
+            if op == "delete":
+                doc = self.doc_ids.get(name, {}).pop(str(doc_id), None)
+                if doc is not None:
+                    self.remove_doc(name, doc)
+                items.append({op: {"_index": name, "_id": doc_id, "status": 200 if doc else 404}})
+                n += 1
+                continue
+            source = lines[n + 1]
+            n += 2
+            stored = self.doc_ids.get(name, {}).get(str(doc_id))
+            if op == "update":
+                if stored is not None:
+                    doc = dict(stored, **source.get("doc", {}))
+                elif source.get("doc_as_upsert"):
+                    doc = dict(source["doc"], _id=doc_id)
+                else:
+                    items.append({op: {"_index": name, "_id": doc_id, "status": 404,
+                                       "error": {"type": "document_missing_exception"}}})
+                    continue
+            else:
+                doc = dict(source, _id=doc_id) if doc_id is not None else dict(source)
+            self.add_docs(name, [doc])
+            items.append({op: {"_index": name, "_id": doc_id, "status": 200}})
+        response = {"took": 0, "errors": any("error" in list(item.values())[0] for item in items), "items": items}
+        return self.count_traffic(lines, response)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import json
+import queue
+import threading
+import time
+
+MAX_DOCS = 500
+MAX_BYTES = 5 * 1024 * 1024
+MAX_INTERVAL = 5.0
+QUEUE_SIZE = 2000
+MAX_RETRIES = 3
+RETRY_DELAY = 1.0
+# Bulk item statuses worth sending again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_CLOSE = object()
+
+
+class BulkWriter:
+    def __init__(self, es_client, index, max_docs=MAX_DOCS, max_bytes=MAX_BYTES, max_interval=MAX_INTERVAL,
+                 queue_size=QUEUE_SIZE, max_retries=MAX_RETRIES):
+        """Index docs from a background thread, so that computing the next dates does not
+        wait on bulk requests. Docs are queued by bulk_upload and sent once max_docs docs
+        or max_bytes bytes are pending, or max_interval seconds after the first of them.
+        :param es_client: Elasticsearch client the bulk requests are sent with.
+        :param index: index the docs are written to.
+        :param queue_size: number of docs queued before bulk_upload blocks.
+        :param max_retries: number of times the rejected docs of a bulk request are resent.
+        """
+        self.es_client = es_client
+        self.index = index
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_interval = max_interval
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.docs = 0
+        self.requests = 0
+        self.retries = 0
+        self.failed = 0
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def bulk_upload(self, items, field_id):
+        '''Queue items to be indexed with field_id as _id, like ElasticSearch.bulk_upload'''
+        if self.error is not None:
+            raise self.error
+        for item in items:
+            line = json.dumps({"index": {"_index": self.index, "_id": item[field_id]}}) + "\n" + json.dumps(item) + "\n"
+            self.queue.put(line)
+        return len(items)
+
+    def close(self):
+        '''Send the queued docs, stop the thread and print the throughput'''
+        self.queue.put(_CLOSE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.es_client.indices.refresh(index=self.index)
+        seconds = time.time() - self.started
+        print("{}: {} docs in {} bulk requests, {:.1f} docs/s, {} retried, {} failed".format(
+            self.index, self.docs, self.requests, self.docs / seconds if seconds else 0, self.retries, self.failed))
+
+    def run(self):
+        lines = []
+        size = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.time(), 0)
+            try:
+                line = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                line = None
+            if line is not None and line is not _CLOSE:
+                lines.append(line)
+                size += len(line)
+                if deadline is None:
+                    deadline = time.time() + self.max_interval
+            if lines and (line is None or line is _CLOSE or len(lines) >= self.max_docs or size >= self.max_bytes):
+                try:
+                    self.send(lines)
+                except Exception as e:
+                    self.error = e
+                    self.drain()
+                    return
+                lines = []
+                size = 0
+                deadline = None
+            if line is _CLOSE:
+                return
+
+    def drain(self):
+        '''Unblock bulk_upload after a failure, until close is called'''
+        while self.queue.get() is not _CLOSE:
+            pass
+
+    def send(self, lines):
+        '''Bulk index lines, resending the docs rejected with a retryable status'''
+        for attempt in range(self.max_retries + 1):
+            self.requests += 1
+            response = self.es_client.bulk(body="".join(lines))
+            if not response.get("errors"):
+                self.docs += len(lines)
+                return
+            rejected = []
+            for line, item in zip(lines, response["items"]):
+                result = item.get("index", {})
+                if "error" not in result:
+                    self.docs += 1
+                elif result.get("status") in RETRY_STATUSES and attempt < self.max_retries:
+                    rejected.append(line)
+                else:
+                    self.failed += 1
+                    print("{}: failed to index {}: {}".format(self.index, result.get("_id"), result.get("error")))
+            if not rejected:
+                return
+            self.retries += len(rejected)
+            lines = rejected
+            time.sleep(RETRY_DELAY * 2 ** attempt)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import copy
+import gzip
+import hashlib
+import json
+import threading
+import time
+from urllib.parse import unquote
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import HTTP_EXCEPTIONS, TransportError
+from grimoirelab_toolkit.datetime import datetime_utcnow
+
+CASSETTE_VERSION = 1
+REPLAY_URL = "http://replay:9200"
+# Request parameters handled by the client, they do not change the response
+CLIENT_PARAMS = ("request_timeout", "ignore")
+BULK_ACTIONS = ("index", "create", "update", "delete")
+
+# Recorders and replays of this process by cassette path
+cassette_recorders = {}
+cassette_replays = {}
+
+
+def get_body_lines(body):
+    '''Body of a request as a list of json values, one per line of an ndjson body'''
+    if body is None:
+        return []
+    if isinstance(body, bytes):
+        body = body.decode("utf-8")
+    if isinstance(body, str):
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    return [body]
+
+
+def get_key(*parts):
+    '''Hash of the canonical json of parts'''
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_request_params(params):
+    return {name: value for name, value in (params or {}).items() if name not in CLIENT_PARAMS}
+
+
+def get_search_index(url, endpoint):
+    '''Indexes of a search or _msearch url as a sorted tuple, None if the url is not one'''
+    path = url.split("?")[0].strip("/").split("/")
+    if path[-1] != endpoint or len(path) > 2:
+        return None
+    return tuple(sorted(unquote(path[0]).split(","))) if len(path) == 2 else ()
+
+
+def get_error(error):
+    '''Exception of a recorded error'''
+    status = error.get("status")
+    return HTTP_EXCEPTIONS.get(status, TransportError)(status, error.get("error"), error.get("info"))
+
+
+class CassetteRecorder:
+    def __init__(self, path):
+        """Gzipped json lines file of the requests of the clients of a run. A header line
+        gives the day of the recording, then each line holds the method, url, params and
+        body of a request with its response, or error, and its latency in seconds.
+        :param path: path of the cassette, overwritten.
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.file = gzip.open(path, "wt")
+        self.write({"cassette": CASSETTE_VERSION, "day": datetime_utcnow().strftime("%Y-%m-%d")})
+
+    def write(self, line):
+        self.file.write(json.dumps(line, separators=(",", ":"), default=str) + "\n")
+
+    def record(self, method, url, params, body, latency, response=None, error=None):
+        line = {"method": method, "url": url, "params": get_request_params(params),
+                "body": get_body_lines(body), "latency": latency}
+        if error is not None:
+            line["error"] = {"status": error.status_code, "error": error.error, "info": error.info}
+        else:
+            line["response"] = response
+        with self.lock:
+            self.write(line)
+            self.requests += 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class RecordingTransport:
+    def __init__(self, transport, recorder):
+        """Transport of a client recording every request it performs in recorder.
+        :param transport: transport the requests are performed with.
+        :param recorder: CassetteRecorder of the run.
+        """
+        self.transport = transport
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        if name in ("transport", "recorder"):
+            raise AttributeError(name)
+        return getattr(self.transport, name)
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        # the transport pops the client params from params
+        request_params = dict(params or {})
+        start = time.perf_counter()
+        try:
+            response = self.transport.perform_request(method, url, headers=headers, params=params, body=body)
+        except TransportError as e:
+            self.recorder.record(method, url, request_params, body, time.perf_counter() - start, error=e)
+            raise
+        self.recorder.record(method, url, request_params, body, time.perf_counter() - start, response)
+        return response
+
+
+class CassetteReplay:
+    def __init__(self, path, latency=False):
+        """Responses of a cassette by request. Identical requests get the responses
+        recorded for them in order, the last one once they are used up. A search
+        missing from the cassette is answered from the same search recorded alone or
+        in an _msearch, and an _msearch from its searches, so a run can be replayed with
+        other batching or caching options than the recording. Dates of the day of the
+        replay in the requests stand for the day of the recording.
+        :param path: path of a cassette written by CassetteRecorder.
+        :param latency: sleep the recorded latency of every response. A search taken
+            from an _msearch has the latency of the _msearch.
+        """
+        self.path = path
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.searches = {}
+        self.today = datetime_utcnow().strftime("%Y-%m-%d")
+        with gzip.open(path, "rt") as f:
+            header = json.loads(f.readline())
+            if header.get("cassette") != CASSETTE_VERSION:
+                raise ValueError("{} is not a cassette of version {}".format(path, CASSETTE_VERSION))
+            self.day = header["day"]
+            for line in f:
+                self.add(json.loads(line))
+
+    def reset(self):
+        '''Start every request over at its first recorded entry, called when a run starts'''
+        with self.lock:
+            for entries in list(self.requests.values()) + list(self.searches.values()):
+                entries[0] = 0
+
+    def add(self, entry):
+        method, url, params, lines = entry["method"], entry["url"], entry["params"], entry["body"]
+        self.requests.setdefault(get_key(method, url, params, lines), [0, []])[1].append(entry)
+        search_index = get_search_index(url, "_search")
+        if search_index is not None and lines:
+            self.add_search(search_index, params, lines[0], entry)
+        msearch_index = get_search_index(url, "_msearch")
+        if msearch_index is not None and "response" in entry:
+            for (header, body), response in zip(self.iter_searches(msearch_index, lines),
+                                                entry["response"]["responses"]):
+                if "error" in response:
+                    error = {"status": response.get("status"), "error": response["error"], "info": response}
+                    self.add_search(header, {}, body, {"error": error, "latency": entry["latency"]})
+                else:
+                    self.add_search(header, {}, body, {"response": response, "latency": entry["latency"]})
+
+    def add_search(self, index, params, body, entry):
+        self.searches.setdefault(get_key(index, params, body), [0, []])[1].append(entry)
+
+    def iter_searches(self, index, lines):
+        '''(indexes, body) of the searches of the lines of an _msearch'''
+        for header, body in zip(lines[0::2], lines[1::2]):
+            search_index = header.get("index")
+            if search_index is None:
+                yield index, body
+            elif isinstance(search_index, list):
+                yield tuple(sorted(search_index)), body
+            else:
+                yield tuple(sorted(search_index.split(","))), body
+
+    def take(self, entries):
+        '''Next recorded entry of a request, the last one once they are used up'''
+        with self.lock:
+            position, recorded = entries
+            entries[0] = min(position + 1, len(recorded) - 1)
+        return recorded[position]
+
+    def get_entry(self, method, url, params, body):
+        '''Recorded entry answering a request, None if the cassette has none'''
+        params = get_request_params(params)
+        lines = json.loads(json.dumps(get_body_lines(body), default=str).replace(self.today, self.day))
+        entries = self.requests.get(get_key(method, url, params, lines))
+        if entries is not None:
+            return self.take(entries)
+        search_index = get_search_index(url, "_search")
+        if search_index is not None and lines:
+            entries = self.searches.get(get_key(search_index, params, lines[0]))
+            return self.take(entries) if entries is not None else None
+        msearch_index = get_search_index(url, "_msearch")
+        if msearch_index is not None:
+            return self.get_msearch_entry(msearch_index, lines)
+        write_response = self.get_write_response(method, url, lines)
+        if write_response is not None:
+            return {"response": write_response, "latency": 0}
+        return None
+
+    def get_write_response(self, method, url, lines):
+        '''Response of a write missing from the cassette, None if the request is not one.
+        Writes are not kept: they are acknowledged, and an index missing from the cassette
+        does not exist, so the run creates it and reads nothing back.'''
+        path = url.split("?")[0].strip("/").split("/")
+        if path[-1] == "_bulk":
+            return self.get_bulk_response(lines)
+        if path[-1] == "_refresh":
+            return {"_shards": {"total": 1, "successful": 1, "failed": 0}}
+        if len(path) == 1 and path[0] and not path[0].startswith("_"):
+            if method == "HEAD":
+                return False
+            if method == "PUT":
+                return {"acknowledged": True, "shards_acknowledged": True, "index": unquote(path[0])}
+        if len(path) in (2, 3) and path[1] in ("_doc", "_create") and method in ("PUT", "POST"):
+            return {"_index": unquote(path[0]), "_id": unquote(path[2]) if len(path) == 3 else None,
+                    "result": "created", "_shards": {"total": 1, "successful": 1, "failed": 0}}
+        return None
+
+    def get_msearch_entry(self, index, lines):
+        responses = []
+        latency = 0
+        for header, body in self.iter_searches(index, lines):
+            entries = self.searches.get(get_key(header, {}, body))
+            if entries is None:
+                return None
+            entry = self.take(entries)
+            latency = max(latency, entry["latency"])
+            if "error" in entry:
+                responses.append({"error": entry["error"]["error"], "status": entry["error"]["status"]})
+            else:
+                responses.append(entry["response"])
+        return {"response": {"took": max([response.get("took", 0) for response in responses] or [0]),
+                             "responses": responses}, "latency": latency}
+
+    def get_bulk_response(self, lines):
+        '''Writes are not recorded, every action of a _bulk missing from the cassette succeeds'''
+        items = []
+        for line in lines:
+            action = next(iter(line), None) if isinstance(line, dict) and len(line) == 1 else None
+            if action in BULK_ACTIONS and isinstance(line[action], dict):
+                meta = line[action]
+                items.append({action: {"_index": meta.get("_index"), "_id": meta.get("_id"),
+                                       "status": 200, "result": "updated"}})
+        return {"took": 0, "errors": False, "items": items}
+
+
+class ReplayTransport:
+    def __init__(self, cassette, serializer):
+        """Transport of a client answering every request from cassette, no cluster is
+        contacted. The writes missing from the cassette are acknowledged, see
+        CassetteReplay.get_write_response, any other request missing from it raises LookupError.
+        :param cassette: CassetteReplay of the run.
+        :param serializer: serializer of the client, used by the helpers.
+        """
+        self.cassette = cassette
+        self.serializer = serializer
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        entry = self.cassette.get_entry(method, url, params, body)
+        if entry is None:
+            raise LookupError("{} {} is not in the cassette {}".format(method, url, self.cassette.path))
+        if self.cassette.latency:
+            time.sleep(entry["latency"])
+        if "error" in entry:
+            raise get_error(entry["error"])
+        # the helpers consume the responses they get, such as the items of a _bulk
+        return copy.deepcopy(entry["response"])
+
+    def close(self):
+        pass
+
+
+class CountingWriter:
+    def __init__(self, out_index):
+        """Stand-in for es_out of a replay, the rows are counted instead of written.
+        :param out_index: index the rows would be written to.
+        """
+        self.out_index = out_index
+        self.rows = 0
+
+    def bulk_upload(self, items, field_id):
+        self.rows += len(items)
+        return len(items)
+
+    def close(self):
+        pass
+
+
+def get_cassette_recorder(path):
+    '''CassetteRecorder of this process for path, the cassette is started over once closed'''
+    recorder = cassette_recorders.get(path)
+    if recorder is None or recorder.file.closed:
+        recorder = cassette_recorders[path] = CassetteRecorder(path)
+    return recorder
+
+
+def close_cassette_recorder(path):
+    recorder = cassette_recorders.pop(path, None)
+    if recorder is not None:
+        recorder.close()
+
+
+def record_client(es_client, path):
+    '''es_client recording its requests in the cassette of path'''
+    es_client.transport = RecordingTransport(es_client.transport, get_cassette_recorder(path))
+    return es_client
+
+
+def get_cassette_replay(path, latency=False):
+    '''CassetteReplay of this process for path, loaded once. A run resets it when it starts.'''
+    if (path, latency) not in cassette_replays:
+        cassette_replays[(path, latency)] = CassetteReplay(path, latency)
+    return cassette_replays[(path, latency)]
+
+
+def get_replay_client(path, latency=False):
+    '''Elasticsearch client answered from the cassette of path'''
+    es_client = Elasticsearch(REPLAY_URL)
+    es_client.transport = ReplayTransport(get_cassette_replay(path, latency), es_client.transport.serializer)
+    return es_client
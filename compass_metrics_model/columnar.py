@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from .backfill import day_millis
+
+DAY_MILLIS = 24 * 60 * 60 * 1000
+SCAN_SIZE = 5000
+
+# _source fields read by the models, per kind of index
+SOURCE_FIELDS = {
+    "git": ["tag", "grimoire_creation_date", "metadata__updated_on", "hash", "author_name",
+            "author_org_name", "lines_changed", "lines_added", "lines_removed", "message"],
+    "issue": ["tag", "pull_request", "uuid", "author_name", "grimoire_creation_date", "metadata__updated_on",
+              "created_at", "closed_at", "state", "num_of_comments_without_bot",
+              "time_to_first_attention_without_bot", "labels", "issue_type"],
+    "pr": ["tag", "pull_request", "uuid", "id", "author_name", "grimoire_creation_date", "created_at",
+           "updated_at", "closed_at", "merged_at", "state", "num_review_comments_without_bot",
+           "time_to_first_attention_without_bot", "merged_by_data_name", "linked_issues_count",
+           "body", "commits_data"],
+    "issue_comments": ["tag", "item_type", "issue_pull_request", "author_name", "grimoire_creation_date"],
+    "pr_comments": ["tag", "item_type", "pull_id", "id", "author_name", "grimoire_creation_date",
+                    "linked_issues_count", "body"],
+    "release": ["tag", "uuid", "grimoire_creation_date"],
+}
+DATE_FIELDS = ["grimoire_creation_date", "metadata__updated_on", "created_at", "updated_at",
+               "closed_at", "merged_at"]
+
+
+def utc_millis(values):
+    '''Epoch millis of ISO date strings, NaN where missing'''
+    dates = pd.to_datetime(values, utc=True, errors="coerce", format="ISO8601")
+    return np.where(dates.isna(), np.nan, dates.astype("int64") // 10**6)
+
+
+def wall_micros(values):
+    '''Wall-clock micros of ISO date strings ignoring their offset, the way
+    get_time_diff_days and get_time_diff_months drop tzinfo'''
+    dates = pd.to_datetime(pd.Series(values, dtype=object).str[:26], errors="coerce", format="ISO8601")
+    return np.where(dates.isna(), np.nan, dates.astype("int64") // 10**3)
+
+
+def round_diff(micros, seconds):
+    '''float('%.2f' % diff) as done by get_time_diff_days and get_time_diff_months'''
+    return np.array([float('%.2f' % (i / 10**6 / seconds)) for i in micros], dtype=float)
+
+
+def is_true(values):
+    return values.astype(str).str.lower() == "true"
+
+
+def mean_and_median(values):
+    '''(average, median) the way sum()/len() and get_medium compute them, None if empty'''
+    if len(values) == 0:
+        return None, None
+    return float(sum(values)/len(values)), float(np.median(values))
+
+
+class Window:
+    def __init__(self, frame, date_field):
+        """Rows of a frame sorted by date_field for window slicing."""
+        self.times = frame["_" + date_field].to_numpy()
+        keep = ~np.isnan(self.times)
+        order = np.argsort(self.times[keep], kind="stable")
+        self.frame = frame[keep].iloc[order].reset_index(drop=True)
+        self.times = self.times[keep][order]
+
+    def slice(self, from_date, to_date, include_end=False):
+        '''Rows with date_field in [from_date, to_date), or [from_date, to_date] if include_end'''
+        end = day_millis(to_date) + (DAY_MILLIS if include_end else 0)
+        start = np.searchsorted(self.times, day_millis(from_date), "left")
+        stop = np.searchsorted(self.times, end, "left")
+        return self.frame.iloc[start:stop]
+
+    def before(self, to_date):
+        '''Rows with date_field before to_date'''
+        return self.frame.iloc[:np.searchsorted(self.times, day_millis(to_date), "left")]
+
+
+class ColumnarMetrics:
+    def __init__(self, model, repos_list):
+        """Metrics source computing every metric in memory. The docs of repos_list are
+        pulled once per index with only the fields the models read, and every date's
+        windows are slices of the same columns.
+        :param model: the MetricsModel whose metrics are answered.
+        :param repos_list: repos of the label being enriched.
+        """
+        self.model = model
+        self.repos_list = repos_list
+        self.frames = {}
+        self.windows = {}
+
+    def __getattr__(self, name):
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def get_frame(self, kind):
+        '''Docs of repos_list in the index of the given kind, one scan on first use'''
+        if kind in self.frames:
+            return self.frames[kind]
+        index = getattr(self.model, kind + "_index", None)
+        fields = SOURCE_FIELDS[kind]
+        query = {
+            "query": {
+                "bool": {
+                    "should": self.model.get_repos_should(self.repos_list),
+                    "minimum_should_match": 1
+                }
+            },
+            "_source": fields
+        }
+        rows = []
+        if index:
+            try:
+                rows = [hit["_source"] for hit in helpers.scan(self.model.es_in, query=query, index=index, size=SCAN_SIZE)]
+            except NotFoundError:
+                if kind != "release":
+                    raise
+        frame = pd.DataFrame(rows).reindex(columns=fields)
+        frame["tag"] = frame["tag"].fillna("").astype(str)
+        for field in DATE_FIELDS:
+            if field in frame:
+                frame["_" + field] = utc_millis(frame[field])
+                frame["~" + field] = wall_micros(frame[field])
+        self.frames[kind] = frame
+        return frame
+
+    def get_window(self, name, kind, date_field, where=None):
+        '''Window over the docs of kind matching where(frame), cached by name'''
+        if name not in self.windows:
+            frame = self.get_frame(kind)
+            if where is not None:
+                frame = frame[where(frame).to_numpy(dtype=bool)]
+            self.windows[name] = Window(frame, date_field)
+        return self.windows[name]
+
+    def prefix(self, frame):
+        '''Docs matched by the repo + "*" simple_query_string of the query builders'''
+        return frame["tag"].str.startswith(tuple(self.repos_list))
+
+    def exact(self, frame):
+        '''Docs matched by the repo simple_query_string without wildcard'''
+        return frame["tag"].isin(self.repos_list)
+
+    def authors(self, windows, date, include_end=False):
+        authors = set()
+        for window in windows:
+            authors.update(window.slice(date - timedelta(days=90), date, include_end)["author_name"].dropna())
+        return authors
+
+    def created_since_list(self, date):
+        '''Months since the first commit of each repo having commits before date'''
+        window = self.get_window("git_created", "git", "grimoire_creation_date", self.prefix)
+        docs = window.before(date)
+        created_since_list = []
+        for repo in self.repos_list:
+            repo_docs = docs[docs["tag"] == repo + ".git"]
+            if len(repo_docs) > 0:
+                created_since_list.append(self.model_months(repo_docs["~grimoire_creation_date"].iloc[0], date))
+        return created_since_list
+
+    def created_since(self, date, repos_list):
+        created_since_list = self.created_since_list(date)
+        if created_since_list:
+            return sum(created_since_list) / len(created_since_list)
+        else:
+            return None
+
+    def model_months(self, micros, date):
+        '''get_time_diff_months(start, str(date)) from wall-clock micros of start'''
+        end = day_millis(date) * 1000
+        return float('%.2f' % ((end - micros) / 10**6 / float(60 * 60 * 24 * 30)))
+
+    def contributor_authors(self, date):
+        windows = [self.get_window("contributor_" + kind, kind, "grimoire_creation_date", self.prefix)
+                   for kind in self.contributor_kinds]
+        return self.authors(windows, date)
+
+    def contributor_count(self, date, repos_list):
+        return len(self.contributor_authors(date))
+
+    def commit_authors(self, date):
+        window = self.get_window("git_commits", "git", "grimoire_creation_date", self.prefix)
+        return self.authors([window], date)
+
+    def active_C2_contributor_count(self, date, repos_list):
+        return len(self.commit_authors(date))
+
+    def pr_create_authors(self, date):
+        window = self.get_window("prs", "pr", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & is_true(frame["pull_request"]))
+        return self.authors([window], date, include_end=True)
+
+    def active_C1_pr_create_contributor(self, date, repos_list):
+        return len(self.pr_create_authors(date))
+
+    def pr_comment_authors(self, date):
+        window = self.get_window("pr_comments", "pr_comments", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & (frame["item_type"] == "comment"))
+        return self.authors([window], date, include_end=True)
+
+    def active_C1_pr_comments_contributor(self, date, repos_list):
+        return len(self.pr_comment_authors(date))
+
+    def issues(self, date):
+        window = self.get_window("issues", "issue", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & ~is_true(frame["pull_request"]))
+        return window.slice(date - timedelta(days=90), date)
+
+    def comment_frequency(self, date, repos_list):
+        issues = self.issues(date)
+        if len(issues) == 0:
+            return None
+        return float(issues["num_of_comments_without_bot"].sum())/len(issues)
+
+    def updated_issue_uuids(self, date):
+        window = self.get_window("updated_issues", "issue", "metadata__updated_on",
+                                 lambda frame: self.prefix(frame) & ~is_true(frame["pull_request"]))
+        return set(window.slice(date - timedelta(days=90), date)["uuid"].dropna())
+
+    def updated_issue_count(self, date, repos_list):
+        return len(self.updated_issue_uuids(date))
+
+    def pr_count(self, date):
+        window = self.get_window("prs", "pr", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & is_true(frame["pull_request"]))
+        return window.slice(date - timedelta(days=90), date)["uuid"].nunique()
+
+
+class ActivityColumnarMetrics(ColumnarMetrics):
+    contributor_kinds = ["git", "issue", "pr", "issue_comments", "pr_comments"]
+
+    def commit_hashes(self, date):
+        window = self.get_window("git_commits", "git", "grimoire_creation_date", self.prefix)
+        return set(window.slice(date - timedelta(days=90), date)["hash"].dropna())
+
+    def commit_frequency(self, date, repos_list):
+        return len(self.commit_hashes(date))/12.85
+
+    def updated_since_list(self, date):
+        window = self.get_window("git_updated", "git", "metadata__updated_on", self.prefix)
+        docs = window.before(date)
+        updated_since_list = []
+        for repo in self.repos_list:
+            repo_docs = docs[docs["tag"] == repo + ".git"]
+            if len(repo_docs) > 0:
+                updated_since_list.append(self.model_months(repo_docs["~metadata__updated_on"].iloc[-1], date))
+        return updated_since_list
+
+    def updated_since(self, date, repos_list):
+        updated_since_list = self.updated_since_list(date)
+        if updated_since_list:
+            return sum(updated_since_list) / len(updated_since_list)
+        else:
+            return 0
+
+    def closed_issue_uuids(self, date):
+        window = self.get_window("closed_issues", "issue", "closed_at",
+                                 lambda frame: self.exact(frame) & ~is_true(frame["pull_request"])
+                                 & ~frame["state"].isin(["open", "progressing"]))
+        return set(window.slice(date - timedelta(days=90), date)["uuid"].dropna())
+
+    def closed_issue_count(self, date, repos_list):
+        return len(self.closed_issue_uuids(date))
+
+    def prs(self, date):
+        window = self.get_window("prs", "pr", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & is_true(frame["pull_request"]))
+        return window.slice(date - timedelta(days=90), date)
+
+    def code_review_count(self, date, repos_list):
+        prs = self.prs(date)
+        if len(prs) == 0:
+            return None
+        return float(prs["num_review_comments_without_bot"].sum())/len(prs)
+
+    def release_uuids(self, date):
+        window = self.get_window("releases", "release", "grimoire_creation_date", self.exact)
+        return set(window.slice(date - timedelta(days=365), date)["uuid"].dropna())
+
+    def recent_releases_count(self, date, repos_list):
+        return len(self.release_uuids(date))
+
+    def issue_create_authors(self, date):
+        window = self.get_window("issue_authors", "issue", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & ~is_true(frame["pull_request"]))
+        return self.authors([window], date, include_end=True)
+
+    def active_C1_issue_create_contributor(self, date, repos_list):
+        return len(self.issue_create_authors(date))
+
+    def issue_comment_authors(self, date):
+        window = self.get_window("issue_comments", "issue_comments", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & (frame["item_type"] == "comment")
+                                 & ~is_true(frame["issue_pull_request"]))
+        return self.authors([window], date, include_end=True)
+
+    def active_C1_issue_comments_contributor(self, date, repos_list):
+        return len(self.issue_comment_authors(date))
+
+
+class CommunitySupportColumnarMetrics(ColumnarMetrics):
+    def first_response(self, name, kind, pull_request, date):
+        window = self.get_window(name, kind, "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & (is_true(frame["pull_request"]) == pull_request))
+        docs = window.slice(date - timedelta(days=90), date)
+        if len(docs) == 0:
+            return None, None
+        values = docs["time_to_first_attention_without_bot"].dropna().to_numpy(dtype=float)
+        if len(values) == 0:
+            return None, None
+        return float(values.mean()), float(np.median(values))
+
+    def issue_first_reponse(self, date, repos_list):
+        return self.first_response("issues", "issue", False, date)
+
+    def pr_first_response_time(self, date, repos_list):
+        return self.first_response("prs", "pr", True, date)
+
+    def open_issues(self, name, date, where):
+        window = self.get_window(name, "issue", "grimoire_creation_date", where)
+        return window.slice(date - timedelta(days=90), date)
+
+    def issue_open_time(self, date, repos_list):
+        issues = self.open_issues("issues", date,
+                                  lambda frame: self.prefix(frame) & ~is_true(frame["pull_request"]))
+        issues = issues[issues["state"].notna()]
+        closed = issues["closed_at"].notna().to_numpy()
+        closed_in_time = closed & issues["state"].isin(["closed", "rejected"]).to_numpy() \
+            & (issues["_closed_at"].to_numpy() < day_millis(date))
+        end = np.where(closed_in_time, issues["~closed_at"], day_millis(date) * 1000)
+        counted = closed_in_time | ~closed
+        return mean_and_median(round_diff((end - issues["~created_at"].to_numpy())[counted], 60 * 60 * 24))
+
+    def bug_issue_open_time(self, date, repos_list):
+        def is_bug(values):
+            return values.map(lambda labels: any(
+                'bug' in str(label).lower() or '缺陷' in str(label).lower()
+                for label in (labels if isinstance(labels, list) else [labels] if isinstance(labels, str) else [])))
+        issues = self.open_issues("bug_issues", date,
+                                  lambda frame: self.prefix(frame) & ~is_true(frame["pull_request"])
+                                  & (is_bug(frame["labels"]) | is_bug(frame["issue_type"])))
+        issues = issues[issues["state"].notna()]
+        closed_in_time = issues["closed_at"].notna().to_numpy() \
+            & issues["state"].isin(["closed", "rejected"]).to_numpy() \
+            & (issues["_closed_at"].to_numpy() < day_millis(date))
+        end = np.where(closed_in_time, issues["~closed_at"], day_millis(date) * 1000)
+        return mean_and_median(round_diff(end - issues["~created_at"].to_numpy(), 60 * 60 * 24))
+
+    def pr_open_time(self, date, repos_list):
+        window = self.get_window("prs", "pr", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & is_true(frame["pull_request"]))
+        prs = window.slice(date - timedelta(days=90), date)
+        prs = prs[prs["state"].notna()]
+        state = prs["state"].to_numpy()
+        created = prs["~created_at"].to_numpy()
+        merged = (state == "merged") & prs["merged_at"].notna().to_numpy() \
+            & (prs["_merged_at"].to_numpy() < day_millis(date))
+        closed_time = np.where(prs["closed_at"].notna(), prs["_closed_at"], prs["_updated_at"])
+        closed_wall = np.where(prs["closed_at"].notna(), prs["~closed_at"], prs["~updated_at"])
+        closed = (state == "closed") & (closed_time < day_millis(date))
+        # a merged pr is counted twice, once merged and once still open, like pr_open_time
+        days = np.column_stack([
+            np.where(merged, round_diff(prs["~merged_at"].to_numpy() - created, 60 * 60 * 24), np.nan),
+            round_diff(np.where(closed, closed_wall, day_millis(date) * 1000) - created, 60 * 60 * 24)]).ravel()
+        return mean_and_median(days[~np.isnan(days)])
+
+    def code_review_count(self, date, repos_list):
+        window = self.get_window("prs", "pr", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & is_true(frame["pull_request"]))
+        prs = window.slice(date - timedelta(days=90), date)
+        if len(prs) == 0:
+            return None
+        reviews = prs["num_review_comments_without_bot"].dropna()
+        return float(reviews.mean()) if len(reviews) else None
+
+    def closed_pr_count(self, date, repos_list):
+        window = self.get_window("closed_prs", "pr", "closed_at",
+                                 lambda frame: self.exact(frame) & is_true(frame["pull_request"])
+                                 & ~frame["state"].isin(["open", "progressing"]))
+        return window.slice(date - timedelta(days=90), date)["uuid"].nunique()
+
+
+class CodeQualityColumnarMetrics(ColumnarMetrics):
+    contributor_kinds = ["git", "pr_comments"]
+
+    def commit_frequency(self, date, repos_list):
+        window = self.get_window("git_commits", "git", "grimoire_creation_date", self.prefix)
+        commits = window.slice(date - timedelta(days=90), date)
+        commit_frequency_company = 0
+        if self.model.company:
+            commit_frequency_company = commits[commits["author_org_name"] == self.model.company]["hash"].nunique()
+        return commits["hash"].nunique()/12.85, commit_frequency_company/12.85
+
+    def is_maintained(self, date, repos_list):
+        window = self.get_window("git_commits", "git", "grimoire_creation_date", self.prefix)
+        is_maintained_list = []
+        if self.model.level == "repo":
+            for day in pd.date_range(freq='7D', start=date - timedelta(days=90), end=date):
+                is_maintained_list.append(len(window.slice(day - timedelta(days=7), day)) > 0)
+        elif self.model.level in ["project", "community"]:
+            commits = window.slice(date - timedelta(days=30), date)
+            for repo in self.repos_list:
+                is_maintained_list.append(bool(commits["tag"].str.startswith(repo + ".git").any()))
+        try:
+            return is_maintained_list.count(True) / len(is_maintained_list)
+        except ZeroDivisionError:
+            return 0
+
+    def LOC_frequency(self, date, repos_list, field='lines_changed'):
+        window = self.get_window("git_commits", "git", "grimoire_creation_date", self.prefix)
+        return float(window.slice(date - timedelta(days=90), date)[field].sum())/12.85
+
+    def code_review_ratio(self, date, repos_list):
+        all_prs = self.get_window("pr_docs", "pr", "grimoire_creation_date", self.prefix)
+        reviewed_prs = self.get_window("reviewed_prs", "pr", "grimoire_creation_date",
+                                       lambda frame: self.exact(frame) & is_true(frame["pull_request"])
+                                       & (frame["num_review_comments_without_bot"] >= 1))
+        pr_count = all_prs.slice(date - timedelta(days=90), date)["uuid"].nunique()
+        prs = reviewed_prs.slice(date - timedelta(days=90), date)["uuid"].nunique()
+        try:
+            return prs/pr_count
+        except ZeroDivisionError:
+            return None
+
+    def linked_commits(self):
+        '''Hashes listed in commits_data of the PRs of repos_list'''
+        if "linked_commits" not in self.windows:
+            prs = self.get_frame("pr")
+            hashes = set()
+            for commits in prs[self.prefix(prs)]["commits_data"].dropna():
+                hashes.update(commits if isinstance(commits, list) else [commits])
+            self.windows["linked_commits"] = hashes
+        return self.windows["linked_commits"]
+
+    def git_pr_linked_ratio(self, date, repos_list):
+        window = self.get_window("commits_without_merge_pr", "git", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & frame["message"].notna()
+                                 & ~frame["message"].fillna("").str.contains("Merge pull request", regex=False))
+        commit_all_message = window.slice(date - timedelta(days=90), date)["hash"].dropna()
+        linked_commits = self.linked_commits()
+        commit_pr_cout = sum(1 for commit_hash in set(commit_all_message) if commit_hash in linked_commits)
+        if len(commit_all_message) > 0:
+            return len(commit_all_message), commit_pr_cout, commit_pr_cout/len(commit_all_message)
+        else:
+            return 0, None, None
+
+    def code_merge_ratio(self, date, repos_list):
+        window = self.get_window("prs", "pr", "grimoire_creation_date",
+                                 lambda frame: self.prefix(frame) & is_true(frame["pull_request"]))
+        prs = window.slice(date - timedelta(days=90), date)
+        pr_count = prs["uuid"].nunique()
+        merged_by_other = prs["merged_by_data_name"].notna() & prs["author_name"].notna() \
+            & (prs["merged_by_data_name"] != prs["author_name"])
+        try:
+            return prs[merged_by_other]["uuid"].nunique()/pr_count, pr_count
+        except ZeroDivisionError:
+            return None, 0
+
+    def linked_issue_docs(self, kind):
+        '''Docs of kind in repos_list linking an issue of their own repo'''
+        def links_issue(frame):
+            body_links = [isinstance(body, str) and (tag + '/issue') in body
+                          for tag, body in zip(frame["tag"], frame["body"])]
+            return self.exact(frame) & ((frame["linked_issues_count"].fillna(0) >= 1) | pd.Series(body_links, index=frame.index))
+        return self.get_window("linked_issue_" + kind, kind, "grimoire_creation_date", links_issue)
+
+    def pr_issue_linked(self, date, repos_list):
+        docs = pd.concat([self.linked_issue_docs(kind).slice(date - timedelta(days=90), date)
+                          for kind in ["pr", "pr_comments"]])
+        keys = docs["pull_id"].where(docs["pull_id"].notna(), docs["id"]) if "pull_id" in docs else docs["id"]
+        pr_linked_issue = pd.DataFrame({"tag": docs["tag"], "key": keys}).dropna().drop_duplicates().shape[0]
+        try:
+            return pr_linked_issue/self.pr_count(date)
+        except ZeroDivisionError:
+            return None
+
+    def active_C2_contributor_count(self, date, repos_list):
+        window = self.get_window("git_commits", "git", "grimoire_creation_date", self.prefix)
+        return len(self.authors([window], date))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from elasticsearch import helpers
+
+SCAN_SIZE = 5000
+BULK_SIZE = 5000
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def is_bug_issue(source):
+    '''A label or issue type of the issue mentions bug'''
+    return any('bug' in str(value).lower() or '缺陷' in str(value).lower()
+               for value in as_list(source.get("labels")) + as_list(source.get("issue_type")))
+
+
+def is_merged_by_other(source):
+    '''The pull request was merged by someone other than its author'''
+    merged_by = as_list(source.get("merged_by_data_name"))
+    author = as_list(source.get("author_name"))
+    return bool(merged_by and author and merged_by[0] != author[0])
+
+
+def is_merge_commit(source):
+    '''The commit message is the one of a merged pull request'''
+    message = as_list(source.get("message"))
+    return bool(message and 'Merge pull request' in str(message[0]))
+
+
+# Derived boolean field: (_source fields it is computed from, function computing it)
+DERIVED_FIELDS = {
+    "is_bug_issue": (["labels", "issue_type"], is_bug_issue),
+    "merged_by_other": (["merged_by_data_name", "author_name"], is_merged_by_other),
+    "is_merge_commit": (["message"], is_merge_commit),
+}
+
+
+def get_derived_filter(field, field_filter, script_filter):
+    '''Query matching docs on the derived field, and on script_filter for docs
+    enriched before the field was added'''
+    return {
+        "bool": {
+            "should": [
+                field_filter,
+                {"bool": {"must_not": [{"exists": {"field": field}}], "must": [script_filter]}}
+            ],
+            "minimum_should_match": 1
+        }
+    }
+
+
+def enrich_derived_field(es_client, index, field):
+    '''Set field on the docs of index that do not have it yet, the number of docs updated.
+    The first call backfills the whole index, later calls only see new or re-enriched docs.'''
+    source_fields, compute = DERIVED_FIELDS[field]
+    es_client.indices.put_mapping(index=index, body={"properties": {field: {"type": "boolean"}}})
+    query = {
+        "query": {"bool": {"must_not": [{"exists": {"field": field}}]}},
+        "_source": source_fields
+    }
+    actions = ({
+        "_op_type": "update",
+        "_index": hit["_index"],
+        "_id": hit["_id"],
+        "doc": {field: compute(hit["_source"])}
+    } for hit in helpers.scan(es_client, query=query, index=index, size=SCAN_SIZE))
+    updated, errors = helpers.bulk(es_client, actions, chunk_size=BULK_SIZE, raise_on_error=False)
+    es_client.indices.refresh(index=index)
+    return updated
+
+
+def enrich_derived_fields(es_client, field_indexes):
+    '''Run enrich_derived_field for every {field: index}'''
+    for field, index in field_indexes.items():
+        updated = enrich_derived_field(es_client, index, field)
+        print("{} {}: {} docs updated".format(index, field, updated))
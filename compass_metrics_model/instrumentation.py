@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Tag of the searches sent outside of any tagged block
+UNTAGGED = "(untagged)"
+PROMETHEUS_PREFIX = "compass_metrics_model_search"
+
+# Tag of the searches of each thread, set by query_tag
+local_tags = threading.local()
+
+
+def get_query_tag():
+    '''Tag of the searches sent by the current thread'''
+    return getattr(local_tags, "tag", None) or UNTAGGED
+
+
+@contextmanager
+def query_tag(tag):
+    '''Tag the searches the current thread sends in the block with tag. An enclosing
+    tag is kept, the searches of a metric called by another one count for the outer one.'''
+    outer = getattr(local_tags, "tag", None)
+    if outer is None:
+        local_tags.tag = tag
+    try:
+        yield
+    finally:
+        local_tags.tag = outer
+
+
+def get_hits(response):
+    '''(total hits, returned hits) of a search response'''
+    hits = response.get("hits") or {}
+    total = hits.get("total", 0)
+    if isinstance(total, dict):
+        total = total.get("value", 0)
+    return total or 0, len(hits.get("hits") or [])
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class QueryStats:
+    def __init__(self, json_file=None, prometheus_file=None, buckets=LATENCY_BUCKETS):
+        """Requests, latency histogram, response bytes, took and hits of the searches of a
+        run by tag, the metric or phase of the run that sent them.
+        :param json_file: file the JSON summary is written to. None to print it.
+        :param prometheus_file: file the stats are also written to in Prometheus text format.
+        :param buckets: upper bounds in seconds of the latency histogram buckets.
+        """
+        self.json_file = json_file
+        self.prometheus_file = prometheus_file
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.tags = {}
+
+    def __getstate__(self):
+        '''Worker processes get the settings and an empty set of stats'''
+        state = self.__dict__.copy()
+        state.pop("lock")
+        state["tags"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def new_stats(self):
+        return {"requests": 0, "errors": 0, "latency_sum": 0.0, "latency_max": 0.0,
+                "latency_buckets": [0] * (len(self.buckets) + 1), "response_bytes": 0,
+                "took_ms": 0, "hits": 0, "returned_hits": 0}
+
+    def record(self, tag, latency, responses=(), error=False):
+        '''Count one request of tag answered in latency seconds with responses, the
+        search responses it carried'''
+        response_bytes = took = hits = returned_hits = 0
+        for response in responses:
+            # the client hands out the decoded body, its size is the size of the json
+            response_bytes += len(json.dumps(response, separators=(",", ":")))
+            took += response.get("took", 0)
+            total, returned = get_hits(response)
+            hits += total
+            returned_hits += returned
+        bucket = next((i for i, bound in enumerate(self.buckets) if latency <= bound), len(self.buckets))
+        with self.lock:
+            stats = self.tags.get(tag)
+            if stats is None:
+                stats = self.tags[tag] = self.new_stats()
+            stats["requests"] += 1
+            stats["errors"] += int(error)
+            stats["latency_sum"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+            stats["latency_buckets"][bucket] += 1
+            stats["response_bytes"] += response_bytes
+            stats["took_ms"] += took
+            stats["hits"] += hits
+            stats["returned_hits"] += returned_hits
+
+    def pop(self):
+        '''Stats recorded so far by tag, the collector starts over'''
+        with self.lock:
+            tags, self.tags = self.tags, {}
+        return tags
+
+    def merge(self, tags):
+        '''Add the stats by tag popped from another collector with the same buckets'''
+        with self.lock:
+            for tag, other in tags.items():
+                stats = self.tags.get(tag)
+                if stats is None:
+                    stats = self.tags[tag] = self.new_stats()
+                for field, value in other.items():
+                    if field == "latency_max":
+                        stats[field] = max(stats[field], value)
+                    elif field == "latency_buckets":
+                        stats[field] = [a + b for a, b in zip(stats[field], value)]
+                    else:
+                        stats[field] += value
+
+    def get_summary(self):
+        '''Totals and stats by tag, the tags with the most search time first. The latency
+        histogram is cumulative, each bucket counting the requests up to its bound.'''
+        with self.lock:
+            tags = {tag: dict(stats, latency_buckets=list(stats["latency_buckets"]))
+                    for tag, stats in self.tags.items()}
+        summary = {"requests": 0, "errors": 0, "latency_sum": 0.0, "response_bytes": 0, "took_ms": 0, "tags": {}}
+        for tag, stats in sorted(tags.items(), key=lambda item: -item[1]["latency_sum"]):
+            for field in ("requests", "errors", "latency_sum", "response_bytes", "took_ms"):
+                summary[field] += stats[field]
+            histogram = {}
+            count = 0
+            for bound, n in zip([str(bound) for bound in self.buckets] + ["+Inf"], stats["latency_buckets"]):
+                count += n
+                histogram[bound] = count
+            stats["latency_buckets"] = histogram
+            stats["latency_avg"] = stats["latency_sum"] / stats["requests"] if stats["requests"] else None
+            summary["tags"][tag] = stats
+        return summary
+
+    def to_prometheus(self, summary=None):
+        '''Stats in Prometheus text exposition format, labelled by tag'''
+        summary = self.get_summary() if summary is None else summary
+        counters = [("requests_total", "requests", "Search requests sent to Elasticsearch."),
+                    ("errors_total", "errors", "Search requests that raised an error."),
+                    ("response_bytes_total", "response_bytes", "Bytes of the json of the search responses."),
+                    ("took_milliseconds_total", "took_ms", "Sum of the took of the search responses."),
+                    ("hits_total", "hits", "Total hits of the search responses."),
+                    ("returned_hits_total", "returned_hits", "Hits returned in the search responses.")]
+        lines = []
+        for suffix, field, help_text in counters:
+            name = "{}_{}".format(PROMETHEUS_PREFIX, suffix)
+            lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} counter".format(name)]
+            for tag, stats in summary["tags"].items():
+                lines.append('{}{{tag="{}"}} {}'.format(name, escape_label(tag), stats[field]))
+        name = "{}_duration_seconds".format(PROMETHEUS_PREFIX)
+        lines += ["# HELP {} Latency of the search requests.".format(name), "# TYPE {} histogram".format(name)]
+        for tag, stats in summary["tags"].items():
+            label = escape_label(tag)
+            for bound, count in stats["latency_buckets"].items():
+                lines.append('{}_bucket{{tag="{}",le="{}"}} {}'.format(name, label, bound, count))
+            lines.append('{}_sum{{tag="{}"}} {}'.format(name, label, stats["latency_sum"]))
+            lines.append('{}_count{{tag="{}"}} {}'.format(name, label, stats["requests"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        '''Print or write the JSON summary, and the Prometheus file if set'''
+        summary = self.get_summary()
+        if self.json_file:
+            with open(self.json_file, "w") as f:
+                json.dump(summary, f, indent=2)
+        else:
+            print(json.dumps(summary, indent=2))
+        if self.prometheus_file:
+            with open(self.prometheus_file, "w") as f:
+                f.write(self.to_prometheus(summary))
+        return summary
+
+
+class InstrumentedSearch:
+    def __init__(self, es_client, query_stats):
+        """Stand-in for es_in recording every search, scroll and _msearch it sends in
+        query_stats, under the tag of the sending thread. Searches answered by a query
+        cache behind it are recorded too, with the took of the cached response.
+        :param es_client: client the requests are sent with.
+        :param query_stats: QueryStats the requests are recorded in.
+        """
+        self.es_client = es_client
+        self.query_stats = query_stats
+
+    def __getattr__(self, name):
+        if name in ("es_client", "query_stats"):
+            raise AttributeError(name)
+        return getattr(self.es_client, name)
+
+    def send(self, method, *args, **kwargs):
+        tag = get_query_tag()
+        start = time.perf_counter()
+        try:
+            response = method(*args, **kwargs)
+        except Exception:
+            self.query_stats.record(tag, time.perf_counter() - start, error=True)
+            raise
+        latency = time.perf_counter() - start
+        self.query_stats.record(tag, latency, response.get("responses", [response]))
+        return response
+
+    def search(self, index=None, body=None, **kwargs):
+        return self.send(self.es_client.search, index=index, body=body, **kwargs)
+
+    def scroll(self, *args, **kwargs):
+        return self.send(self.es_client.scroll, *args, **kwargs)
+
+    def msearch(self, body, index=None, **kwargs):
+        return self.send(self.es_client.msearch, body=body, index=index, **kwargs)
+
+
+class TaggedMetrics:
+    def __init__(self, metrics):
+        """Metrics source tagging the searches of every method called on it with the
+        name of the method.
+        :param metrics: metrics source of the model, see get_metrics_source.
+        """
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        if name == "metrics":
+            raise AttributeError(name)
+        value = getattr(self.metrics, name)
+        if name.startswith("_") or not callable(value):
+            return value
+
+        def tagged(*args, **kwargs):
+            with query_tag(name):
+                return value(*args, **kwargs)
+        return tagged
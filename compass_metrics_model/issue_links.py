@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from datetime import timedelta
+import numpy as np
+from elasticsearch import helpers
+from grimoirelab_toolkit.datetime import datetime_to_utc, str_to_datetime
+from .backfill import day_millis
+from .repo_filter import get_repos_should
+
+SCAN_SIZE = 5000
+
+
+class LinkedIssuePrs:
+    def __init__(self, repos_list):
+        """PRs linking an issue of their own repo, by repo and day. Built from one scan
+        of the PR and PR comment docs of the label, so pr_issue_linked needs no
+        painless body script per repo and date.
+        :param repos_list: repos of the label being enriched.
+        """
+        self.repos_list = repos_list
+        self.days = {}
+        self.keys = {}
+
+    def load(self, es_in, indexes, from_date, to_date, repos_should=get_repos_should):
+        '''Scan the docs of repos_list created in [from_date, to_date) and keep the linking ones,
+        repos_should(repos_list, pattern, field) building the repo clauses'''
+        query = {
+            "query": {
+                "bool": {
+                    "should": repos_should(self.repos_list, "{}", "tag"),
+                    "minimum_should_match": 1,
+                    "filter": {"range": {"grimoire_creation_date": {
+                        "gte": from_date.strftime("%Y-%m-%d"), "lt": to_date.strftime("%Y-%m-%d")}}}
+                }
+            },
+            "_source": ["tag", "grimoire_creation_date", "linked_issues_count", "body", "pull_id", "id"]
+        }
+        links = {repo: [] for repo in self.repos_list}
+        for hit in helpers.scan(es_in, query=query, index=indexes, size=SCAN_SIZE):
+            source = hit["_source"]
+            if source.get("tag") not in links:
+                continue
+            body = source.get("body")
+            if (source.get("linked_issues_count") or 0) >= 1 or \
+                    (isinstance(body, str) and source["tag"] + "/issue" in body):
+                key = source["pull_id"] if source.get("pull_id") is not None else source.get("id")
+                if key is not None:
+                    links[source["tag"]].append((day_millis(datetime_to_utc(str_to_datetime(source["grimoire_creation_date"]))), key))
+        for repo, repo_links in links.items():
+            repo_links.sort(key=lambda link: link[0])
+            self.days[repo] = np.array([link[0] for link in repo_links], dtype=np.int64)
+            self.keys[repo] = [link[1] for link in repo_links]
+        return self
+
+    def count(self, date, days=90):
+        '''Sum over the repos of the distinct linking PRs created in [date - days, date)'''
+        total = 0
+        for repo in self.repos_list:
+            start = np.searchsorted(self.days[repo], day_millis(date - timedelta(days=days)), "left")
+            end = np.searchsorted(self.days[repo], day_millis(date), "left")
+            total += len(set(self.keys[repo][start:end]))
+        return total
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import bisect
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from grimoirelab_toolkit.datetime import datetime_utcnow, str_to_datetime
+from perceval.backend import uuid
+from .backfill import day_millis
+
+# Buckets of each page of the lifecycle aggregation, below search.max_buckets
+COMPOSITE_SIZE = 10000
+BULK_SIZE = 500
+
+
+def get_lifecycle_query(tags, enriched_after=None, after=None):
+    '''Page of the first commit, last commit and last update of every (git tag, update day)'''
+    query = {
+        "size": 0,
+        "query": {
+            "bool": {
+                "filter": [{"terms": {"tag": tags}}]
+            }
+        },
+        "aggs": {
+            "days": {
+                "composite": {
+                    "size": COMPOSITE_SIZE,
+                    "sources": [
+                        {"tag": {"terms": {"field": "tag"}}},
+                        {"day": {"date_histogram": {"field": "metadata__updated_on", "calendar_interval": "day",
+                                                    "missing_bucket": True}}}
+                    ]
+                },
+                "aggs": {
+                    "first_commit": {"min": {"field": "grimoire_creation_date"}},
+                    "last_commit": {"max": {"field": "grimoire_creation_date"}},
+                    "last_update": {"max": {"field": "metadata__updated_on"}},
+                    "enriched_until": {"max": {"field": "metadata__enriched_on"}}
+                }
+            }
+        }
+    }
+    if enriched_after:
+        query["query"]["bool"]["filter"].append({"range": {"metadata__enriched_on": {"gt": enriched_after}}})
+    if after:
+        query["aggs"]["days"]["composite"]["after"] = after
+    return query
+
+
+def metric_value(bucket, name):
+    return bucket[name].get("value_as_string")
+
+
+def earlier(a, b):
+    '''Earlier of two date strings, either may be None'''
+    if a is None or b is None:
+        return a or b
+    return a if str_to_datetime(a) <= str_to_datetime(b) else b
+
+
+def later(a, b):
+    if a is None or b is None:
+        return a or b
+    return a if str_to_datetime(a) >= str_to_datetime(b) else b
+
+
+class RepoLifecycle:
+    def __init__(self, git_index, lifecycle_index=None):
+        """First commit, last commit and update history of the repos, read from git_index
+        with one paged aggregation. The last update is kept for every day with updates, so
+        updated_since can be answered for any date of date_list.
+        :param git_index: enriched git index.
+        :param lifecycle_index: index the lifecycle of the repos is stored in and
+            incrementally updated from. None to recompute it on every run.
+        """
+        self.git_index = git_index
+        self.lifecycle_index = lifecycle_index
+        self.repos = {}
+
+    def refresh(self, es_client, repos_list):
+        '''Load the lifecycle of repos_list, aggregating only the commits enriched since it
+        was stored. The commits are aggregated and the stored lifecycle read and written with
+        es_client, never a cache, so new commits and updates are always seen.'''
+        tags = [repo + ".git" for repo in repos_list]
+        if self.lifecycle_index:
+            for item in self.read_stored(es_client, tags):
+                self.repos[item["tag"]] = item
+        stored = [self.repos.get(tag) for tag in tags]
+        enriched_after = None
+        if all(stored):
+            enriched_after = min(item["enriched_until"] or "1970-01-01" for item in stored)
+        tag_days = {}
+        after = None
+        while True:
+            days = es_client.search(index=self.git_index, body=get_lifecycle_query(tags, enriched_after, after))[
+                "aggregations"]["days"]
+            for bucket in days["buckets"]:
+                tag_days.setdefault(bucket["key"]["tag"], []).append(bucket)
+            after = days.get("after_key")
+            if not days["buckets"] or after is None:
+                break
+        items = [self.merge(tag, buckets) for tag, buckets in tag_days.items()]
+        if self.lifecycle_index and items:
+            self.store(es_client, items)
+
+    def read_stored(self, es_client, tags):
+        query = {"size": len(tags), "query": {"bool": {"filter": [{"terms": {"tag": tags}}]}}}
+        try:
+            hits = es_client.search(index=self.lifecycle_index, body=query)["hits"]["hits"]
+        except NotFoundError:
+            return []
+        return [hit["_source"] for hit in hits]
+
+    def store(self, es_client, items):
+        if not es_client.indices.exists(index=self.lifecycle_index):
+            es_client.indices.create(index=self.lifecycle_index, body={"mappings": {"properties": {
+                "tag": {"type": "keyword"}, "update_days": {"type": "object", "enabled": False}}}})
+        actions = ({"_index": self.lifecycle_index, "_id": item["uuid"], "_source": item} for item in items)
+        helpers.bulk(es_client, actions, chunk_size=BULK_SIZE)
+        es_client.indices.refresh(index=self.lifecycle_index)
+
+    def merge(self, tag, buckets):
+        '''Merge the (tag, update day) buckets of one tag into its lifecycle, the changed item'''
+        item = self.repos.get(tag) or {
+            "uuid": uuid(tag), "tag": tag, "first_commit_date": None, "last_commit_date": None,
+            "last_updated_on": None, "update_days": [], "enriched_until": None}
+        update_days = dict(item["update_days"])
+        for bucket in buckets:
+            item["first_commit_date"] = earlier(item["first_commit_date"], metric_value(bucket, "first_commit"))
+            item["last_commit_date"] = later(item["last_commit_date"], metric_value(bucket, "last_commit"))
+            item["enriched_until"] = later(item["enriched_until"], metric_value(bucket, "enriched_until"))
+            day = bucket["key"]["day"]
+            if day is not None:
+                update_days[day] = later(update_days.get(day), metric_value(bucket, "last_update"))
+        item["update_days"] = sorted(update_days.items())
+        if item["update_days"]:
+            item["last_updated_on"] = item["update_days"][-1][1]
+        item["metadata__enriched_on"] = datetime_utcnow().isoformat()
+        self.repos[tag] = item
+        return item
+
+    def get_first_commit(self, repo, date):
+        '''grimoire_creation_date of the first commit of repo before date, None if there is none'''
+        item = self.repos.get(repo + ".git")
+        if item is None or item["first_commit_date"] is None:
+            return None
+        if str_to_datetime(item["first_commit_date"]) >= date:
+            return None
+        return item["first_commit_date"]
+
+    def get_last_update(self, repo, date):
+        '''Newest metadata__updated_on of repo before date, None if there is none'''
+        item = self.repos.get(repo + ".git")
+        if item is None:
+            return None
+        days = [day for day, last_update in item["update_days"]]
+        position = bisect.bisect_left(days, day_millis(date))
+        if position == 0:
+            return None
+        return item["update_days"][position - 1][1]
+
+    def get_dates(self, date_list, repos_list, delay):
+        '''Dates of date_list at which some repo had a commit more than delay before'''
+        first_commits = [str_to_datetime(self.repos[repo + ".git"]["first_commit_date"]) for repo in repos_list
+                         if self.repos.get(repo + ".git", {}).get("first_commit_date")]
+        if not first_commits:
+            return []
+        return [date for date in date_list if min(first_commits) < date - delay]
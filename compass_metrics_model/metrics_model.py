@@ -26,6 +26,7 @@ from urllib.parse import urlparse
 import json
 import yaml
 import pandas as pd
+import numpy as np
 import ssl
 import certifi
 import re
@@ -42,7 +43,39 @@ from .utils import (get_activity_score,
                     code_quality_guarantee, 
                     community_decay,
                     activity_decay,
-                    code_quality_decay)
+                    code_quality_decay,
+                    get_activity_scores,
+                    community_support_scores,
+                    code_quality_guarantee_scores)
+from .backfill import (day_millis,
+                       HistogramBackfill,
+                       ActivityHistogramBackfill,
+                       CommunitySupportHistogramBackfill,
+                       CodeQualityHistogramBackfill)
+from .columnar import (ColumnarMetrics,
+                       ActivityColumnarMetrics,
+                       CommunitySupportColumnarMetrics,
+                       CodeQualityColumnarMetrics)
+from .msearch import msearch_metrics_data
+from .query_cache import CachedSearch, get_query_cache
+from .instrumentation import QueryStats, InstrumentedSearch, TaggedMetrics, query_tag
+from .cassette import (CountingWriter, record_client, get_cassette_replay, get_replay_client,
+                       close_cassette_recorder)
+from .lifecycle import RepoLifecycle
+from .pr_linkage import CommitPrLinkage
+from .issue_links import LinkedIssuePrs
+from .derived_fields import enrich_derived_fields, get_derived_filter
+from .open_time import (ISSUE_OPEN_TIME_SCRIPT,
+                        BUG_ISSUE_OPEN_TIME_SCRIPT,
+                        PR_OPEN_TIME_SCRIPT,
+                        get_open_time_query,
+                        get_open_time)
+from .async_engine import async_metrics_data
+from .bulk_writer import BulkWriter
+from .release_ingest import ReleaseIngester
+from .sketches import SketchStore, SketchRollupMetrics, has_prefix_overlap
+from .repo_filter import RepoSetFilter, get_repos_should
+from .process_pool import process_pool_enrich
 import os
 import inspect
 import sys
@@ -52,6 +85,8 @@ os.chdir(current_dir)
 sys.path.append('../')
 
 MAX_BULK_UPDATE_SIZE = 10
+COMPOSITE_SIZE = 10000
+RESCORE_BULK_SIZE = 5000
 
 
 def get_date_list(begin_date, end_date, freq='W-MON'):
@@ -73,55 +108,23 @@ def get_all_repo(file, source):
             all_repo.append(j)
     return all_repo
 
-def newest_message(repo_url):
-    query = {
-        "query": {
-            "match": {
-                "tag": repo_url
-            }
-        },
-        "sort":[
-            {
-                "metadata__updated_on": { "order": "desc" }
-            }
-        ]
-    }
-    return query
-
-def add_release_message(es_client, out_index, repo_url, releases,):
-    item_datas = []
-    for item in releases:
-        release_data = {
-            "_index": out_index,
-            "_id": uuid(str(item["id"])),
-            "_source": {
-                "uuid": uuid(str(item["id"])),
-                "id": item["id"],
-                "tag": repo_url,
-                "tag_name": item["tag_name"],
-                "target_commitish": item["target_commitish"],
-                "prerelease": item["prerelease"],
-                "name": item["name"],
-                "body": item["body"],
-                "author_login": item["author"]["login"],
-                "author_name": item["author"]["name"],
-                "grimoire_creation_date": item["created_at"]
-            }
-        }
-        item_datas.append(release_data)
-        if len(item_datas) > MAX_BULK_UPDATE_SIZE:
-            helpers.bulk(client=es_client, actions=item_datas)
-            item_datas = []
-    helpers.bulk(client=es_client, actions=item_datas)
-    item_datas = []
-
-def create_release_index(es_client, all_repo, repo_index, release_index):
-    for repo_url in all_repo:
-        query = newest_message(repo_url)
-        query_hits = es_client.search(index=repo_index, body=query)["hits"]["hits"]
-        if len(query_hits) > 0 and query_hits[0]["_source"].get("releases"):
-            items = query_hits[0]["_source"]["releases"]
-            add_release_message(es_client, release_index, repo_url, items)
+
+def run_cleanups(cleanups, failed=False):
+    '''Call every cleanup of a run even if one raises. The first error is raised once they
+    are all called, unless failed: the error of the run is propagating then and the cleanup
+    errors are printed instead of replacing it.'''
+    error = None
+    for cleanup in cleanups:
+        try:
+            cleanup()
+        except Exception as e:
+            if failed or error is not None:
+                print("cleanup failed: {!r}".format(e))
+            else:
+                error = e
+    if error is not None:
+        raise error
+
 
 def get_all_project(file):
     '''Get all projects from json file'''
@@ -163,56 +166,375 @@ def get_medium(L):
 
 
 class MetricsModel:
-    def __init__(self, json_file, from_date, end_date, out_index=None, community=None, level=None):
+    backfill_class = HistogramBackfill
+    columnar_class = ColumnarMetrics
+    score_field = None
+    # get_metrics_data needs a commit this long before the date
+    created_since_delay = timedelta(days=0)
+    # Derived boolean fields read by the model: {field: attribute naming its index}
+    derived_field_indexes = {}
+    # Attributes naming the indexes the repo + "*" patterns of repo_filter are resolved against
+    tag_indexes = ("issue_index", "pr_index", "git_index", "issue_comments_index", "pr_comments_index")
+    # Metrics other models compute the same way, computed once per label and date by
+    # MultiModelRunner: {metric: attributes naming the indexes it reads}
+    shared_metrics = {}
+
+    def __init__(self, json_file, from_date, end_date, out_index=None, community=None, level=None, backfill=False, msearch_dates=None, async_concurrency=None, processes=None, chunk_dates=None, columnar=False, query_cache=None, lifecycle=None, derived_fields=False, incremental=False, bulk_writer=None, repo_filter=False, query_stats=None, record_cassette=None, replay_cassette=None):
         """Metrics Model is designed for the integration of multiple CHAOSS metrics.
         :param json_file: the path of json file containing repository message. 
         :param out_index: target index for Metrics Model.
         :param community: used to mark the repo belongs to which community.
         :param level: str representation of the metrics, choose from repo, project, community.
+        :param backfill: answer window metrics from one date_histogram query per metric
+            instead of one query per metric per date.
+        :param msearch_dates: number of dates computed together, their searches are sent
+            as _msearch requests. None to send every search on its own.
+        :param async_concurrency: evaluate dates concurrently on AsyncElasticsearch with
+            at most this number of searches in flight. None to evaluate them one by one.
+        :param processes: number of worker processes for level repo. None to enrich the
+            repos one after another in this process.
+        :param chunk_dates: number of dates in each work unit sent to a worker process.
+        :param columnar: pull the docs of the repos once and compute every date in memory
+            instead of querying Elasticsearch per metric.
+        :param query_cache: answer repeated searches from a cache shared by the models of
+            the process, True for the default settings or a dict of get_query_cache arguments
+            (max_entries, cache_dir, max_disk_bytes, ttl). None to send every search.
+        :param lifecycle: answer created_since and updated_since from one aggregation of
+            the git index per label and skip the dates before the first commit. True to
+            aggregate on every run, or the name of the index the lifecycle is stored in
+            and incrementally updated from.
+        :param derived_fields: set the derived boolean fields of the model on the docs
+            missing them before enriching, and filter on them instead of painless scripts.
+        :param incremental: only compute the dates after the newest row of each label
+            already in out_index, the decay state is restored from the stored rows.
+        :param bulk_writer: write out_index from a background thread while the next dates
+            are computed, True for the default settings or a dict of BulkWriter arguments
+            (max_docs, max_bytes, max_interval, queue_size, max_retries).
+        :param repo_filter: match the repos with one terms filter on their exact tags instead
+            of one wildcard simple_query_string per repo. True to inline the tags, or the name
+            of the index large tag sets are stored in and referenced by terms lookup.
+        :param query_stats: record the requests, latency, response bytes, took and hits of
+            the searches of each metric and print a JSON summary at the end of the run. True,
+            or a dict of QueryStats arguments (json_file, prometheus_file, buckets).
+        :param record_cassette: path of a gzipped cassette the requests of the Elasticsearch
+            clients of the run are recorded to, with their responses and latencies.
+        :param replay_cassette: answer the requests from a cassette instead of a cluster and
+            count the rows instead of writing them. The path of the cassette, or a dict of
+            CassetteReplay arguments (path, latency).
         """
+        if (record_cassette or replay_cassette) and async_concurrency:
+            raise ValueError("cassettes are not supported with async_concurrency")
+        if record_cassette and processes:
+            raise ValueError("record_cassette is not supported with processes")
         self.json_file = json_file
         self.out_index = out_index
         self.community = community
         self.level = level
+        self.backfill = backfill
+        self.msearch_dates = msearch_dates
+        self.async_concurrency = async_concurrency
+        self.processes = processes
+        self.chunk_dates = chunk_dates
+        self.columnar = columnar
+        self.query_cache = query_cache
+        self.lifecycle = lifecycle
+        self.derived_fields = derived_fields
+        self.incremental = incremental
+        self.bulk_writer = bulk_writer
+        self.repo_set_filter = None
+        if repo_filter:
+            self.repo_set_filter = RepoSetFilter(repo_filter if isinstance(repo_filter, str) else None)
+        self.search_stats = None
+        if query_stats:
+            self.search_stats = QueryStats(**(query_stats if isinstance(query_stats, dict) else {}))
+        self.record_cassette = record_cassette
+        self.replay_cassette = replay_cassette
+        self.high_water_marks = {}
+        self.es_client = None
         self.date_list = get_date_list(from_date, end_date)
 
     def metrics_model_metrics(self, elastic_url):
+        self.elastic_url = elastic_url
+        self.es_in = self.get_es_in(elastic_url)
+        self.es_out = self.get_es_out(elastic_url)
+        try:
+            self.prepare_run()
+            if self.derived_fields:
+                with query_tag("derived_fields"):
+                    enrich_derived_fields(self.es_in, {field: getattr(self, index)
+                                                       for field, index in self.derived_field_indexes.items()})
+
+            repos_labels = self.get_repos_labels()
+            if self.level == "repo" and self.processes:
+                process_pool_enrich(self, repos_labels, self.processes, self.chunk_dates)
+            else:
+                for repos_list, label in repos_labels:
+                    self.metrics_model_enrich(repos_list, label)
+        except BaseException:
+            run_cleanups(self.get_run_cleanups(), failed=True)
+            raise
+        run_cleanups(self.get_run_cleanups())
+
+    def get_run_cleanups(self):
+        '''Steps closing what a run opened: the bulk writer, the search stats and the cassette'''
+        cleanups = []
+        if self.bulk_writer:
+            cleanups.append(self.es_out.close)
+        if self.search_stats:
+            cleanups.append(self.search_stats.write)
+        if self.record_cassette:
+            cleanups.append(lambda: close_cassette_recorder(self.record_cassette))
+        return cleanups
+
+    def get_repos_labels(self):
+        '''(repos_list, label) of every label of the level, from json_file'''
+        if self.level == "community":
+            return [(self.all_repo, self.community)]
+        repos_labels = []
+        all_repo_json = json.load(open(self.json_file))
+        origin = 'gitee' if 'gitee' in self.issue_index else 'github'
+        for project in all_repo_json:
+            if self.level == "project":
+                repos_labels.append((list(all_repo_json[project][origin]), project))
+            if self.level == "repo":
+                for j in all_repo_json[project][origin]:
+                    repos_labels.append(([j], j))
+        return repos_labels
+
+    def metrics_model_rescore(self, elastic_url):
+        '''Recompute score_field of the rows of the model in out_index with the current
+        weights and thresholds of utils, replaying the decay of each label from its first
+        row. Only the scores that changed are updated, the source indexes are not read.'''
+        es_client = self.get_es_client(elastic_url)
+        label_hits = {}
+        for hit in self.scan_metrics_data(es_client):
+            label_hits.setdefault(hit["_source"]["label"], []).append(hit)
+        updated, errors = helpers.bulk(es_client, self.iter_rescore_actions(label_hits),
+                                       chunk_size=RESCORE_BULK_SIZE, raise_on_error=False)
+        es_client.indices.refresh(index=self.out_index)
+        print("{} {}: {} scores updated, {} errors".format(self.out_index, self.model_name, updated, len(errors)))
+        return updated
+
+    def iter_rescore_actions(self, label_hits):
+        for label, hits in label_hits.items():
+            hits.sort(key=lambda hit: pd.Timestamp(hit["_source"]["grimoire_creation_date"]))
+            scores = self.get_scores([hit["_source"] for hit in hits], {})
+            for hit, score in zip(hits, scores):
+                if hit["_source"].get(self.score_field) != score:
+                    yield {
+                        "_op_type": "update",
+                        "_index": hit["_index"],
+                        "_id": hit["_id"],
+                        "doc": {self.score_field: score}
+                    }
+
+    def get_es_client(self, elastic_url):
+        if self.replay_cassette:
+            return get_replay_client(**self.get_replay_settings())
         is_https = urlparse(elastic_url).scheme == 'https'
-        self.es_in = Elasticsearch(
+        es_client = Elasticsearch(
             elastic_url, use_ssl=is_https, verify_certs=False, connection_class=RequestsHttpConnection)
-        self.es_out = ElasticSearch(elastic_url, self.out_index)
+        if self.record_cassette:
+            return record_client(es_client, self.record_cassette)
+        return es_client
+
+    def get_es_in(self, elastic_url):
+        return self.wrap_search_client(self.get_es_client(elastic_url))
+
+    def wrap_search_client(self, es_client):
+        '''es_client behind the query cache and the query stats of the model, if set'''
+        if self.query_cache:
+            es_client = self.get_cached_search(es_client)
+        if self.search_stats:
+            es_client = InstrumentedSearch(es_client, self.search_stats)
+        return es_client
+
+    def get_replay_settings(self):
+        '''path and latency of replay_cassette'''
+        return self.replay_cassette if isinstance(self.replay_cassette, dict) else {"path": self.replay_cassette}
+
+    def get_es_out(self, elastic_url):
+        '''Writer of out_index, queueing the rows to a BulkWriter if bulk_writer is set'''
+        if self.replay_cassette:
+            return CountingWriter(self.out_index)
+        if self.bulk_writer:
+            settings = self.bulk_writer if isinstance(self.bulk_writer, dict) else {}
+            return BulkWriter(self.get_es_client(elastic_url), self.out_index, **settings)
+        return ElasticSearch(elastic_url, self.out_index)
+
+    def get_cached_search(self, es_client):
+        '''es_client answering repeated searches from the query cache of the process'''
+        settings = self.query_cache if isinstance(self.query_cache, dict) else {}
+        return CachedSearch(es_client, get_query_cache(**settings), self.elastic_url)
+
+    def __getstate__(self):
+        '''Clients are left out when the model is sent to worker processes'''
+        state = self.__dict__.copy()
+        state.pop("es_in", None)
+        state.pop("es_out", None)
+        state.pop("es_client", None)
+        return state
 
-        if self.level == "community":
-            all_repos_list = self.all_repo
-            label = "community"
-            self.metrics_model_enrich(all_repos_list, self.community)
-        if self.level == "project":
-            all_repo_json = json.load(open(self.json_file))
-            for project in all_repo_json:
-                repos_list = []
-                origin = 'gitee' if 'gitee' in self.issue_index else 'github'
-                for j in all_repo_json[project][origin]:
-                    repos_list.append(j)
-                self.metrics_model_enrich(repos_list, project)
-        if self.level == "repo":
-            all_repo_json = json.load(open(self.json_file))
-            for project in all_repo_json:
-                origin = 'gitee' if 'gitee' in self.issue_index else 'github'
-                for j in all_repo_json[project][origin]:
-                    self.metrics_model_enrich([j], j)
+    def metrics_model_enrich(self, repos_list, label):
+        last_metrics_data = self.restore_metrics_data(label)
+        with query_tag("prepare_enrich"):
+            self.prepare_enrich(repos_list)
+        with query_tag("get_metrics_source"):
+            metrics = self.get_metrics_source(repos_list)
+        self.write_metrics_data(self.iter_metrics_data(metrics, repos_list, label), last_metrics_data)
+        self.finish_enrich(repos_list)
+
+    def restore_metrics_data(self, label):
+        '''last_metrics_data after the rows of label already stored in out_index, empty
+        unless incremental. get_enrich_dates then skips the dates up to the newest row.'''
+        last_metrics_data = {}
+        self.high_water_marks.pop(label, None)
+        if not self.incremental or not self.date_list:
+            return last_metrics_data
+        # stored rows are read from the cluster, never from the query cache
+        rows = [hit["_source"] for hit in self.scan_metrics_data(
+            self.get_run_client(), label, self.date_list[0])]
+        rows.sort(key=lambda row: pd.Timestamp(row["grimoire_creation_date"]))
+        for row in rows:
+            self.cache_last_metrics_data(row, last_metrics_data)
+        if rows:
+            self.high_water_marks[label] = pd.Timestamp(rows[-1]["grimoire_creation_date"])
+            print("{}: resuming after {}".format(label, rows[-1]["grimoire_creation_date"]))
+        return last_metrics_data
+
+    def scan_metrics_data(self, es_client, label=None, from_date=None):
+        '''Hits of the rows of the model in out_index, of label and from from_date if given'''
+        must = [{"match_phrase": {"model_name": self.model_name}}, {"match_phrase": {"level": self.level}}]
+        if label is not None:
+            must.append({"match_phrase": {"label": label}})
+        query = {"query": {"bool": {"must": must}}}
+        if from_date is not None:
+            query["query"]["bool"]["filter"] = {"range": {"grimoire_creation_date": {"gte": from_date.isoformat()}}}
+        try:
+            for hit in helpers.scan(es_client, query=query, index=self.out_index):
+                row = hit["_source"]
+                # match_phrase also matches labels and names containing the given ones
+                if label is not None and row["label"] != label:
+                    continue
+                if row.get("uuid") == uuid(str(pd.Timestamp(row["grimoire_creation_date"])), self.community,
+                                           self.level, row["label"], self.model_name):
+                    yield hit
+        except NotFoundError:
+            return
+
+    def prepare_run(self):
+        '''Called when a run starts, before any label is enriched, drops what the previous run kept'''
+        self.es_client = self.get_es_client(self.elastic_url)
+        if self.repo_set_filter is not None:
+            self.repo_set_filter.reset()
+        if self.replay_cassette:
+            # the cassette is loaded once per process, every run replays it from the start
+            get_cassette_replay(**self.get_replay_settings()).reset()
+
+    def get_run_client(self):
+        '''Uncached client of the run, the stored state and the docs that must be read as they
+        are now go through it. Created by prepare_run, or on first use in a worker process.'''
+        if getattr(self, "es_client", None) is None:
+            self.es_client = self.get_es_client(self.elastic_url)
+        return self.es_client
+
+    def prepare_enrich(self, repos_list):
+        '''Called before the metrics of repos_list are computed'''
+        if self.lifecycle:
+            if not hasattr(self, "repo_lifecycle"):
+                self.repo_lifecycle = RepoLifecycle(
+                    self.git_index, self.lifecycle if isinstance(self.lifecycle, str) else None)
+            self.repo_lifecycle.refresh(self.get_run_client(), repos_list)
+
+    def finish_enrich(self, repos_list):
+        '''Called after the metrics of repos_list are written, drops what was kept for them'''
+        pass
+
+    def write_metrics_data(self, metrics_data_list, last_metrics_data=None):
+        '''Score (date, metrics data) pairs in date order and upload them to out_index'''
+        item_datas = []
+        last_metrics_data = {} if last_metrics_data is None else last_metrics_data
+        for date, metrics_data in metrics_data_list:
+            if metrics_data is None:
+                continue
+            self.cache_last_metrics_data(metrics_data, last_metrics_data)
+            metrics_data[self.score_field] = self.get_score(metrics_data, last_metrics_data)
+            item_datas.append(metrics_data)
+            if len(item_datas) > MAX_BULK_UPDATE_SIZE:
+                self.es_out.bulk_upload(item_datas, "uuid")
+                item_datas = []
+        self.es_out.bulk_upload(item_datas, "uuid")
+        item_datas = []
+
+    def iter_metrics_data(self, metrics, repos_list, label):
+        '''(date, metrics data) of every date in self.date_list, in date order'''
+        date_list = self.get_enrich_dates(repos_list, label)
+        if self.search_stats:
+            metrics = TaggedMetrics(metrics)
+        if self.async_concurrency:
+            yield from async_metrics_data(self, metrics, date_list, repos_list, label, self.async_concurrency)
+            return
+        if self.msearch_dates:
+            yield from msearch_metrics_data(self, metrics, date_list, repos_list, label, self.msearch_dates)
+            return
+        for date in date_list:
+            print(date)
+            yield date, self.get_metrics_data(metrics, date, repos_list, label)
+
+    def get_resume_dates(self, label):
+        '''Dates of self.date_list after the newest stored row of label, see restore_metrics_data'''
+        if label in self.high_water_marks:
+            return [date for date in self.date_list if date > self.high_water_marks[label]]
+        return self.date_list
+
+    def get_enrich_dates(self, repos_list, label):
+        '''Dates of self.date_list the metrics of repos_list are computed for'''
+        date_list = self.get_resume_dates(label)
+        if self.lifecycle:
+            return self.repo_lifecycle.get_dates(date_list, repos_list, self.created_since_delay)
+        return date_list
+
+    def get_metrics_source(self, repos_list):
+        '''Object whose metric methods are evaluated for every date'''
+        if self.columnar:
+            return self.columnar_class(self, repos_list)
+        if self.backfill:
+            return self.backfill_class(self, repos_list)
+        return self
+
+    def get_metrics_data(self, metrics, date, repos_list, label):
+        '''Metrics of repos_list at date, None if the repos did not exist yet'''
+        pass
 
-    def metrics_model_enrich(repos_list, label):
+    def get_score(self, item, last_metrics_data):
+        pass
+
+    def get_scores(self, items, last_metrics_data):
+        '''get_score of every row of a label in date order, each row being cached first
+        as write_metrics_data does. last_metrics_data is the state before the rows.'''
+        last_metrics_data = dict(last_metrics_data)
+        scores = []
+        for item in items:
+            self.cache_last_metrics_data(item, last_metrics_data)
+            scores.append(self.get_score(item, last_metrics_data))
+        return scores
+
+    def cache_last_metrics_data(self, item, last_metrics_data):
         pass
 
     def created_since(self, date, repos_list):
         created_since_list = []
         for repo in repos_list:
-            query_first_commit_since = self.get_updated_since_query(
-                [repo], date_field='grimoire_creation_date', to_date=date, order="asc")
-            first_commit_since = self.es_in.search(
-                index=self.git_index, body=query_first_commit_since)['hits']['hits']
-            if len(first_commit_since) > 0:
-                creation_since = first_commit_since[0]['_source']["grimoire_creation_date"]
+            if self.lifecycle:
+                creation_since = self.repo_lifecycle.get_first_commit(repo, date)
+            else:
+                query_first_commit_since = self.get_updated_since_query(
+                    [repo], date_field='grimoire_creation_date', to_date=date, order="asc")
+                first_commit_since = self.es_in.search(
+                    index=self.git_index, body=query_first_commit_since)['hits']['hits']
+                creation_since = first_commit_since[0]['_source']["grimoire_creation_date"] \
+                    if len(first_commit_since) > 0 else None
+            if creation_since is not None:
                 created_since_list.append(
                     get_time_diff_months(creation_since, str(date)))
                 # print(get_time_diff_months(creation_since, str(date)))
@@ -222,6 +544,22 @@ class MetricsModel:
         else:
             return None
 
+    def get_derived_filter(self, field, field_filter, script_filter):
+        '''script_filter, or a filter on the derived field when derived_fields is set'''
+        if self.derived_fields:
+            return get_derived_filter(field, field_filter, script_filter)
+        return script_filter
+
+    def get_repos_should(self, repos_list, pattern="{}*", field="tag"):
+        '''should clauses matching the docs of repos_list, pattern.format(repo) being the
+        simple_query_string of a repo, compiled to one terms filter with repo_filter. The tags
+        are listed and the tag sets stored with the uncached client of the run, es_in may be
+        cached or only able to search.'''
+        if self.repo_set_filter is None:
+            return get_repos_should(repos_list, pattern, field)
+        indexes = [getattr(self, name) for name in self.tag_indexes if getattr(self, name, None)]
+        return [self.repo_set_filter.get_clause(self.get_run_client(), indexes, repos_list, pattern, field)]
+
     def get_uuid_count_query(self, option, repos_list, field, date_field="grimoire_creation_date", size=0, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
         query = {
             "size": size,
@@ -236,10 +574,7 @@ class MetricsModel:
                 "must": [
                     {"bool":
                      {"should":
-                      [{"simple_query_string":
-                        {"query": i + "*",
-                         "fields":
-                         ["tag"]}}for i in repos_list],
+                      self.get_repos_should(repos_list),
                          "minimum_should_match": 1,
                          "filter":
                          {"range":
@@ -262,12 +597,7 @@ class MetricsModel:
             },
             "query": {
                 "bool": {
-                    "should": [{
-                        "simple_query_string": {
-                            "query": i+'*',
-                            "fields": ["tag"]
-                        }
-                    } for i in repos_list],
+                    "should": self.get_repos_should(repos_list),
                     "minimum_should_match": 1,
                     "filter": {
                         "range": {
@@ -303,7 +633,8 @@ class MetricsModel:
                         {
                             "match_phrase": {
                                 "tag": repo + ".git"
-                            }} for repo in repos_list],
+                            }} for repo in repos_list] if self.repo_set_filter is None else
+                    self.get_repos_should(repos_list, "{}.git"),
                     "minimum_should_match": 1,
                     "filter": {
                         "range": {
@@ -337,11 +668,7 @@ class MetricsModel:
                 "bool": {
                     "must": [{
                         "bool": {
-                            "should": [{
-                                "simple_query_string": {
-                                    "query": i,
-                                    "fields": ["tag"]
-                                }}for i in repos_list],
+                            "should": self.get_repos_should(repos_list, "{}"),
                             "minimum_should_match": 1
                         }
                     }],
@@ -378,11 +705,7 @@ class MetricsModel:
                 "bool": {
                     "must": [{
                         "bool": {
-                            "should": [{
-                                "simple_query_string": {
-                                    "query": i,
-                                    "fields": ["tag"]
-                                }}for i in repos_list],
+                            "should": self.get_repos_should(repos_list, "{}"),
                             "minimum_should_match": 1
                         }
                     },
@@ -425,11 +748,7 @@ class MetricsModel:
                 "bool": {
                     "must": [{
                         "bool": {
-                            "should": [{
-                                "simple_query_string": {
-                                    "query": i,
-                                    "fields": ["tag.keyword"]
-                                }}for i in repos_list],
+                            "should": self.get_repos_should(repos_list, "{}", "tag.keyword"),
                             "minimum_should_match": 1
                         }
                     }
@@ -450,6 +769,31 @@ class MetricsModel:
 
     # name list of author_name in a index
     def get_all_CX_contributors(self, repos_list, search_index, pr=False, issue=False, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
+        query_CX_users = self.get_all_CX_contributors_query(
+            repos_list, pr=pr, issue=issue, from_date=from_date, to_date=to_date)
+        CX_contributors = self.es_in.search(index=search_index, body=query_CX_users)[
+            "aggregations"]["name"]["buckets"]
+        return [i["date"]["hits"]["hits"][0]["_source"] for i in CX_contributors]
+
+    def count_CX_contributors(self, repos_list, search_index, pr=False, issue=False, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
+        '''len(get_all_CX_contributors(...)) without fetching any _source'''
+        query_CX_users = self.get_all_CX_contributors_query(
+            repos_list, pr=pr, issue=issue, from_date=from_date, to_date=to_date)
+        return self.count_composite_terms(search_index, query_CX_users, "author_name")
+
+    def count_composite_terms(self, search_index, query, field):
+        '''Number of distinct values of field in the docs of query, paging through a composite aggregation'''
+        query["size"] = 0
+        query["aggs"] = {"name": {"composite": {"size": COMPOSITE_SIZE, "sources": [{field: {"terms": {"field": field}}}]}}}
+        count = 0
+        while True:
+            composite = self.es_in.search(index=search_index, body=query)["aggregations"]["name"]
+            count += len(composite["buckets"])
+            if len(composite["buckets"]) < COMPOSITE_SIZE or "after_key" not in composite:
+                return count
+            query["aggs"]["name"]["composite"]["after"] = composite["after_key"]
+
+    def get_all_CX_contributors_query(self, repos_list, pr=False, issue=False, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
         query_CX_users = {
             "aggs": {
                 "name": {
@@ -470,16 +814,7 @@ class MetricsModel:
             },
             "query": {
                 "bool": {
-                    "should": [
-                        {
-                            "simple_query_string": {
-                                "query": i+"(*) OR " + i+"*",
-                                "fields": [
-                                    "tag"
-                                ]
-                            }
-                        } for i in repos_list
-                    ],
+                    "should": self.get_repos_should(repos_list, "{0}(*) OR {0}*"),
                     "minimum_should_match": 1,
                     "filter": {
                         "range": {
@@ -505,12 +840,25 @@ class MetricsModel:
                     "pull_request": "false"
                 }
             }
+        return query_CX_users
+
+
+    def get_all_CX_comments_contributors(self, repos_list, search_index, pr=False, issue=False, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
+        query_CX_users = self.get_all_CX_comments_contributors_query(
+            repos_list, pr=pr, issue=issue, from_date=from_date, to_date=to_date)
         CX_contributors = self.es_in.search(index=search_index, body=query_CX_users)[
             "aggregations"]["name"]["buckets"]
-        return [i["date"]["hits"]["hits"][0]["_source"] for i in CX_contributors]
+        all_contributors = [i["date"]["hits"]["hits"]
+                            [0]["_source"] for i in CX_contributors]
+        return all_contributors
 
+    def count_CX_comments_contributors(self, repos_list, search_index, pr=False, issue=False, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
+        '''len(get_all_CX_comments_contributors(...)) without fetching any _source'''
+        query_CX_users = self.get_all_CX_comments_contributors_query(
+            repos_list, pr=pr, issue=issue, from_date=from_date, to_date=to_date)
+        return self.count_composite_terms(search_index, query_CX_users, "author_name")
 
-    def get_all_CX_comments_contributors(self, repos_list, search_index, pr=False, issue=False, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
+    def get_all_CX_comments_contributors_query(self, repos_list, pr=False, issue=False, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
         query_CX_users = {
             "aggs": {
                 "name": {
@@ -531,16 +879,7 @@ class MetricsModel:
             },
             "query": {
                 "bool": {
-                    "should": [
-                        {
-                            "simple_query_string": {
-                                "query": i+"(*) OR " + i+"*",
-                                "fields": [
-                                    "tag"
-                                ]
-                            }
-                        } for i in repos_list
-                    ],
+                    "should": self.get_repos_should(repos_list, "{0}(*) OR {0}*"),
                     "minimum_should_match": 1,
                     "filter": {
                         "range": {
@@ -573,18 +912,26 @@ class MetricsModel:
                         "issue_pull_request": "false"
                     }
                 }]
-        CX_contributors = self.es_in.search(index=search_index, body=query_CX_users)[
-            "aggregations"]["name"]["buckets"]
-        all_contributors = [i["date"]["hits"]["hits"]
-                            [0]["_source"] for i in CX_contributors]
-        return all_contributors
+        return query_CX_users
 
 
 
 
 class ActivityMetricsModel(MetricsModel):
-    def __init__(self, issue_index, repo_index=None, pr_index=None, json_file=None, git_index=None, out_index=None, git_branch=None, from_date=None, end_date=None, community=None, level=None, release_index=None, opensearch_config_file=None,issue_comments_index=None, pr_comments_index=None):
-        super().__init__(json_file, from_date, end_date, out_index, community, level)
+    backfill_class = ActivityHistogramBackfill
+    columnar_class = ActivityColumnarMetrics
+    score_field = "activity_score"
+    shared_metrics = {
+        "created_since": ("git_index",),
+        "comment_frequency": ("issue_index",),
+        "updated_issue_count": ("issue_index",),
+        "active_C1_pr_create_contributor": ("pr_index",),
+        "active_C1_pr_comments_contributor": ("pr_comments_index",),
+        "active_C2_contributor_count": ("git_index",),
+    }
+
+    def __init__(self, issue_index, repo_index=None, pr_index=None, json_file=None, git_index=None, out_index=None, git_branch=None, from_date=None, end_date=None, community=None, level=None, release_index=None, opensearch_config_file=None,issue_comments_index=None, pr_comments_index=None, sketch_index=None, **kwargs):
+        super().__init__(json_file, from_date, end_date, out_index, community, level, **kwargs)
         self.issue_index = issue_index
         self.repo_index = repo_index
         self.git_index = git_index
@@ -596,6 +943,10 @@ class ActivityMetricsModel(MetricsModel):
         self.all_project = get_all_project(self.json_file)
         self.all_repo = get_all_repo(self.json_file, self.issue_index)
         self.model_name = 'Activity'
+        self.release_ingester = ReleaseIngester(self.repo_index, self.release_index)
+        self.sketch_index = sketch_index
+        if sketch_index:
+            self.sketch_store = SketchStore(sketch_index)
 
     def contributor_count(self, date, repos_list):
         query_author_uuid_data = self.get_uuid_count_contribute_query(
@@ -615,13 +966,16 @@ class ActivityMetricsModel(MetricsModel):
     def updated_since(self, date, repos_list):
         updated_since_list = []
         for repo in repos_list:
-            query_updated_since = self.get_updated_since_query(
-                [repo], date_field='metadata__updated_on', to_date=date)
-            updated_since = self.es_in.search(
-                index=self.git_index, body=query_updated_since)['hits']['hits']
-            if updated_since:
-                updated_since_list.append(get_time_diff_months(
-                    updated_since[0]['_source']["metadata__updated_on"], str(date)))
+            if self.lifecycle:
+                last_update = self.repo_lifecycle.get_last_update(repo, date)
+            else:
+                query_updated_since = self.get_updated_since_query(
+                    [repo], date_field='metadata__updated_on', to_date=date)
+                updated_since = self.es_in.search(
+                    index=self.git_index, body=query_updated_since)['hits']['hits']
+                last_update = updated_since[0]['_source']["metadata__updated_on"] if updated_since else None
+            if last_update is not None:
+                updated_since_list.append(get_time_diff_months(last_update, str(date)))
         if updated_since_list:
             return sum(updated_since_list) / len(updated_since_list)
         else:
@@ -675,22 +1029,18 @@ class ActivityMetricsModel(MetricsModel):
             return 0
 
     def active_C1_pr_create_contributor(self, date, repos_list):
-        C1_pr_contributors = self.get_all_CX_contributors(
+        return self.count_CX_contributors(
             repos_list, (self.pr_index), pr=True, from_date=date-timedelta(days=90), to_date=date)
-        return len(C1_pr_contributors)
 
     def active_C1_pr_comments_contributor(self, date, repos_list):
-        C1_pr_comments_contributors = self.get_all_CX_comments_contributors(repos_list, (self.pr_comments_index), pr=True, from_date=date-timedelta(days=90), to_date=date)
-        return len(C1_pr_comments_contributors)
+        return self.count_CX_comments_contributors(repos_list, (self.pr_comments_index), pr=True, from_date=date-timedelta(days=90), to_date=date)
     
     def active_C1_issue_create_contributor(self, date, repos_list):
-        C1_issue_contributors = self.get_all_CX_contributors(
+        return self.count_CX_contributors(
             repos_list, (self.issue_index), issue=True, from_date=date-timedelta(days=90), to_date=date)
-        return len(C1_issue_contributors)
 
     def active_C1_issue_comments_contributor(self, date, repos_list):
-        C1_issue_comments_contributors = self.get_all_CX_comments_contributors(repos_list, (self.issue_comments_index), issue=True, from_date=date-timedelta(days=90), to_date=date)
-        return len(C1_issue_comments_contributors)
+        return self.count_CX_comments_contributors(repos_list, (self.issue_comments_index), issue=True, from_date=date-timedelta(days=90), to_date=date)
 
     def active_C2_contributor_count(self, date, repos_list):
         query_author_uuid_data = self.get_uuid_count_contribute_query(
@@ -700,50 +1050,69 @@ class ActivityMetricsModel(MetricsModel):
         return author_uuid_count
 
 
-    def metrics_model_enrich(self, repos_list, label):
-        item_datas = []
-        last_metrics_data = {}
-        create_release_index(self.es_in, repos_list, self.repo_index ,self.release_index)
+    def prepare_run(self):
+        super().prepare_run()
+        self.release_ingester = ReleaseIngester(self.repo_index, self.release_index)
+        # the releases of every repo of the json file, before any label is enriched
+        self.release_ingester.ingest(self.get_run_client(), self.all_repo)
+
+    def prepare_enrich(self, repos_list):
+        super().prepare_enrich(repos_list)
+        self.release_ingester.ingest(self.get_run_client(), repos_list)
+        if self.sketch_index and self.level == "repo" and not (self.columnar or self.processes):
+            # the sketches need the docs in memory, pulled by a columnar source of their own
+            self.sketch_store.record(self.get_run_client(), self.columnar_class(self, repos_list),
+                                     repos_list[0], self.date_list)
+
+    def get_metrics_source(self, repos_list):
+        if self.sketch_index and self.level != "repo" and not has_prefix_overlap(repos_list):
+            sketches = self.sketch_store.load(self.get_run_client(), repos_list, self.date_list)
+            if sketches is not None:
+                return SketchRollupMetrics(self, repos_list, sketches)
+            print("sketches of {} repos missing, querying them".format(len(repos_list)))
+        metrics = super().get_metrics_source(repos_list)
+        if self.sketch_index and self.level == "repo" and (self.columnar or self.processes):
+            # recorded from the columnar source of the run, in the worker of each chunk with processes
+            columnar = metrics if self.columnar else self.columnar_class(self, repos_list)
+            self.sketch_store.record(self.get_run_client(), columnar, repos_list[0], self.date_list)
+        return metrics
+
+    def get_metrics_data(self, metrics, date, repos_list, label):
+        created_since = metrics.created_since(date, repos_list)
+        if created_since is None:
+            return None
+        comment_frequency = metrics.comment_frequency(date, repos_list)
+        code_review_count = metrics.code_review_count(date, repos_list)
+        commit_frequency_message = metrics.commit_frequency(date, repos_list)
+        metrics_data = {
+            'uuid': uuid(str(date), self.community, self.level, label, self.model_name),
+            'level': self.level,
+            'label': label,
+            'model_name': self.model_name,
+            'contributor_count': int(metrics.contributor_count(date, repos_list)),
+            'active_C2_contributor_count': metrics.active_C2_contributor_count(date, repos_list),
+            'active_C1_pr_create_contributor': metrics.active_C1_pr_create_contributor(date, repos_list),
+            'active_C1_pr_comments_contributor': metrics.active_C1_pr_comments_contributor(date, repos_list),
+            'active_C1_issue_create_contributor': metrics.active_C1_issue_create_contributor(date, repos_list),
+            'active_C1_issue_comments_contributor': metrics.active_C1_issue_comments_contributor(date, repos_list),
+            'commit_frequency': commit_frequency_message,
+            'created_since': round(metrics.created_since(date, repos_list), 4),
+            'comment_frequency': float(round(comment_frequency, 4)) if comment_frequency != None else None,
+            'code_review_count': round(code_review_count, 4) if code_review_count != None else None,
+            'updated_since': float(round(metrics.updated_since(date, repos_list), 4)),
+            'closed_issues_count': metrics.closed_issue_count(date, repos_list),
+            'updated_issues_count': metrics.updated_issue_count(date, repos_list),
+            'recent_releases_count': metrics.recent_releases_count(date, repos_list),
+            'grimoire_creation_date': date.isoformat(),
+            'metadata__enriched_on': datetime_utcnow().isoformat()
+        }
+        return metrics_data
 
-        for date in self.date_list:
-            print(date)
-            created_since = self.created_since(date, repos_list)
-            if created_since is None:
-                continue
-            comment_frequency = self.comment_frequency(date, repos_list)
-            code_review_count = self.code_review_count(date, repos_list)
-            commit_frequency_message = self.commit_frequency(date, repos_list)
-            metrics_data = {
-                'uuid': uuid(str(date), self.community, self.level, label, self.model_name),
-                'level': self.level,
-                'label': label,
-                'model_name': self.model_name,
-                'contributor_count': int(self.contributor_count(date, repos_list)),
-                'active_C2_contributor_count': self.active_C2_contributor_count(date, repos_list),
-                'active_C1_pr_create_contributor': self.active_C1_pr_create_contributor(date, repos_list),
-                'active_C1_pr_comments_contributor': self.active_C1_pr_comments_contributor(date, repos_list),
-                'active_C1_issue_create_contributor': self.active_C1_issue_create_contributor(date, repos_list),
-                'active_C1_issue_comments_contributor': self.active_C1_issue_comments_contributor(date, repos_list),
-                'commit_frequency': commit_frequency_message,
-                'created_since': round(self.created_since(date, repos_list), 4),
-                'comment_frequency': float(round(comment_frequency, 4)) if comment_frequency != None else None,
-                'code_review_count': round(code_review_count, 4) if code_review_count != None else None,
-                'updated_since': float(round(self.updated_since(date, repos_list), 4)),
-                'closed_issues_count': self.closed_issue_count(date, repos_list),
-                'updated_issues_count': self.updated_issue_count(date, repos_list),
-                'recent_releases_count': self.recent_releases_count(date, repos_list),
-                'grimoire_creation_date': date.isoformat(),
-                'metadata__enriched_on': datetime_utcnow().isoformat()
-            }
-            self.cache_last_metrics_data(metrics_data, last_metrics_data)
-            score = get_activity_score(activity_decay(metrics_data, last_metrics_data))
-            metrics_data["activity_score"] = score
-            item_datas.append(metrics_data)
-            if len(item_datas) > MAX_BULK_UPDATE_SIZE:
-                self.es_out.bulk_upload(item_datas, "uuid")
-                item_datas = []
-        self.es_out.bulk_upload(item_datas, "uuid")
-        item_datas = []
+    def get_score(self, item, last_metrics_data):
+        return get_activity_score(activity_decay(item, last_metrics_data))
+
+    def get_scores(self, items, last_metrics_data):
+        return get_activity_scores(items, last_metrics_data)
 
     def cache_last_metrics_data(self, item, last_metrics_data):
         for i in ["comment_frequency",  "code_review_count"]:
@@ -753,9 +1122,20 @@ class ActivityMetricsModel(MetricsModel):
 
 
 class CommunitySupportMetricsModel(MetricsModel):
-    def __init__(self, issue_index=None, pr_index=None, git_index=None,  json_file=None, out_index=None, from_date=None, end_date=None, community=None, level=None):
-        super().__init__(json_file, from_date, end_date, out_index, community, level)
+    backfill_class = CommunitySupportHistogramBackfill
+    columnar_class = CommunitySupportColumnarMetrics
+    score_field = "community_support_score"
+    derived_field_indexes = {"is_bug_issue": "issue_index"}
+    shared_metrics = {
+        "created_since": ("git_index",),
+        "comment_frequency": ("issue_index",),
+        "updated_issue_count": ("issue_index",),
+    }
+
+    def __init__(self, issue_index=None, pr_index=None, git_index=None,  json_file=None, out_index=None, from_date=None, end_date=None, community=None, level=None, open_time_aggs=False, **kwargs):
+        super().__init__(json_file, from_date, end_date, out_index, community, level, **kwargs)
         self.issue_index = issue_index
+        self.open_time_aggs = open_time_aggs
         self.all_project = get_all_project(self.json_file)
         self.all_repo = get_all_repo(self.json_file, self.issue_index)
         self.model_name = 'Community Support and Service'
@@ -782,6 +1162,9 @@ class CommunitySupportMetricsModel(MetricsModel):
     def issue_open_time(self, date, repos_list):
         query_issue_opens = self.get_uuid_count_query("avg", repos_list, "time_to_first_attention_without_bot", "grimoire_creation_date", size=10000, from_date=date-timedelta(days=90), to_date=date)
         query_issue_opens["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "false" }})
+        if self.open_time_aggs:
+            query_issue_opens = get_open_time_query(query_issue_opens, ISSUE_OPEN_TIME_SCRIPT, date)
+            return get_open_time(self.es_in.search(index=self.issue_index, body=query_issue_opens))
         issue_opens_items = self.es_in.search(index=self.issue_index, body=query_issue_opens)['hits']['hits']
         if len(issue_opens_items) == 0:
             return None, None
@@ -820,7 +1203,11 @@ class CommunitySupportMetricsModel(MetricsModel):
                 "minimum_should_match": 1
             }
         }
-        query_issue_opens["query"]["bool"]["must"].append(bug_query)
+        query_issue_opens["query"]["bool"]["must"].append(
+            self.get_derived_filter("is_bug_issue", {"term": {"is_bug_issue": True}}, bug_query))
+        if self.open_time_aggs:
+            query_issue_opens = get_open_time_query(query_issue_opens, BUG_ISSUE_OPEN_TIME_SCRIPT, date)
+            return get_open_time(self.es_in.search(index=self.issue_index, body=query_issue_opens))
         issue_opens_items = self.es_in.search(
             index=self.issue_index, body=query_issue_opens)['hits']['hits']
         if len(issue_opens_items) == 0:
@@ -842,6 +1229,9 @@ class CommunitySupportMetricsModel(MetricsModel):
         query_pr_opens = self.get_uuid_count_query("avg", repos_list, "time_to_first_attention_without_bot",
                                                    "grimoire_creation_date", size=10000, from_date=date-timedelta(days=90), to_date=date)
         query_pr_opens["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "true" }})                                    
+        if self.open_time_aggs:
+            query_pr_opens = get_open_time_query(query_pr_opens, PR_OPEN_TIME_SCRIPT, date)
+            return get_open_time(self.es_in.search(index=self.pr_index, body=query_pr_opens))
         pr_opens_items = self.es_in.search(
             index=self.pr_index, body=query_pr_opens)['hits']['hits']
         if len(pr_opens_items) == 0:
@@ -917,49 +1307,43 @@ class CommunitySupportMetricsModel(MetricsModel):
             'aggregations']["count_of_uuid"]['value']
         return pr_closed
 
-    def metrics_model_enrich(self, repos_list, label):
-        item_datas = []
-        last_metrics_data = {}
-        for date in self.date_list:
-            print(date)
-            created_since = self.created_since(date, repos_list)
-            if created_since is None:
-                continue
-            issue_first = self.issue_first_reponse(date, repos_list)
-            bug_issue_open_time = self.bug_issue_open_time(date, repos_list)
-            pr_open_time = self.pr_open_time(date, repos_list)
-            pr_first_response_time = self.pr_first_response_time(date, repos_list)
-            comment_frequency = self.comment_frequency(date, repos_list)
-            code_review_count = self.code_review_count(date, repos_list)
-            metrics_data = {
-                'uuid': uuid(str(date), self.community, self.level, label, self.model_name),
-                'level': self.level,
-                'label': label,
-                'model_name': self.model_name,
-                'issue_first_reponse_avg': round(issue_first[0],4) if issue_first[0] != None else None,
-                'issue_first_reponse_mid': round(issue_first[1],4) if issue_first[1] != None else None,
-                'bug_issue_open_time_avg': round(bug_issue_open_time[0],4) if bug_issue_open_time[0] != None else None,
-                'bug_issue_open_time_mid': round(bug_issue_open_time[1],4) if bug_issue_open_time[1] != None else None,
-                'pr_open_time_avg': round(pr_open_time[0],4) if pr_open_time[0] != None else None,
-                'pr_open_time_mid': round(pr_open_time[1],4) if pr_open_time[1] != None else None,
-                'pr_first_response_time_avg': round(pr_first_response_time[0],4) if pr_first_response_time[0] != None else None,
-                'pr_first_response_time_mid': round(pr_first_response_time[1],4) if pr_first_response_time[1] != None else None,
-                'comment_frequency': float(round(comment_frequency, 4)) if comment_frequency != None else None,
-                'code_review_count': float(code_review_count) if code_review_count != None else None,
-                'updated_issues_count': self.updated_issue_count(date, repos_list),
-                'closed_prs_count': self.closed_pr_count(date, repos_list),
-                'grimoire_creation_date': date.isoformat(),
-                'metadata__enriched_on': datetime_utcnow().isoformat()
-            }
-            self.cache_last_metrics_data(metrics_data, last_metrics_data)
-            score = community_support(community_decay(metrics_data, last_metrics_data))
-            metrics_data["community_support_score"] = score
-            item_datas.append(metrics_data)
-            if len(item_datas) > MAX_BULK_UPDATE_SIZE:
-                self.es_out.bulk_upload(item_datas, "uuid")
-                item_datas = []
-        self.es_out.bulk_upload(item_datas, "uuid")
-        item_datas = []
+    def get_metrics_data(self, metrics, date, repos_list, label):
+        created_since = metrics.created_since(date, repos_list)
+        if created_since is None:
+            return None
+        issue_first = metrics.issue_first_reponse(date, repos_list)
+        bug_issue_open_time = metrics.bug_issue_open_time(date, repos_list)
+        pr_open_time = metrics.pr_open_time(date, repos_list)
+        pr_first_response_time = metrics.pr_first_response_time(date, repos_list)
+        comment_frequency = metrics.comment_frequency(date, repos_list)
+        code_review_count = metrics.code_review_count(date, repos_list)
+        metrics_data = {
+            'uuid': uuid(str(date), self.community, self.level, label, self.model_name),
+            'level': self.level,
+            'label': label,
+            'model_name': self.model_name,
+            'issue_first_reponse_avg': round(issue_first[0],4) if issue_first[0] != None else None,
+            'issue_first_reponse_mid': round(issue_first[1],4) if issue_first[1] != None else None,
+            'bug_issue_open_time_avg': round(bug_issue_open_time[0],4) if bug_issue_open_time[0] != None else None,
+            'bug_issue_open_time_mid': round(bug_issue_open_time[1],4) if bug_issue_open_time[1] != None else None,
+            'pr_open_time_avg': round(pr_open_time[0],4) if pr_open_time[0] != None else None,
+            'pr_open_time_mid': round(pr_open_time[1],4) if pr_open_time[1] != None else None,
+            'pr_first_response_time_avg': round(pr_first_response_time[0],4) if pr_first_response_time[0] != None else None,
+            'pr_first_response_time_mid': round(pr_first_response_time[1],4) if pr_first_response_time[1] != None else None,
+            'comment_frequency': float(round(comment_frequency, 4)) if comment_frequency != None else None,
+            'code_review_count': float(code_review_count) if code_review_count != None else None,
+            'updated_issues_count': metrics.updated_issue_count(date, repos_list),
+            'closed_prs_count': metrics.closed_pr_count(date, repos_list),
+            'grimoire_creation_date': date.isoformat(),
+            'metadata__enriched_on': datetime_utcnow().isoformat()
+        }
+        return metrics_data
+
+    def get_score(self, item, last_metrics_data):
+        return community_support(community_decay(item, last_metrics_data))
+
+    def get_scores(self, items, last_metrics_data):
+        return community_support_scores(items, last_metrics_data)
 
     def cache_last_metrics_data(self, item, last_metrics_data):
         for i in ["issue_first_reponse_avg",  "issue_first_reponse_mid", 
@@ -973,8 +1357,20 @@ class CommunitySupportMetricsModel(MetricsModel):
 
 
 class CodeQualityGuaranteeMetricsModel(MetricsModel):
-    def __init__(self, issue_index=None, pr_index=None, repo_index=None, json_file=None, git_index=None, out_index=None, git_branch=None, from_date=None, end_date=None, community=None, level=None, company=None, pr_comments_index=None):
-        super().__init__(json_file, from_date, end_date, out_index, community, level)
+    backfill_class = CodeQualityHistogramBackfill
+    columnar_class = CodeQualityColumnarMetrics
+    score_field = "code_quality_guarantee"
+    created_since_delay = timedelta(days=90)
+    derived_field_indexes = {"merged_by_other": "pr_index", "is_merge_commit": "git_index"}
+    shared_metrics = {
+        "created_since": ("git_index",),
+        "active_C1_pr_create_contributor": ("pr_index",),
+        "active_C1_pr_comments_contributor": ("pr_comments_index",),
+        "active_C2_contributor_count": ("git_index",),
+    }
+
+    def __init__(self, issue_index=None, pr_index=None, repo_index=None, json_file=None, git_index=None, out_index=None, git_branch=None, from_date=None, end_date=None, community=None, level=None, company=None, pr_comments_index=None, pr_linkage=None, batch_linked_issues=False, **kwargs):
+        super().__init__(json_file, from_date, end_date, out_index, community, level, **kwargs)
         self.issue_index = issue_index
         self.repo_index = repo_index
         self.git_index = git_index
@@ -986,6 +1382,25 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
         self.company = company
         self.pr_comments_index = pr_comments_index
         self.commit_message_dict = {}
+        self.commit_days = {}
+        self.pr_linkage = pr_linkage
+        self.batch_linked_issues = batch_linked_issues
+        self.linked_issue_prs = {}
+        if pr_linkage:
+            self.commit_pr_linkage = CommitPrLinkage(
+                pr_index, pr_linkage if isinstance(pr_linkage, str) else None)
+
+    def prepare_enrich(self, repos_list):
+        super().prepare_enrich(repos_list)
+        # computed in the worker processes instead, from the dates of their chunk
+        if not self.columnar and not (self.level == "repo" and self.processes):
+            self.get_label_commit_days(repos_list)
+        if self.pr_linkage:
+            self.commit_pr_linkage.refresh(self.es_in, self.get_run_client(), repos_list, self.get_repos_should)
+        if self.batch_linked_issues and self.date_list:
+            self.linked_issue_prs[tuple(repos_list)] = LinkedIssuePrs(repos_list).load(
+                self.es_in, (self.pr_index, self.pr_comments_index),
+                self.date_list[0]-timedelta(days=90), self.date_list[-1]+timedelta(days=1), self.get_repos_should)
 
     def get_pr_message_count(self, repos_list, field, date_field="grimoire_creation_date", size=0, filter_field=None, from_date=str_to_datetime("1970-01-01"), to_date=datetime_utcnow()):
         query = {
@@ -1003,11 +1418,7 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
                     "must": [
                         {
                             "bool": {
-                                "should": [{
-                                    "simple_query_string": {
-                                        "query": i,
-                                        "fields": ["tag"]
-                                    }}for i in repos_list],
+                                "should": self.get_repos_should(repos_list, "{}"),
                                 "minimum_should_match": 1
                             }
                         },
@@ -1073,16 +1484,7 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
                     "must": [
                         {
                             "bool": {
-                                "should": [
-                                    {
-                                        "simple_query_string": {
-                                            "query": repo,
-                                            "fields": [
-                                                "tag"
-                                            ]
-                                        }
-                                    }
-                                ],
+                                "should": self.get_repos_should([repo], "{}"),
                                 "minimum_should_match": 1
                             }
                         }
@@ -1122,26 +1524,71 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
                 'aggregations']["count_of_uuid"]['value']
         return commit_frequency/12.85, query_commit_frequency_commpany/12.85
 
+    def finish_enrich(self, repos_list):
+        super().finish_enrich(repos_list)
+        self.commit_days.pop(tuple(repos_list), None)
+        self.linked_issue_prs.pop(tuple(repos_list), None)
+
+    def get_label_commit_days(self, repos_list):
+        '''get_commit_days of repos_list over the current date_list, kept until the label is written'''
+        dates = (self.date_list[0], self.date_list[-1]) if self.date_list else None
+        cached = self.commit_days.get(tuple(repos_list))
+        if cached is None or cached[0] != dates:
+            cached = self.commit_days[tuple(repos_list)] = (dates, self.get_commit_days(repos_list))
+        return cached[1]
+
+    def get_commit_days(self, repos_list):
+        '''{tag: epoch millis of the days with commits} of repos_list over date_list, paging
+        through a composite aggregation on (tag, day)'''
+        if not self.date_list:
+            return {}
+        query = self.get_uuid_count_query("cardinality", repos_list, "hash",
+                                          from_date=self.date_list[0]-timedelta(days=97),
+                                          to_date=self.date_list[-1]+timedelta(days=1))
+        query["query"]["bool"]["must"].append({"exists": {"field": "hash"}})
+        query["aggs"] = {
+            "days": {
+                "composite": {
+                    "size": COMPOSITE_SIZE,
+                    "sources": [
+                        {"tag": {"terms": {"field": "tag"}}},
+                        {"day": {"date_histogram": {"field": "grimoire_creation_date", "calendar_interval": "day"}}}
+                    ]
+                }
+            }
+        }
+        tag_days = {}
+        while True:
+            composite = self.es_in.search(index=self.git_index, body=query)['aggregations']["days"]
+            for bucket in composite["buckets"]:
+                tag_days.setdefault(bucket["key"]["tag"], []).append(bucket["key"]["day"])
+            if len(composite["buckets"]) < COMPOSITE_SIZE or "after_key" not in composite:
+                break
+            query["aggs"]["days"]["composite"]["after"] = composite["after_key"]
+        return {tag: np.array(days, dtype=np.int64) for tag, days in tag_days.items()}
+
+    def has_commits(self, days, from_date, to_date):
+        '''Whether some day of the sorted days is in [from_date, to_date)'''
+        return np.searchsorted(days, day_millis(to_date)) > np.searchsorted(days, day_millis(from_date))
+
     def is_maintained(self, date, repos_list):
+        commit_days = self.get_label_commit_days(repos_list)
         is_maintained_list = []
         if self.level == "repo":
+            days = np.unique(np.concatenate([np.array([], dtype=np.int64)] + list(commit_days.values())))
             date_list_maintained = get_date_list(begin_date=str(
                 date-timedelta(days=90)), end_date=str(date), freq='7D')
             for day in date_list_maintained:
-                query_git_commit_i = self.get_uuid_count_query(
-                    "cardinality", repos_list, "hash", size=0, from_date=day-timedelta(days=7), to_date=day)
-                commit_frequency_i = self.es_in.search(index=self.git_index, body=query_git_commit_i)[
-                    'aggregations']["count_of_uuid"]['value']
-                if commit_frequency_i > 0:
+                if self.has_commits(days, day-timedelta(days=7), day):
                     is_maintained_list.append("True")
                 else:
                     is_maintained_list.append("False")
 
         elif self.level in ["project", "community"]:
             for repo in repos_list:
-                query_git_commit_i = self.get_uuid_count_query("cardinality",[repo+'.git'], "hash",from_date=date-timedelta(days=30), to_date=date)
-                commit_frequency_i = self.es_in.search(index=self.git_index, body=query_git_commit_i)['aggregations']["count_of_uuid"]['value']
-                if commit_frequency_i > 0:
+                days = np.unique(np.concatenate([np.array([], dtype=np.int64)] + [
+                    tag_days for tag, tag_days in commit_days.items() if tag.startswith(repo + '.git')]))
+                if self.has_commits(days, date-timedelta(days=30), date):
                     is_maintained_list.append("True")
                 else:
                     is_maintained_list.append("False")
@@ -1182,7 +1629,10 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
                 }],
                 "minimum_should_match": 1}
         }
-        commit_frequency["query"]["bool"]["must"].append(commits_without_merge_pr) 
+        commit_frequency["query"]["bool"]["must"].append(self.get_derived_filter(
+            "is_merge_commit",
+            {"bool": {"must": [{"term": {"is_merge_commit": False}}, {"exists": {"field": "message"}}]}},
+            commits_without_merge_pr))
         commit_message = self.es_in.search(index=self.git_index, body=commit_frequency)
         commit_count = commit_message['aggregations']["count_of_uuid"]['value']
         commit_pr_cout = 0
@@ -1190,7 +1640,9 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
 
         for commit_message_i in set(commit_all_message):
             commit_hash = commit_message_i
-            if commit_hash in self.commit_message_dict:
+            if self.pr_linkage:
+                commit_pr_cout += self.commit_pr_linkage.is_linked(commit_hash, repos_list)
+            elif commit_hash in self.commit_message_dict:
                 commit_pr_cout += self.commit_message_dict[commit_hash]
             else:
                 pr_message = self.get_uuid_count_query("cardinality", repos_list, "uuid", "grimoire_creation_date", size=0)
@@ -1211,6 +1663,14 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
             return 0, None, None
 
 
+    def get_merged_by_other_filter(self):
+        merged_by_other = {
+                            "script": {
+                                "script": "if(doc['merged_by_data_name'].size() > 0 && doc['author_name'].size() > 0 && doc['merged_by_data_name'].value !=  doc['author_name'].value){return true}"
+                            }
+                        }
+        return self.get_derived_filter("merged_by_other", {"term": {"merged_by_other": True}}, merged_by_other)
+
     def code_merge_ratio(self, date, repos_list):
         query_pr_count = self.get_uuid_count_query(
             "cardinality", repos_list, "uuid", size=0, from_date=(date-timedelta(days=90)), to_date=date)
@@ -1219,11 +1679,7 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
             'aggregations']["count_of_uuid"]['value']
         query_pr_body = self.get_uuid_count_query( "cardinality", repos_list, "uuid", "grimoire_creation_date", size=0, from_date=(date-timedelta(days=90)), to_date=date)
         query_pr_body["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "true" }})
-        query_pr_body["query"]["bool"]["must"].append({
-                            "script": {
-                                "script": "if(doc['merged_by_data_name'].size() > 0 && doc['author_name'].size() > 0 && doc['merged_by_data_name'].value !=  doc['author_name'].value){return true}"
-                            }
-                        })
+        query_pr_body["query"]["bool"]["must"].append(self.get_merged_by_other_filter())
         prs = self.es_in.search(index=self.pr_index, body=query_pr_body)[
             'aggregations']["count_of_uuid"]['value']
         try:
@@ -1233,11 +1689,14 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
 
     def pr_issue_linked(self, date, repos_list):
         pr_linked_issue = 0
-        for repo in repos_list:
-            query_pr_linked_issue = self.get_pr_linked_issue_count(
-                repo, from_date=date-timedelta(days=90), to_date=date)
-            pr_linked_issue += self.es_in.search(index=(self.pr_index, self.pr_comments_index), body=query_pr_linked_issue)[
-                'aggregations']["count_of_uuid"]['value']
+        if tuple(repos_list) in self.linked_issue_prs:
+            pr_linked_issue = self.linked_issue_prs[tuple(repos_list)].count(date)
+        else:
+            for repo in repos_list:
+                query_pr_linked_issue = self.get_pr_linked_issue_count(
+                    repo, from_date=date-timedelta(days=90), to_date=date)
+                pr_linked_issue += self.es_in.search(index=(self.pr_index, self.pr_comments_index), body=query_pr_linked_issue)[
+                    'aggregations']["count_of_uuid"]['value']
         query_pr_count = self.get_uuid_count_query(
             "cardinality", repos_list, "uuid", size=0, from_date=(date-timedelta(days=90)), to_date=date)
         query_pr_count["query"]["bool"]["must"].append({"match_phrase": {"pull_request": "true" }})
@@ -1249,13 +1708,11 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
         except ZeroDivisionError:
             return None
     def active_C1_pr_create_contributor(self, date, repos_list):
-        C1_pr_contributors = self.get_all_CX_contributors(
+        return self.count_CX_contributors(
             repos_list, (self.pr_index), pr=True, from_date=date-timedelta(days=90), to_date=date)
-        return len(C1_pr_contributors)
 
     def active_C1_pr_comments_contributor(self, date, repos_list):
-        C1_pr_comments_contributors = self.get_all_CX_comments_contributors(repos_list, (self.pr_comments_index), pr=True, from_date=date-timedelta(days=90), to_date=date)
-        return len(C1_pr_comments_contributors)
+        return self.count_CX_comments_contributors(repos_list, (self.pr_comments_index), pr=True, from_date=date-timedelta(days=90), to_date=date)
     
     def active_C2_contributor_count(self, date, repos_list):
         query_author_uuid_data = self.get_uuid_count_contribute_query(
@@ -1264,55 +1721,49 @@ class CodeQualityGuaranteeMetricsModel(MetricsModel):
             'aggregations']["count_of_contributors"]['value']
         return author_uuid_count
  
-    def metrics_model_enrich(self, repos_list, label):
-        item_datas = []
-        last_metrics_data = {}
-        for date in self.date_list:
-            print(date)
-            created_since = self.created_since(
-                date-timedelta(days=90), repos_list)
-            if created_since is None:
-                continue
-            commit_frequency_message = self.commit_frequency(date, repos_list)
-            LOC_frequency = self.LOC_frequency(date, repos_list)
-            lines_added_frequency = self.LOC_frequency(date, repos_list, 'lines_added')
-            lines_removed_frequency = self.LOC_frequency(date, repos_list, 'lines_removed')
-            git_pr_linked_ratio = self.git_pr_linked_ratio(date, repos_list)
-            code_merge_ratio, pr_count = self.code_merge_ratio(date, repos_list)
-            metrics_data = {
-                'uuid': uuid(str(date), self.community, self.level, label, self.model_name),
-                'level': self.level,
-                'label': label,
-                'model_name': self.model_name,
-                'contributor_count': self.contributor_count(date, repos_list),
-                'active_C2_contributor_count': self.active_C2_contributor_count(date, repos_list),
-                'active_C1_pr_create_contributor': self.active_C1_pr_create_contributor(date, repos_list),
-                'active_C1_pr_comments_contributor': self.active_C1_pr_comments_contributor(date, repos_list),                
-                'commit_frequency': commit_frequency_message[0],
-                'commit_frequency_inside': commit_frequency_message[1],
-                'is_maintained': round(self.is_maintained(date, repos_list), 4),
-                'LOC_frequency': LOC_frequency,
-                'lines_added_frequency': lines_added_frequency,
-                'lines_removed_frequency': lines_removed_frequency,
-                'pr_issue_linked_ratio': self.pr_issue_linked(date, repos_list),
-                'code_review_ratio': self.code_review_ratio(date, repos_list),
-                'code_merge_ratio': code_merge_ratio,
-                'pr_count': pr_count,
-                'pr_commit_count': git_pr_linked_ratio[0],
-                'pr_commit_linked_count': git_pr_linked_ratio[1],
-                'git_pr_linked_ratio': git_pr_linked_ratio[2],
-                'grimoire_creation_date': date.isoformat(),
-                'metadata__enriched_on': datetime_utcnow().isoformat()
-            }
-            self.cache_last_metrics_data(metrics_data, last_metrics_data)
-            score = code_quality_guarantee(code_quality_decay(metrics_data, last_metrics_data))
-            metrics_data["code_quality_guarantee"] = score
-            item_datas.append(metrics_data)
-            if len(item_datas) > MAX_BULK_UPDATE_SIZE:
-                self.es_out.bulk_upload(item_datas, "uuid")
-                item_datas = []
-        self.es_out.bulk_upload(item_datas, "uuid")
-        item_datas = []
+    def get_metrics_data(self, metrics, date, repos_list, label):
+        created_since = metrics.created_since(
+            date-self.created_since_delay, repos_list)
+        if created_since is None:
+            return None
+        commit_frequency_message = metrics.commit_frequency(date, repos_list)
+        LOC_frequency = metrics.LOC_frequency(date, repos_list)
+        lines_added_frequency = metrics.LOC_frequency(date, repos_list, 'lines_added')
+        lines_removed_frequency = metrics.LOC_frequency(date, repos_list, 'lines_removed')
+        git_pr_linked_ratio = metrics.git_pr_linked_ratio(date, repos_list)
+        code_merge_ratio, pr_count = metrics.code_merge_ratio(date, repos_list)
+        metrics_data = {
+            'uuid': uuid(str(date), self.community, self.level, label, self.model_name),
+            'level': self.level,
+            'label': label,
+            'model_name': self.model_name,
+            'contributor_count': metrics.contributor_count(date, repos_list),
+            'active_C2_contributor_count': metrics.active_C2_contributor_count(date, repos_list),
+            'active_C1_pr_create_contributor': metrics.active_C1_pr_create_contributor(date, repos_list),
+            'active_C1_pr_comments_contributor': metrics.active_C1_pr_comments_contributor(date, repos_list),
+            'commit_frequency': commit_frequency_message[0],
+            'commit_frequency_inside': commit_frequency_message[1],
+            'is_maintained': round(metrics.is_maintained(date, repos_list), 4),
+            'LOC_frequency': LOC_frequency,
+            'lines_added_frequency': lines_added_frequency,
+            'lines_removed_frequency': lines_removed_frequency,
+            'pr_issue_linked_ratio': metrics.pr_issue_linked(date, repos_list),
+            'code_review_ratio': metrics.code_review_ratio(date, repos_list),
+            'code_merge_ratio': code_merge_ratio,
+            'pr_count': pr_count,
+            'pr_commit_count': git_pr_linked_ratio[0],
+            'pr_commit_linked_count': git_pr_linked_ratio[1],
+            'git_pr_linked_ratio': git_pr_linked_ratio[2],
+            'grimoire_creation_date': date.isoformat(),
+            'metadata__enriched_on': datetime_utcnow().isoformat()
+        }
+        return metrics_data
+
+    def get_score(self, item, last_metrics_data):
+        return code_quality_guarantee(code_quality_decay(item, last_metrics_data))
+
+    def get_scores(self, items, last_metrics_data):
+        return code_quality_guarantee_scores(items, last_metrics_data)
 
     def cache_last_metrics_data(self, item, last_metrics_data):
         for i in ["code_merge_ratio",  "code_review_ratio", "pr_issue_linked_ratio"]:
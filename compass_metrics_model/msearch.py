@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import threading
+from elasticsearch.exceptions import HTTP_EXCEPTIONS, TransportError
+from .instrumentation import InstrumentedSearch
+
+MAX_MSEARCH_SIZE = 200
+# search kwargs carried by the body of a search in _msearch: {kwarg: body field}
+BODY_PARAMS = {
+    "size": "size",
+    "from_": "from",
+    "track_total_hits": "track_total_hits",
+    "terminate_after": "terminate_after",
+    "timeout": "timeout",
+    "explain": "explain",
+    "version": "version",
+    "track_scores": "track_scores",
+}
+# search kwargs carried by the header of a search in _msearch
+HEADER_PARAMS = ("search_type", "request_cache", "routing", "preference", "allow_no_indices",
+                 "expand_wildcards", "ignore_unavailable", "allow_partial_search_results")
+
+
+def index_name(index):
+    '''Index parameter of search as the comma separated string _msearch expects'''
+    if isinstance(index, (list, tuple)):
+        return ",".join(index)
+    return index
+
+
+def get_msearch_lines(index, body, kwargs):
+    '''(header, body) of a search in _msearch, None if kwargs has a parameter _msearch
+    cannot carry for each search, such as request_timeout or scroll'''
+    if any(name not in BODY_PARAMS and name not in HEADER_PARAMS for name in kwargs):
+        return None
+    header = {"index": index_name(index)}
+    body = dict(body or {})
+    for name, value in kwargs.items():
+        if value in ("true", "false"):
+            value = value == "true"
+        if name in BODY_PARAMS:
+            body[BODY_PARAMS[name]] = value
+        else:
+            header[name] = value
+    return header, body
+
+
+def get_response_error(response):
+    '''Exception es_in.search would have raised for a failed _msearch item'''
+    status = response.get("status", 500)
+    error = response.get("error", {})
+    error_type = error.get("type") if isinstance(error, dict) else error
+    return HTTP_EXCEPTIONS.get(status, TransportError)(status, error_type, response)
+
+
+class MsearchBatcher:
+    def __init__(self, es_client, max_searches=MAX_MSEARCH_SIZE):
+        """Stand-in for es_in shared by worker threads. A search blocks its worker
+        until every running worker is blocked too, then all pending searches are
+        sent together as one _msearch request. Search kwargs go to the body or the
+        header of the search, a search with kwargs _msearch cannot carry is sent on its own.
+        :param es_client: Elasticsearch client the batches are sent with.
+        :param max_searches: max number of searches in one _msearch request.
+        """
+        self.es_client = es_client
+        self.max_searches = max_searches
+        self.condition = threading.Condition()
+        self.pending = []
+        self.running = 0
+        self.requests = 0
+
+    def __getattr__(self, name):
+        if name == "es_client":
+            raise AttributeError(name)
+        return getattr(self.es_client, name)
+
+    def search(self, index=None, body=None, **kwargs):
+        lines = get_msearch_lines(index, body, kwargs)
+        if lines is None:
+            # sent on its own, the worker stays running while it waits
+            return self.es_client.search(index=index, body=body, **kwargs)
+        request = {"header": lines[0], "body": lines[1], "done": False}
+        with self.condition:
+            self.pending.append(request)
+            self.running -= 1
+            if self.running == 0:
+                self.flush()
+            while not request["done"]:
+                self.condition.wait()
+        if "error" in request:
+            raise request["error"]
+        return request["response"]
+
+    def flush(self):
+        '''Send the pending searches, called with the condition held by the last running worker'''
+        batch, self.pending = self.pending, []
+        for start in range(0, len(batch), self.max_searches):
+            requests = batch[start:start + self.max_searches]
+            lines = []
+            for request in requests:
+                lines.append(request["header"])
+                lines.append(request["body"])
+            try:
+                responses = self.es_client.msearch(body=lines)["responses"]
+                self.requests += 1
+            except Exception as e:
+                responses = [e] * len(requests)
+            for request, response in zip(requests, responses):
+                if isinstance(response, Exception):
+                    request["error"] = response
+                elif "error" in response:
+                    request["error"] = get_response_error(response)
+                else:
+                    request["response"] = response
+                request["done"] = True
+        self.running += len(batch)
+        self.condition.notify_all()
+
+    def run(self, functions):
+        '''Call every function in its own worker thread, return their results in order'''
+        results = [None] * len(functions)
+        errors = [None] * len(functions)
+
+        def work(i, function):
+            try:
+                results[i] = function()
+            except Exception as e:
+                errors[i] = e
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    if self.running == 0 and self.pending:
+                        self.flush()
+
+        with self.condition:
+            self.running += len(functions)
+        threads = [threading.Thread(target=work, args=(i, function), daemon=True)
+                   for i, function in enumerate(functions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+
+def msearch_metrics_data(model, metrics, date_list, repos_list, label, block_size):
+    '''Metrics data of date_list in date order, block_size dates share each _msearch'''
+    es_in = model.es_in
+    if isinstance(es_in, InstrumentedSearch):
+        # each search is recorded under the tag of its metric, its latency being the
+        # time it waited for its batch
+        batcher = MsearchBatcher(es_in.es_client)
+        batched = InstrumentedSearch(batcher, es_in.query_stats)
+    else:
+        batched = batcher = MsearchBatcher(es_in)
+    for start in range(0, len(date_list), block_size):
+        dates = date_list[start:start + block_size]
+        print(dates[0], "-", dates[-1])
+        model.es_in = batched
+        try:
+            metrics_data_list = batcher.run([
+                lambda date=date: model.get_metrics_data(metrics, date, repos_list, label) for date in dates])
+        finally:
+            model.es_in = es_in
+        for date, metrics_data in zip(dates, metrics_data_list):
+            yield date, metrics_data
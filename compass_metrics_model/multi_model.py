@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from .derived_fields import enrich_derived_fields
+from .instrumentation import TaggedMetrics, query_tag
+from .cassette import close_cassette_recorder
+from .metrics_model import run_cleanups
+
+
+class SharedMetrics:
+    def __init__(self, metrics, model, values):
+        """Metrics source of model answering its shared_metrics from values, the
+        results already computed for the label by the other models.
+        :param metrics: metrics source of the model, see get_metrics_source.
+        :param model: model the metrics are computed for.
+        :param values: {(metric, indexes, date, repos, args): result} of the label.
+        """
+        self.metrics = metrics
+        self.model = model
+        self.values = values
+
+    def __getattr__(self, name):
+        method = getattr(self.metrics, name)
+        if name not in self.model.shared_metrics:
+            return method
+        indexes = tuple(getattr(self.model, attr) for attr in self.model.shared_metrics[name])
+
+        def shared(date, repos_list, *args):
+            key = (name, indexes, date, tuple(repos_list)) + args
+            if key not in self.values:
+                self.values[key] = method(date, repos_list, *args)
+            return self.values[key]
+        return shared
+
+
+class MultiModelRunner:
+    def __init__(self, models):
+        """Enrich several models in one pass over the labels and dates. The models share
+        their input client, and so the query cache and query stats of the first model, and
+        every metric listed in the shared_metrics of more than one model is computed once
+        per label and date.
+        Dates are evaluated one after another in this process, the msearch_dates,
+        async_concurrency and processes options of the models are not used.
+        :param models: models of the same level and json_file, each written to its out_index.
+        """
+        if len({(model.level, model.json_file) for model in models}) > 1:
+            raise ValueError("models of a MultiModelRunner must have the same level and json_file")
+        self.models = models
+
+    def run(self, elastic_url):
+        for model in self.models:
+            model.elastic_url = elastic_url
+        es_in = self.models[0].get_es_in(elastic_url)
+        for model in self.models:
+            model.es_in = es_in
+            model.es_out = model.get_es_out(elastic_url)
+        try:
+            for model in self.models:
+                model.prepare_run()
+            field_indexes = {}
+            for model in self.models:
+                if model.derived_fields:
+                    field_indexes.update({field: getattr(model, index)
+                                          for field, index in model.derived_field_indexes.items()})
+            if field_indexes:
+                with query_tag("derived_fields"):
+                    enrich_derived_fields(es_in, field_indexes)
+            for repos_list, label in self.models[0].get_repos_labels():
+                self.enrich(repos_list, label)
+        except BaseException:
+            run_cleanups(self.get_run_cleanups(), failed=True)
+            raise
+        run_cleanups(self.get_run_cleanups())
+
+    def get_run_cleanups(self):
+        '''Steps closing what the run opened, the search stats are those of the shared es_in'''
+        cleanups = []
+        for model in self.models:
+            if model.bulk_writer:
+                cleanups.append(model.es_out.close)
+            if model.record_cassette:
+                cleanups.append(lambda path=model.record_cassette: close_cassette_recorder(path))
+        if self.models[0].search_stats:
+            cleanups.append(self.models[0].search_stats.write)
+        return cleanups
+
+    def enrich(self, repos_list, label):
+        '''Compute and write the metrics of repos_list of every model'''
+        values = {}
+        last_metrics_data = {}
+        metrics = {}
+        dates = {}
+        for model in self.models:
+            last_metrics_data[model] = model.restore_metrics_data(label)
+            with query_tag("prepare_enrich"):
+                model.prepare_enrich(repos_list)
+            with query_tag("get_metrics_source"):
+                metrics[model] = SharedMetrics(model.get_metrics_source(repos_list), model, values)
+            if self.models[0].search_stats:
+                metrics[model] = TaggedMetrics(metrics[model])
+            dates[model] = set(model.get_enrich_dates(repos_list, label))
+        metrics_data_lists = {model: [] for model in self.models}
+        for date in sorted(set().union(*dates.values())):
+            print(date)
+            for model in self.models:
+                if date in dates[model]:
+                    metrics_data_lists[model].append(
+                        (date, model.get_metrics_data(metrics[model], date, repos_list, label)))
+        for model in self.models:
+            model.write_metrics_data(metrics_data_lists[model], last_metrics_data[model])
+            model.finish_enrich(repos_list)
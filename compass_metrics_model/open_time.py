@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+# Painless helpers of the open time runtime fields. Durations are taken between
+# wall-clock times and rounded to 2 decimals, like get_time_diff_days does.
+OPEN_TIME_FUNCTIONS = """
+boolean present(def value) {
+    return value != null && value != '';
+}
+LocalDateTime wall(String value) {
+    try {
+        return ZonedDateTime.parse(value).toLocalDateTime();
+    } catch (Exception e) {
+        return LocalDateTime.parse(value);
+    }
+}
+long millis(String value) {
+    try {
+        return ZonedDateTime.parse(value).toInstant().toEpochMilli();
+    } catch (Exception e) {
+        return LocalDateTime.parse(value).toInstant(ZoneOffset.UTC).toEpochMilli();
+    }
+}
+double days(String start, LocalDateTime end) {
+    double diff = ChronoUnit.MILLIS.between(wall(start), end) / 1000.0 / 86400.0;
+    return Math.round(diff * 100) / 100.0;
+}
+"""
+
+ISSUE_OPEN_TIME_SCRIPT = OPEN_TIME_FUNCTIONS + """
+def src = params._source;
+LocalDateTime date = LocalDateTime.parse(params.date);
+if (src.containsKey('state')) {
+    if (present(src['closed_at'])) {
+        if ((src['state'] == 'closed' || src['state'] == 'rejected') && millis(src['closed_at']) < params.date_millis) {
+            emit(days(src['created_at'], wall(src['closed_at'])));
+        }
+    } else {
+        emit(days(src['created_at'], date));
+    }
+}
+"""
+
+BUG_ISSUE_OPEN_TIME_SCRIPT = OPEN_TIME_FUNCTIONS + """
+def src = params._source;
+LocalDateTime date = LocalDateTime.parse(params.date);
+if (src.containsKey('state')) {
+    if (present(src['closed_at']) && (src['state'] == 'closed' || src['state'] == 'rejected')
+            && millis(src['closed_at']) < params.date_millis) {
+        emit(days(src['created_at'], wall(src['closed_at'])));
+    } else {
+        emit(days(src['created_at'], date));
+    }
+}
+"""
+
+# A merged PR emits its merge time and its open time so far, as pr_open_time counts both
+PR_OPEN_TIME_SCRIPT = OPEN_TIME_FUNCTIONS + """
+def src = params._source;
+LocalDateTime date = LocalDateTime.parse(params.date);
+if (src.containsKey('state')) {
+    if (src['state'] == 'merged' && present(src['merged_at']) && millis(src['merged_at']) < params.date_millis) {
+        emit(days(src['created_at'], wall(src['merged_at'])));
+    }
+    String closed = present(src['closed_at']) ? src['closed_at'] : src['updated_at'];
+    if (src['state'] == 'closed' && millis(closed) < params.date_millis) {
+        emit(days(src['created_at'], wall(closed)));
+    } else {
+        emit(days(src['created_at'], date));
+    }
+}
+"""
+
+
+def get_open_time_query(query, script, date):
+    '''query with its hits replaced by the avg and median of the durations emitted by script'''
+    query["size"] = 0
+    query["runtime_mappings"] = {
+        "open_time_days": {
+            "type": "double",
+            "script": {
+                "source": script,
+                "params": {
+                    "date": date.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "date_millis": int(date.timestamp() * 1000)
+                }
+            }
+        }
+    }
+    query["aggs"] = {
+        "open_time_avg": {"avg": {"field": "open_time_days"}},
+        "open_time_mid": {"percentiles": {"field": "open_time_days", "percents": [50]}}
+    }
+    return query
+
+
+def get_open_time(response):
+    '''(avg, median) of an open time query response, (None, None) without durations'''
+    aggregations = response["aggregations"]
+    if aggregations["open_time_avg"]["value"] is None:
+        return None, None
+    return aggregations["open_time_avg"]["value"], aggregations["open_time_mid"]["values"]["50.0"]
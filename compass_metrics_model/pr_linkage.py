@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from grimoirelab_toolkit.datetime import datetime_utcnow, str_to_datetime
+from perceval.backend import uuid
+from .repo_filter import get_repos_should
+
+SCAN_SIZE = 5000
+BULK_SIZE = 500
+# Strings of the linkage index are keywords, pr_tags is matched by prefix
+LINKAGE_MAPPINGS = {"dynamic_templates": [
+    {"strings": {"match_mapping_type": "string", "mapping": {"type": "keyword"}}}]}
+
+
+def get_repos_query(repos_list, field="tag", enriched_after=None, repos_should=get_repos_should):
+    '''Docs whose field starts with a repo of repos_list, enriched after enriched_after if given'''
+    query = {
+        "query": {
+            "bool": {
+                "should": repos_should(repos_list, "{}*", field),
+                "minimum_should_match": 1
+            }
+        }
+    }
+    if enriched_after:
+        query["query"]["bool"]["filter"] = {"range": {"metadata__enriched_on": {"gt": enriched_after}}}
+    return query
+
+
+class CommitPrLinkage:
+    def __init__(self, pr_index, linkage_index=None):
+        """Tags of the PRs listing each commit hash in their commits_data, streamed once
+        from pr_index so that linked commits are found by set membership.
+        :param pr_index: enriched pull request index.
+        :param linkage_index: index the hash to PR tags mapping is stored in and
+            incrementally updated from. None to stream it on every run.
+        """
+        self.pr_index = pr_index
+        self.linkage_index = linkage_index
+        self.hash_tags = {}
+        self.enriched_until = {}
+
+    def refresh(self, es_in, es_client, repos_list, repos_should=get_repos_should):
+        '''Load the linked commits of the PRs of repos_list, streaming only PRs enriched since they were stored.
+        The stored linkage is read and written with es_client, never a cache.
+        repos_should(repos_list, pattern, field) builds the repo clauses, see MetricsModel.get_repos_should'''
+        started = datetime_utcnow().isoformat()
+        if self.linkage_index:
+            self.read_stored(es_client, repos_list, repos_should)
+        enriched_after = None
+        if all(repo in self.enriched_until for repo in repos_list):
+            enriched_after = min(self.enriched_until[repo] or "1970-01-01" for repo in repos_list)
+        query = get_repos_query(repos_list, enriched_after=enriched_after, repos_should=repos_should)
+        query["_source"] = ["tag", "commits_data", "metadata__enriched_on"]
+        changed = set()
+        newest = {repo: self.enriched_until.get(repo) for repo in repos_list}
+        for hit in helpers.scan(es_in, query=query, index=self.pr_index, size=SCAN_SIZE):
+            source = hit["_source"]
+            commits = source.get("commits_data") or []
+            for commit_hash in commits if isinstance(commits, list) else [commits]:
+                tags = self.hash_tags.setdefault(commit_hash, set())
+                if source["tag"] not in tags:
+                    tags.add(source["tag"])
+                    changed.add(commit_hash)
+            enriched_on = source.get("metadata__enriched_on")
+            for repo in repos_list:
+                if enriched_on and source["tag"].startswith(repo) and (
+                        newest[repo] is None or str_to_datetime(enriched_on) > str_to_datetime(newest[repo])):
+                    newest[repo] = enriched_on
+        for repo in repos_list:
+            # repos without PRs are not scanned again before new PRs are enriched
+            if newest[repo] is None:
+                newest[repo] = started
+        self.enriched_until.update(newest)
+        if self.linkage_index:
+            now = datetime_utcnow().isoformat()
+            items = [{"uuid": uuid(commit_hash), "hash": commit_hash, "pr_tags": sorted(self.hash_tags[commit_hash]),
+                      "metadata__enriched_on": now} for commit_hash in changed]
+            items += [{"uuid": uuid(self.pr_index, repo), "repo": repo, "enriched_until": newest[repo],
+                       "metadata__enriched_on": now} for repo in repos_list]
+            self.store(es_client, items)
+
+    def store(self, es_client, items):
+        if not es_client.indices.exists(index=self.linkage_index):
+            es_client.indices.create(index=self.linkage_index, body={"mappings": LINKAGE_MAPPINGS})
+        actions = ({"_index": self.linkage_index, "_id": item["uuid"], "_source": item} for item in items)
+        helpers.bulk(es_client, actions, chunk_size=BULK_SIZE)
+        es_client.indices.refresh(index=self.linkage_index)
+
+    def read_stored(self, es_client, repos_list, repos_should=get_repos_should):
+        missing = [repo for repo in repos_list if repo not in self.enriched_until]
+        if not missing:
+            return
+        query = {"size": len(missing), "query": {"terms": {"uuid": [uuid(self.pr_index, repo) for repo in missing]}}}
+        try:
+            hits = es_client.search(index=self.linkage_index, body=query)["hits"]["hits"]
+        except NotFoundError:
+            return
+        for hit in hits:
+            self.enriched_until[hit["_source"]["repo"]] = hit["_source"]["enriched_until"]
+        stored = [hit["_source"]["repo"] for hit in hits]
+        if not stored:
+            return
+        query = get_repos_query(stored, field="pr_tags", repos_should=repos_should)
+        query["_source"] = ["hash", "pr_tags"]
+        for hit in helpers.scan(es_client, query=query, index=self.linkage_index, size=SCAN_SIZE):
+            self.hash_tags.setdefault(hit["_source"]["hash"], set()).update(hit["_source"]["pr_tags"])
+
+    def is_linked(self, commit_hash, repos_list):
+        '''Whether a PR of repos_list lists commit_hash in its commits_data'''
+        return any(tag.startswith(tuple(repos_list)) for tag in self.hash_tags.get(commit_hash, ()))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from .instrumentation import query_tag
+
+# Dates in a work unit when chunk_dates is not given, about half a year
+CHUNK_DATES = 26
+
+# Model of the worker process, connected by init_worker
+worker_model = None
+# date_list of the run, the model's own is replaced by the dates of each chunk
+worker_dates = None
+# Label the worker model is prepared for, see prepare_label
+worker_label = None
+
+
+def init_worker(model):
+    '''Give the worker process its own copy of the model and its own clients'''
+    global worker_model, worker_dates
+    worker_model = model
+    worker_model.es_in = worker_model.get_es_in(worker_model.elastic_url)
+    worker_dates = model.date_list
+
+
+def prepare_label(repos_list, label):
+    '''prepare_enrich the worker model for label on the first chunk of label, dropping what
+    was kept for the previous label. Chunks are taken in submission order, so the worker
+    gets no chunk of the previous label once it has one of the next.'''
+    global worker_label
+    if worker_label is not None and worker_label[1] == label:
+        return
+    model = worker_model
+    if worker_label is not None:
+        model.finish_enrich(worker_label[0])
+    worker_label = None
+    model.date_list = worker_dates
+    with query_tag("prepare_enrich"):
+        model.prepare_enrich(repos_list)
+    worker_label = (repos_list, label)
+
+
+def compute_chunk(repos_list, label, date_list):
+    '''Unscored (date, metrics data) pairs of repos_list for the dates of one work unit,
+    and the query stats of the work unit if the model records them'''
+    model = worker_model
+    prepare_label(repos_list, label)
+    model.date_list = date_list
+    with query_tag("get_metrics_source"):
+        metrics = model.get_metrics_source(repos_list)
+    metrics_data_list = list(model.iter_metrics_data(metrics, repos_list, label))
+    return metrics_data_list, model.search_stats.pop() if model.search_stats else None
+
+
+def process_pool_enrich(model, repos_labels, processes, chunk_dates=None):
+    '''Enrich every (repos_list, label) with a pool of worker processes.
+
+    Each label's dates after its stored rows are split into chunks of chunk_dates dates.
+    Workers prepare a label on its first chunk and only compute the metrics of a chunk,
+    the dates the label is not computed for are dropped there. Decay and scoring happen
+    here, label by label and in date order, so last_metrics_data goes through exactly
+    the same states as in a sequential run and chunks need no warm-up dates.
+    '''
+    chunk_dates = chunk_dates or CHUNK_DATES
+    with ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(model,)) as executor:
+        label_futures = []
+        for repos_list, label in repos_labels:
+            last_metrics_data = model.restore_metrics_data(label)
+            date_list = model.get_resume_dates(label)
+            label_futures.append((last_metrics_data, [
+                executor.submit(compute_chunk, repos_list, label, date_list[start:start + chunk_dates])
+                for start in range(0, len(date_list), chunk_dates)]))
+        for last_metrics_data, futures in label_futures:
+            model.write_metrics_data(itertools.chain.from_iterable(
+                get_chunk_result(model, future) for future in futures), last_metrics_data)
+
+
+def get_chunk_result(model, future):
+    '''Metrics data of a work unit, its query stats are added to those of model'''
+    metrics_data_list, query_stats = future.result()
+    if query_stats:
+        model.search_stats.merge(query_stats)
+    return metrics_data_list
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from urllib.parse import urlparse
+from elasticsearch.exceptions import NotFoundError
+from grimoirelab_toolkit.datetime import str_to_datetime
+
+MAX_ENTRIES = 10000
+MAX_DISK_BYTES = 1024 * 1024 * 1024
+TTL = 24 * 60 * 60
+# Date field set when a doc is enriched, its max and the doc count give the ingest state of an index
+ENRICHED_FIELD = "metadata__enriched_on"
+# Ingest state of an index that could not be read, such as in a replay recorded without the cache
+UNKNOWN_STATE = "unknown"
+
+# Caches of the running process, shared by every model with the same settings
+query_caches = {}
+
+
+def get_query_cache(max_entries=MAX_ENTRIES, cache_dir=None, max_disk_bytes=MAX_DISK_BYTES, ttl=TTL):
+    '''QueryCache of this process for the given settings'''
+    key = (max_entries, cache_dir, max_disk_bytes, ttl)
+    if key not in query_caches:
+        query_caches[key] = QueryCache(max_entries, cache_dir, max_disk_bytes, ttl)
+    return query_caches[key]
+
+
+def index_tuple(index):
+    '''Index parameter of search as a tuple of index names'''
+    if isinstance(index, (list, tuple)):
+        return tuple(index)
+    return tuple(str(index).split(","))
+
+
+def get_cluster(elastic_url):
+    '''scheme://host:port of elastic_url, without its credentials'''
+    if not elastic_url:
+        return None
+    url = urlparse(elastic_url)
+    return "{}://{}:{}".format(url.scheme, url.hostname, url.port or (443 if url.scheme == "https" else 9200))
+
+
+def get_cache_key(index, body, kwargs, cluster=None, ingest_state=None):
+    '''Hash of the cluster, the indexes and their ingest state, and the canonical json of the search'''
+    canonical = json.dumps([cluster, index_tuple(index), ingest_state, body, kwargs],
+                           sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_window_ends(query, ends=None):
+    '''{field: end of window} of the range clauses of query, None for an open range'''
+    ends = {} if ends is None else ends
+    if isinstance(query, dict):
+        for key, value in query.items():
+            if key == "range" and isinstance(value, dict):
+                for field, condition in value.items():
+                    end = None
+                    if condition.get("lt"):
+                        end = str_to_datetime(str(condition["lt"]))
+                    elif condition.get("lte"):
+                        end = str_to_datetime(str(condition["lte"]))
+                        if len(str(condition["lte"])) <= len("YYYY-MM-DD"):
+                            end += timedelta(days=1)
+                    if field in ends and (end is None or ends[field] is None):
+                        ends[field] = None
+                    else:
+                        ends[field] = max(end, ends.get(field, end)) if end else None
+            else:
+                get_window_ends(value, ends)
+    elif isinstance(query, list):
+        for item in query:
+            get_window_ends(item, ends)
+    return ends
+
+
+class QueryCache:
+    def __init__(self, max_entries=MAX_ENTRIES, cache_dir=None, max_disk_bytes=MAX_DISK_BYTES, ttl=TTL):
+        """Search responses by cache key, an LRU of max_entries responses in memory and
+        optionally a directory of up to max_disk_bytes shared with other processes and runs.
+        :param max_entries: max number of responses kept in memory.
+        :param cache_dir: directory of the on-disk tier. None to only cache in memory.
+        :param max_disk_bytes: size cap of cache_dir, least recently used files are removed first.
+        :param ttl: seconds a response is valid, unless it is stored as permanent.
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.files = OrderedDict()
+        self.disk_bytes = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            paths = [os.path.join(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".json")]
+            for path in sorted(paths, key=os.path.getmtime):
+                self.files[path] = os.path.getsize(path)
+                self.disk_bytes += self.files[path]
+
+    def get(self, key):
+        '''Cached response json of key, None if missing or expired'''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] is None or entry[0] > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+        entry = self.read_file(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.remember(key, entry)
+        return entry[1]
+
+    def put(self, key, response_json, permanent=False):
+        entry = (None if permanent else time.time() + self.ttl, response_json)
+        with self.lock:
+            self.remember(key, entry)
+        self.write_file(key, entry)
+
+    def remember(self, key, entry):
+        '''Add entry to the memory tier, called with the lock held'''
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def file_path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def read_file(self, key):
+        if not self.cache_dir:
+            return None
+        path = self.file_path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stored["expires"] is not None and stored["expires"] <= time.time():
+            self.remove_file(path)
+            return None
+        os.utime(path)
+        with self.lock:
+            if path in self.files:
+                self.files.move_to_end(path)
+        return stored["expires"], stored["response"]
+
+    def write_file(self, key, entry):
+        if not self.cache_dir:
+            return
+        path = self.file_path(key)
+        tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"expires": entry[0], "response": entry[1]}, f)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.disk_bytes += os.path.getsize(path) - self.files.pop(path, 0)
+            self.files[path] = os.path.getsize(path)
+            evicted = []
+            while self.disk_bytes > self.max_disk_bytes and len(self.files) > 1:
+                old_path, size = self.files.popitem(last=False)
+                self.disk_bytes -= size
+                evicted.append(old_path)
+        for old_path in evicted:
+            self.remove_file(old_path)
+
+    def remove_file(self, path):
+        with self.lock:
+            self.disk_bytes -= self.files.pop(path, 0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class CachedSearch:
+    def __init__(self, es_client, query_cache, elastic_url=None):
+        """Stand-in for es_in answering repeated searches from query_cache. Responses are
+        keyed by the ingest state of their indexes, the doc count and newest
+        metadata__enriched_on read once by this client, so a repo ingested or docs enriched
+        again since a response was cached miss it. Responses of windows that end before the
+        newest data of their indexes never expire, they stay valid until the ingest state changes.
+        :param es_client: client the searches missing from the cache are sent with.
+        :param query_cache: QueryCache the responses are kept in.
+        :param elastic_url: url of the cluster of es_client, the responses of other
+            clusters in query_cache are not used.
+        """
+        self.es_client = es_client
+        self.query_cache = query_cache
+        self.cluster = get_cluster(elastic_url)
+        self.lock = threading.Lock()
+        self.ingest_states = {}
+        self.newest = {}
+
+    def __getattr__(self, name):
+        if name == "es_client":
+            raise AttributeError(name)
+        return getattr(self.es_client, name)
+
+    def get_key(self, index, body, kwargs):
+        '''Cache key of the search, None if the ingest state of its indexes could not be read'''
+        ingest_state = self.get_ingest_state(index)
+        if ingest_state is UNKNOWN_STATE:
+            return None
+        return get_cache_key(index, body, kwargs, self.cluster, ingest_state)
+
+    def search(self, index=None, body=None, **kwargs):
+        key = None if "scroll" in kwargs else self.get_key(index, body, kwargs)
+        if key is None:
+            return self.es_client.search(index=index, body=body, **kwargs)
+        response_json = self.query_cache.get(key)
+        if response_json is not None:
+            return json.loads(response_json)
+        response = self.es_client.search(index=index, body=body, **kwargs)
+        self.query_cache.put(key, json.dumps(response), self.is_permanent(index, body))
+        return response
+
+    def msearch(self, body, index=None, **kwargs):
+        '''_msearch sending only the searches missing from the cache'''
+        lines = body if isinstance(body, list) else [json.loads(line) for line in body.splitlines() if line.strip()]
+        searches = [(header.get("index", index), query) for header, query in zip(lines[0::2], lines[1::2])]
+        keys = [self.get_key(search_index, query, {}) for search_index, query in searches]
+        responses = []
+        for key in keys:
+            response_json = None if key is None else self.query_cache.get(key)
+            responses.append(None if response_json is None else json.loads(response_json))
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            missing_lines = []
+            for i in missing:
+                missing_lines += [lines[2 * i], lines[2 * i + 1]]
+            result = self.es_client.msearch(body=missing_lines, index=index, **kwargs)
+            for i, response in zip(missing, result["responses"]):
+                responses[i] = response
+                if "error" not in response and keys[i] is not None:
+                    self.query_cache.put(keys[i], json.dumps(response), self.is_permanent(*searches[i]))
+        return {"responses": responses}
+
+    def get_ingest_state(self, index):
+        '''[doc count, newest metadata__enriched_on] of index, None if it does not exist,
+        UNKNOWN_STATE if it could not be read'''
+        key = index_tuple(index)
+        with self.lock:
+            if key in self.ingest_states:
+                return self.ingest_states[key]
+        query = {"size": 0, "track_total_hits": True, "aggs": {"enriched": {"max": {"field": ENRICHED_FIELD}}}}
+        try:
+            response = self.es_client.search(index=index, body=query)
+            total = response["hits"]["total"]
+            state = [total["value"] if isinstance(total, dict) else total,
+                     response["aggregations"]["enriched"].get("value")]
+        except NotFoundError:
+            state = None
+        except Exception:
+            # the searches of index are sent uncached
+            state = UNKNOWN_STATE
+        with self.lock:
+            self.ingest_states[key] = state
+        return state
+
+    def get_newest(self, index, field):
+        '''Newest value of the date field in index, None if it has none'''
+        key = (index_tuple(index), field)
+        with self.lock:
+            if key in self.newest:
+                return self.newest[key]
+        query = {"size": 0, "aggs": {"newest": {"max": {"field": field}}}}
+        newest = self.es_client.search(index=index, body=query)["aggregations"]["newest"]
+        newest = str_to_datetime(newest["value_as_string"]) if newest.get("value_as_string") else None
+        with self.lock:
+            self.newest[key] = newest
+        return newest
+
+    def is_permanent(self, index, body):
+        '''Whether every range of the search ends before the newest data of its field'''
+        ends = get_window_ends((body or {}).get("query"))
+        if not ends:
+            return False
+        try:
+            for field, end in ends.items():
+                newest = self.get_newest(index, field)
+                if end is None or newest is None or end > newest:
+                    return False
+        except Exception:
+            return False
+        return True
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from perceval.backend import uuid
+
+MSEARCH_SIZE = 200
+IDS_SIZE = 10000
+BULK_SIZE = 5000
+
+
+def newest_message(repo_url):
+    query = {
+        "size": 1,
+        "query": {
+            "match": {
+                "tag": repo_url
+            }
+        },
+        "sort": [
+            {
+                "metadata__updated_on": {"order": "desc"}
+            }
+        ],
+        "_source": ["releases"]
+    }
+    return query
+
+
+def get_release_item(repo_url, item):
+    '''Release doc of one release of the repo doc of repo_url'''
+    return {
+        "uuid": uuid(str(item["id"])),
+        "id": item["id"],
+        "tag": repo_url,
+        "tag_name": item["tag_name"],
+        "target_commitish": item["target_commitish"],
+        "prerelease": item["prerelease"],
+        "name": item["name"],
+        "body": item["body"],
+        "author_login": item["author"]["login"],
+        "author_name": item["author"]["name"],
+        "grimoire_creation_date": item["created_at"]
+    }
+
+
+def is_stored(item, stored):
+    '''Whether stored, the doc of release_index with the uuid of item, has its fields'''
+    return stored is not None and all(stored.get(field) == value for field, value in item.items())
+
+
+class ReleaseIngester:
+    def __init__(self, repo_index, release_index):
+        """Copy the releases listed by the newest repo doc of each repo to release_index.
+        The repo docs are fetched with _msearch and only the releases missing from
+        release_index or stored with other fields are written. Each repo is ingested once
+        by the ingester, a model creates one per run so the labels sharing repos do not
+        repeat the work and every run sees the releases listed since the previous one.
+        :param repo_index: enriched repo index, its docs list the releases of the repo.
+        :param release_index: index the release docs are written to.
+        """
+        self.repo_index = repo_index
+        self.release_index = release_index
+        self.ingested = set()
+
+    def ingest(self, es_client, repos_list):
+        '''Write the new and changed releases of the repos of repos_list not ingested yet, the
+        number of docs written. es_client must not be cached, the newest repo docs are read with it.'''
+        repos = [repo for repo in dict.fromkeys(repos_list) if repo not in self.ingested]
+        if not repos:
+            return 0
+        items = []
+        for start in range(0, len(repos), MSEARCH_SIZE):
+            items += self.get_release_items(es_client, repos[start:start + MSEARCH_SIZE])
+        stored = self.get_stored_items(es_client, [item["uuid"] for item in items])
+        actions = [{"_index": self.release_index, "_id": item["uuid"], "_source": item}
+                   for item in items if not is_stored(item, stored.get(item["uuid"]))]
+        if actions:
+            helpers.bulk(client=es_client, actions=actions, chunk_size=BULK_SIZE)
+        self.ingested.update(repos)
+        return len(actions)
+
+    def get_release_items(self, es_client, repos):
+        body = []
+        for repo_url in repos:
+            body += [{"index": self.repo_index}, newest_message(repo_url)]
+        items = []
+        responses = es_client.msearch(body=body)["responses"]
+        for repo_url, response in zip(repos, responses):
+            query_hits = response.get("hits", {}).get("hits", [])
+            if len(query_hits) > 0 and query_hits[0]["_source"].get("releases"):
+                items += [get_release_item(repo_url, item) for item in query_hits[0]["_source"]["releases"]]
+        return items
+
+    def get_stored_items(self, es_client, uuids):
+        '''{uuid: stored release doc} of the uuids found in release_index'''
+        stored = {}
+        for start in range(0, len(uuids), IDS_SIZE):
+            values = uuids[start:start + IDS_SIZE]
+            query = {"size": len(values), "query": {"ids": {"values": values}}}
+            try:
+                hits = es_client.search(index=self.release_index, body=query)["hits"]["hits"]
+            except NotFoundError:
+                return stored
+            stored.update((hit["_id"], hit["_source"]) for hit in hits)
+        return stored
+
+
+def create_release_index(es_client, all_repo, repo_index, release_index):
+    return ReleaseIngester(repo_index, release_index).ingest(es_client, all_repo)
+
+
+if __name__ == '__main__':
+    import yaml
+    from .metrics_model import get_all_repo
+    from elasticsearch import Elasticsearch, RequestsHttpConnection
+    CONF = yaml.safe_load(open('../conf.yaml'))
+    params = CONF['params']
+    es_client = Elasticsearch(CONF['url'], verify_certs=False, connection_class=RequestsHttpConnection)
+    all_repo = get_all_repo(params['json_file'], params['issue_index'])
+    print(create_release_index(es_client, all_repo, params['repo_index'], params['release_index']))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+from elasticsearch.exceptions import NotFoundError
+from perceval.backend import uuid
+
+COMPOSITE_SIZE = 10000
+# Tag sets larger than this are stored in repo_set_index and referenced by terms
+# lookup, the smaller ones are inlined in the terms filter
+LOOKUP_MIN_TAGS = 100
+
+
+def get_repos_should(repos_list, pattern="{}*", field="tag"):
+    '''One simple_query_string per repo, pattern.format(repo) being its query'''
+    return [{"simple_query_string": {"query": pattern.format(i), "fields": [field]}} for i in repos_list]
+
+
+class RepoSetFilter:
+    def __init__(self, repo_set_index=None):
+        """Compile the repo clauses of the query builders to one terms filter on exact
+        tag values. The tags of each index are listed once per run, and a repo + "*"
+        pattern matches the listed tags starting with the repo, as the wildcard did, which
+        covers the .git tags of the git index and the tags of the comment indexes.
+        :param repo_set_index: index the tag sets of more than LOOKUP_MIN_TAGS tags are
+            stored in and referenced by terms lookup. None to always inline the tags.
+        """
+        self.repo_set_index = repo_set_index
+        self.reset()
+
+    def reset(self):
+        '''Forget the tags listed so far, called when a run starts so new repos are matched'''
+        self.index_tags = {}
+        self.resolved = {}
+        self.stored = set()
+
+    def get_clause(self, es_client, indexes, repos_list, pattern="{}*", field="tag"):
+        '''terms filter on field matching the docs the pattern of each repo of repos_list matches'''
+        tags = self.resolve(es_client, indexes, repos_list, pattern)
+        if self.repo_set_index and len(tags) > LOOKUP_MIN_TAGS:
+            return {"terms": {field: {"index": self.repo_set_index, "id": self.store(es_client, tags), "path": "tags"}}}
+        return {"terms": {field: tags}}
+
+    def resolve(self, es_client, indexes, repos_list, pattern="{}*"):
+        '''Sorted exact tags matched by pattern.format(repo) for the repos of repos_list.
+        The clauses of the pattern are OR'ed: "repo*" matches the tags of indexes starting
+        with repo, "repo(*)" and "repo" match the tag repo itself.'''
+        key = (tuple(indexes), tuple(repos_list), pattern)
+        if key not in self.resolved:
+            tags, prefixes = set(), []
+            for clause in pattern.split(" OR "):
+                clause = clause.strip()
+                if clause.endswith("(*)"):
+                    tags.update(clause[:-3].format(i) for i in repos_list)
+                elif clause.endswith("*"):
+                    prefixes += [clause[:-1].format(i) for i in repos_list]
+                else:
+                    tags.update(clause.format(i) for i in repos_list)
+            if prefixes:
+                for index in indexes:
+                    tags.update(tag for tag in self.get_tags(es_client, index) if tag.startswith(tuple(prefixes)))
+            self.resolved[key] = sorted(tags)
+        return self.resolved[key]
+
+    def get_tags(self, es_client, index):
+        '''Every tag of index, from one paged composite aggregation on first use'''
+        if index not in self.index_tags:
+            query = {"size": 0, "aggs": {"tags": {"composite": {
+                "size": COMPOSITE_SIZE, "sources": [{"tag": {"terms": {"field": "tag"}}}]}}}}
+            tags = []
+            try:
+                while True:
+                    composite = es_client.search(index=index, body=query)["aggregations"]["tags"]
+                    tags += [bucket["key"]["tag"] for bucket in composite["buckets"]]
+                    if len(composite["buckets"]) < COMPOSITE_SIZE or "after_key" not in composite:
+                        break
+                    query["aggs"]["tags"]["composite"]["after"] = composite["after_key"]
+            except NotFoundError:
+                pass
+            self.index_tags[index] = tags
+        return self.index_tags[index]
+
+    def store(self, es_client, tags):
+        '''Id of the repo_set_index doc listing tags, written on first use'''
+        set_id = uuid(*tags)
+        if set_id not in self.stored:
+            if not es_client.indices.exists(index=self.repo_set_index):
+                es_client.indices.create(index=self.repo_set_index, body={"mappings": {"enabled": False}})
+            es_client.index(index=self.repo_set_index, id=set_id, body={"tags": tags})
+            self.stored.add(set_id)
+        return set_id
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import base64
+import hashlib
+import zlib
+import numpy as np
+from elasticsearch import helpers
+from elasticsearch.exceptions import NotFoundError
+from perceval.backend import uuid
+
+# HyperLogLog precision, 2**PRECISION registers
+PRECISION = 14
+# Distinct hashes kept as they are before switching to registers, like the
+# precision_threshold of the Elasticsearch cardinality aggregation
+SPARSE_LIMIT = 3000
+IDS_SIZE = 10000
+BULK_SIZE = 500
+
+# Distinct count metric: method of the columnar source returning its values at a date
+SET_METHODS = {
+    "contributor_count": "contributor_authors",
+    "active_C2_contributor_count": "commit_authors",
+    "active_C1_pr_create_contributor": "pr_create_authors",
+    "active_C1_pr_comments_contributor": "pr_comment_authors",
+    "active_C1_issue_create_contributor": "issue_create_authors",
+    "active_C1_issue_comments_contributor": "issue_comment_authors",
+    "commit_frequency": "commit_hashes",
+    "closed_issue_count": "closed_issue_uuids",
+    "updated_issue_count": "updated_issue_uuids",
+    "recent_releases_count": "release_uuids",
+}
+# Average metric: (method of the columnar source returning its docs at a date, summed field)
+SUM_METHODS = {
+    "comment_frequency": ("issues", "num_of_comments_without_bot"),
+    "code_review_count": ("prs", "num_review_comments_without_bot"),
+}
+# Metric averaged over the repos having a value: method of the columnar source
+# returning the values of its repos at a date
+REPO_VALUE_METHODS = {
+    "created_since": "created_since_list",
+    "updated_since": "updated_since_list",
+}
+
+
+def hash_values(values):
+    return np.unique(np.array([int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+                               for value in values], dtype=np.uint64))
+
+
+class HyperLogLog:
+    def __init__(self, hashes=None, registers=None):
+        """Mergeable distinct count sketch. Up to SPARSE_LIMIT values the 64 bit hashes
+        are kept and counted exactly, beyond that they are folded into registers.
+        :param hashes: sorted unique uint64 hashes, or None for a dense sketch.
+        :param registers: uint8 registers of a dense sketch.
+        """
+        self.hashes = np.zeros(0, dtype=np.uint64) if hashes is None and registers is None else hashes
+        self.registers = registers
+        if self.hashes is not None and len(self.hashes) > SPARSE_LIMIT:
+            self.registers = get_registers(self.hashes)
+            self.hashes = None
+
+    @classmethod
+    def of(cls, values):
+        return cls(hashes=hash_values(values))
+
+    def merge(self, other):
+        if self.hashes is not None and other.hashes is not None:
+            return HyperLogLog(hashes=np.union1d(self.hashes, other.hashes))
+        registers = [get_registers(sketch.hashes) if sketch.hashes is not None else sketch.registers
+                     for sketch in (self, other)]
+        return HyperLogLog(registers=np.maximum(registers[0], registers[1]))
+
+    def count(self):
+        if self.hashes is not None:
+            return len(self.hashes)
+        m = float(len(self.registers))
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def to_str(self):
+        if self.hashes is not None:
+            data = b"s" + self.hashes.astype(">u8").tobytes()
+        else:
+            data = b"d" + self.registers.tobytes()
+        return base64.b64encode(zlib.compress(data)).decode()
+
+    @classmethod
+    def from_str(cls, value):
+        data = zlib.decompress(base64.b64decode(value))
+        if data[:1] == b"s":
+            return cls(hashes=np.frombuffer(data[1:], dtype=">u8").astype(np.uint64))
+        return cls(registers=np.frombuffer(data[1:], dtype=np.uint8).copy())
+
+
+def get_registers(hashes):
+    '''HyperLogLog registers of uint64 hashes: the first PRECISION bits pick the register,
+    which keeps the largest position of the first set bit of the others'''
+    registers = np.zeros(1 << PRECISION, dtype=np.uint8)
+    index = (hashes >> np.uint64(64 - PRECISION)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - PRECISION)) - 1)
+    # frexp exponent is the bit length, exact as rest has less than 53 bits
+    bit_length = np.frexp(rest.astype(float))[1]
+    rank = (64 - PRECISION - bit_length + 1).astype(np.uint8)
+    np.maximum.at(registers, index, rank)
+    return registers
+
+
+def has_prefix_overlap(repos_list):
+    '''A repo of repos_list is a prefix of another, their docs would be counted twice by summed counters'''
+    return any(repo != other and other.startswith(repo) for repo in repos_list for other in repos_list)
+
+
+class SketchStore:
+    def __init__(self, sketch_index):
+        """Per (repo, date) sketches of the Activity metrics, recorded by repo level runs
+        so that project and community levels merge them instead of querying the repos again.
+        Distinct counts are HyperLogLog sketches, averages their sum and count, and
+        created_since and updated_since the value of the repo.
+        :param sketch_index: index the sketches are stored in.
+        """
+        self.sketch_index = sketch_index
+
+    def record(self, es_client, columnar, repo, date_list):
+        '''Store the sketches of repo at every date of date_list, computed from its columnar source'''
+        if not es_client.indices.exists(index=self.sketch_index):
+            es_client.indices.create(index=self.sketch_index, body={"mappings": {"properties": {
+                "tag": {"type": "keyword"}, "sets": {"type": "object", "enabled": False}}}})
+        actions = ({
+            "_index": self.sketch_index,
+            "_id": uuid(repo, date.isoformat()),
+            "_source": self.get_sketch(columnar, repo, date)
+        } for date in date_list)
+        helpers.bulk(es_client, actions, chunk_size=BULK_SIZE)
+
+    def get_sketch(self, columnar, repo, date):
+        sketch = {
+            "uuid": uuid(repo, date.isoformat()),
+            "tag": repo,
+            "grimoire_creation_date": date.isoformat(),
+            "sets": {metric: HyperLogLog.of(getattr(columnar, method)(date)).to_str()
+                     for metric, method in SET_METHODS.items()},
+            "sums": {},
+            "repo_values": {}
+        }
+        for metric, (method, field) in SUM_METHODS.items():
+            docs = getattr(columnar, method)(date)
+            sketch["sums"][metric] = [float(docs[field].sum()), len(docs)]
+        for metric, method in REPO_VALUE_METHODS.items():
+            values = getattr(columnar, method)(date)
+            sketch["repo_values"][metric] = values[0] if values else None
+        return sketch
+
+    def load(self, es_client, repos_list, date_list):
+        '''{(repo, date isoformat): sketch} of repos_list at the dates of date_list, None if one is missing'''
+        ids = [uuid(repo, date.isoformat()) for repo in repos_list for date in date_list]
+        sketches = {}
+        for start in range(0, len(ids), IDS_SIZE):
+            values = ids[start:start + IDS_SIZE]
+            query = {"size": len(values), "query": {"ids": {"values": values}}}
+            try:
+                hits = es_client.search(index=self.sketch_index, body=query)["hits"]["hits"]
+            except NotFoundError:
+                return None
+            for hit in hits:
+                sketches[(hit["_source"]["tag"], hit["_source"]["grimoire_creation_date"])] = hit["_source"]
+        if len(sketches) < len(ids):
+            return None
+        return sketches
+
+
+class SketchRollupMetrics:
+    def __init__(self, model, repos_list, sketches):
+        """Metrics source of an Activity model answering the metrics of repos_list by
+        merging the sketches of its repos, without querying the indexes.
+        :param model: the ActivityMetricsModel whose metrics are answered.
+        :param repos_list: repos of the label being enriched.
+        :param sketches: {(repo, date isoformat): sketch} from SketchStore.load.
+        """
+        self.model = model
+        self.repos_list = repos_list
+        self.sketches = sketches
+        self.merged = {}
+
+    def __getattr__(self, name):
+        if name == "model":
+            raise AttributeError(name)
+        if name in SET_METHODS:
+            return lambda date, repos_list: self.distinct_count(name, date)
+        return getattr(self.model, name)
+
+    def distinct_count(self, metric, date):
+        key = (metric, date)
+        if key not in self.merged:
+            merged = HyperLogLog()
+            for repo in self.repos_list:
+                merged = merged.merge(HyperLogLog.from_str(self.sketches[(repo, date.isoformat())]["sets"][metric]))
+            self.merged[key] = merged.count()
+        return self.merged[key]
+
+    def average(self, metric, date):
+        total, count = 0.0, 0
+        for repo in self.repos_list:
+            repo_total, repo_count = self.sketches[(repo, date.isoformat())]["sums"][metric]
+            total += repo_total
+            count += repo_count
+        if count == 0:
+            return None
+        return total/count
+
+    def repo_values(self, metric, date):
+        return [self.sketches[(repo, date.isoformat())]["repo_values"][metric] for repo in self.repos_list
+                if self.sketches[(repo, date.isoformat())]["repo_values"][metric] is not None]
+
+    def commit_frequency(self, date, repos_list):
+        return self.distinct_count("commit_frequency", date)/12.85
+
+    def comment_frequency(self, date, repos_list):
+        return self.average("comment_frequency", date)
+
+    def code_review_count(self, date, repos_list):
+        return self.average("code_review_count", date)
+
+    def created_since(self, date, repos_list):
+        values = self.repo_values("created_since", date)
+        if values:
+            return sum(values) / len(values)
+        return None
+
+    def updated_since(self, date, repos_list):
+        values = self.repo_values("updated_since", date)
+        if values:
+            return sum(values) / len(values)
+        return 0
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import itertools
+import json
+import numpy as np
+import pandas as pd
+from .utils import (ACTIVITY_PARAMS,
+                    COMMUNITY_PARAMS,
+                    CODE_QUALITY_PARAMS,
+                    ACTIVITY_INCREMENT_DECAY,
+                    COMMUNITY_INCREMENT_DECAY,
+                    COMMUNITY_DECREASE_DECAY,
+                    CODE_QUALITY_INCREMENT_DECAY,
+                    MIN_ACTIVITY_SCORE,
+                    MAX_ACTIVITY_SCORE,
+                    MIN_COMMUNITY_SCORE,
+                    MAX_COMMUNITY_SCORE,
+                    decay_batch,
+                    get_column)
+
+# model_name: (param_dict, increment_decay_dict, decrease_decay_dict, (min_score, max_score) or None)
+MODEL_SCORES = {
+    "Activity": (ACTIVITY_PARAMS, ACTIVITY_INCREMENT_DECAY, {}, (MIN_ACTIVITY_SCORE, MAX_ACTIVITY_SCORE)),
+    "Community Support and Service": (COMMUNITY_PARAMS, COMMUNITY_INCREMENT_DECAY, COMMUNITY_DECREASE_DECAY,
+                                      (MIN_COMMUNITY_SCORE, MAX_COMMUNITY_SCORE)),
+    "Code_Quality_Guarantee": (CODE_QUALITY_PARAMS, CODE_QUALITY_INCREMENT_DECAY, {}, None),
+}
+
+# Bytes the float arrays of one chunk of configurations may take while it is scored
+MEMORY_BUDGET = 256 * 1024 * 1024
+# (configs, params, rows) float arrays alive at once while a chunk is scored
+CHUNK_ARRAYS = 4
+
+
+def load_rows(model, es_client=None, path=None):
+    '''Rows of model from out_index, or from a file of one JSON row per line'''
+    if path is None:
+        return [hit["_source"] for hit in model.scan_metrics_data(es_client)]
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [row for row in rows if row.get("model_name") == model.model_name and row.get("level") == model.level]
+
+
+class MetricMatrix:
+    def __init__(self, rows, model_name):
+        """Decayed metric values of rows as a (rows, params) array, the input of WeightTuner.
+        The decay is replayed per label with the current thresholds of utils, so only the
+        weights and thresholds of the score are tuned.
+        :param rows: metric rows of one model, as stored in out_index.
+        :param model_name: model_name of the rows, a key of MODEL_SCORES.
+        """
+        self.param_dict, increment_decay_dict, decrease_decay_dict, self.normalization = MODEL_SCORES[model_name]
+        self.keys = list(self.param_dict)
+        label_rows = {}
+        for row in rows:
+            label_rows.setdefault(row["label"], []).append(row)
+        labels, dates, columns = [], [], []
+        for label, items in label_rows.items():
+            items.sort(key=lambda row: pd.Timestamp(row["grimoire_creation_date"]))
+            decayed = decay_batch(items, {}, increment_decay_dict, decrease_decay_dict)
+            columns.append(np.column_stack([decayed[key] if key in decayed else get_column(items, key)
+                                            for key in self.keys]))
+            labels += [label] * len(items)
+            dates += [pd.Timestamp(row["grimoire_creation_date"]) for row in items]
+        self.labels = np.array(labels)
+        self.dates = pd.DatetimeIndex(dates)
+        self.values = np.vstack(columns) if columns else np.zeros((0, len(self.keys)))
+        self.weights = np.array([self.param_dict[key][0] for key in self.keys], dtype=float)
+        self.thresholds = np.array([self.param_dict[key][1] for key in self.keys], dtype=float)
+        # the newest row of each label, the rows ranked against each other
+        order = np.lexsort((self.dates.asi8, self.labels))
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = self.labels[order][1:] != self.labels[order][:-1]
+        self.latest = order[last]
+
+
+def get_config_chunk(rows, params, memory_budget=MEMORY_BUDGET):
+    '''Number of configurations scored at once for their arrays to fit in memory_budget bytes'''
+    return max(1, memory_budget // (CHUNK_ARRAYS * 8 * max(1, rows * params)))
+
+
+class WeightTuner:
+    def __init__(self, matrix, memory_budget=MEMORY_BUDGET):
+        """Score a MetricMatrix under many weight and threshold configurations at once.
+        A configuration is a row of a (configs, params) weight array and threshold array,
+        params being in the order of matrix.keys. Configurations are scored in chunks sized
+        from the rows and params of matrix, and report and sensitivity reduce every chunk
+        before the next one, so only evaluate holds a (configs, rows) array. The scores are
+        normalized with the fixed MIN_ and MAX_ bounds of utils, those of the stored scores,
+        so a configuration moving the score range can score below 0 or above 1.
+        :param matrix: MetricMatrix of the rows to score.
+        :param memory_budget: bytes the arrays of one chunk of configurations may take.
+        """
+        self.matrix = matrix
+        self.config_chunk = get_config_chunk(len(matrix.values), len(matrix.keys), memory_budget)
+        self.baseline = self.evaluate(matrix.weights[None, :])[0]
+
+    def get_configs(self, weights, thresholds=None):
+        '''(weights, thresholds) as (configs, params) arrays, the current thresholds by default'''
+        weights = np.atleast_2d(np.asarray(weights, dtype=float))
+        if thresholds is None:
+            thresholds = np.broadcast_to(self.matrix.thresholds, weights.shape)
+        return weights, np.atleast_2d(np.asarray(thresholds, dtype=float))
+
+    def iter_scores(self, weights, thresholds=None):
+        '''(start, (chunk configs, rows) scores) of every chunk of configurations,
+        get_score_ahp without its rounding to 5 decimals'''
+        weights, thresholds = self.get_configs(weights, thresholds)
+        x = self.matrix.values.T[None, :, :]
+        for start in range(0, len(weights), self.config_chunk):
+            w = weights[start:start + self.config_chunk, :, None]
+            t = thresholds[start:start + self.config_chunk, :, None]
+            param = np.where(np.isnan(x), np.where(w < 0, t, 0), x)
+            total = (np.log(1 + param) / np.log(1 + np.maximum(param, t)) * w).sum(axis=1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                score = np.where(w.sum(axis=1) != 0, total / w.sum(axis=1), 0.0)
+            if self.matrix.normalization:
+                min_score, max_score = self.matrix.normalization
+                score = (score - min_score) / (max_score - min_score)
+            yield start, score
+
+    def evaluate(self, weights, thresholds=None):
+        '''(configs, rows) scores, get_score_ahp without its rounding to 5 decimals'''
+        weights, thresholds = self.get_configs(weights, thresholds)
+        scores = np.empty((len(weights), len(self.matrix.values)))
+        for start, score in self.iter_scores(weights, thresholds):
+            scores[start:start + len(score)] = score
+        return scores
+
+    def grid(self, weight_values=None, threshold_values=None):
+        '''(weights, thresholds) of every combination of {param: candidate values}, the
+        other params keeping their current weight and threshold'''
+        weight_values = weight_values or {}
+        threshold_values = threshold_values or {}
+        axes = [(0, key, values) for key, values in weight_values.items()] + \
+            [(1, key, values) for key, values in threshold_values.items()]
+        combinations = list(itertools.product(*[values for kind, key, values in axes]))
+        configs = np.tile(np.stack([self.matrix.weights, self.matrix.thresholds]), (len(combinations), 1, 1))
+        for n, (kind, key, values) in enumerate(axes):
+            configs[:, kind, self.matrix.keys.index(key)] = [combination[n] for combination in combinations]
+        return configs[:, 0], configs[:, 1]
+
+    def distributions(self, scores, percentiles=(5, 25, 50, 75, 95)):
+        '''Mean and percentiles of the scores of every configuration'''
+        report = {"mean": scores.mean(axis=1)}
+        for percentile, values in zip(percentiles, np.percentile(scores, percentiles, axis=1)):
+            report["p{}".format(percentile)] = values
+        return report
+
+    def rank_changes(self, scores):
+        '''Change of the ranking of the labels on their newest row against the current
+        configuration: Spearman correlation, mean and max absolute rank shift'''
+        latest = self.matrix.latest
+        base_ranks = np.argsort(np.argsort(-self.baseline[latest]))
+        ranks = np.argsort(np.argsort(-scores[:, latest], axis=1), axis=1)
+        shift = np.abs(ranks - base_ranks[None, :])
+        n = len(latest)
+        spearman = 1 - 6 * (shift.astype(float) ** 2).sum(axis=1) / (n * (n * n - 1)) if n > 1 else np.ones(len(scores))
+        return {"spearman": spearman, "mean_shift": shift.mean(axis=1) if n else np.zeros(len(scores)),
+                "max_shift": shift.max(axis=1) if n else np.zeros(len(scores))}
+
+    def sensitivity(self, delta=0.1):
+        '''Mean absolute score change when the weight, then the threshold, of each param
+        alone is scaled by 1 + delta and 1 - delta: {param: {"weight", "threshold"}}'''
+        keys = self.matrix.keys
+        weights = np.tile(self.matrix.weights, (4 * len(keys), 1))
+        thresholds = np.tile(self.matrix.thresholds, (4 * len(keys), 1))
+        for k in range(len(keys)):
+            weights[4 * k, k] *= 1 + delta
+            weights[4 * k + 1, k] *= 1 - delta
+            thresholds[4 * k + 2, k] *= 1 + delta
+            thresholds[4 * k + 3, k] *= 1 - delta
+        change = np.concatenate([np.abs(scores - self.baseline[None, :]).mean(axis=1)
+                                 for start, scores in self.iter_scores(weights, thresholds)])
+        return {key: {"weight": (change[4 * k] + change[4 * k + 1]) / 2,
+                      "threshold": (change[4 * k + 2] + change[4 * k + 3]) / 2}
+                for k, key in enumerate(keys)}
+
+    def report(self, weights, thresholds=None):
+        '''Distributions and rank changes of the configurations, one dict per configuration'''
+        weights, thresholds = self.get_configs(weights, thresholds)
+        report = []
+        for start, scores in self.iter_scores(weights, thresholds):
+            columns = dict(self.distributions(scores), **self.rank_changes(scores))
+            report += [dict({"weights": dict(zip(self.matrix.keys, weights[start + n].tolist())),
+                             "thresholds": dict(zip(self.matrix.keys, thresholds[start + n].tolist()))},
+                            **{name: float(values[n]) for name, values in columns.items()})
+                       for n in range(len(scores))]
+        return report
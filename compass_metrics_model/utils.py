@@ -1,4 +1,5 @@
 import math
+import numpy as np
 import pendulum
 
 BACKOFF_FACTOR = 0.2
@@ -121,48 +122,76 @@ def get_score_ahp(item, param_dict):
     except ZeroDivisionError:
         return 0.0
 
+ACTIVITY_PARAMS = {
+    "created_since":[CREATED_SINCE_WEIGHT_ACTIVITY, CREATED_SINCE_THRESHOLD_ACTIVITY],
+    "updated_since":[UPDATED_SINCE_WEIGHT_ACTIVITY, UPDATED_SINCE_THRESHOLD_ACTIVITY],
+    "contributor_count":[CONTRIBUTOR_COUNT_WEIGHT_ACTIVITY, CONTRIBUTOR_COUNT_THRESHOLD_ACTIVITY],
+    "commit_frequency":[COMMIT_FREQUENCY_WEIGHT_ACTIVITY, COMMIT_FREQUENCY_THRESHOLD_ACTIVITY],
+    "closed_issues_count":[CLOSED_ISSUES_WEIGHT_ACTIVITY, CLOSED_ISSUES_THRESHOLD_ACTIVITY],
+    "updated_issues_count":[UPDATED_ISSUES_WEIGHT_ACTIVITY, UPDATED_ISSUES_THRESHOLD_ACTIVITY],
+    "code_review_count":[CODE_REVIEW_COUNT_WEIGHT_ACTIVITY, CODE_REVIEW_COUNT_THRESHOLD_ACTIVITY],
+    "comment_frequency":[COMMENT_FREQUENCY_WEIGHT_ACTIVITY, COMMENT_FREQUENCY_THRESHOLD_ACTIVITY],
+    "recent_releases_count":[RECENT_RELEASES_WEIGHT_ACTIVITY, RECENT_RELEASES_THRESHOLD_ACTIVITY]
+}
+
+COMMUNITY_PARAMS = {
+    "issue_first_reponse_avg":[ISSUE_FIRST_RESPONSE_WEIGHT_COMMUNITY*0.5, ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY],
+    "issue_first_reponse_mid":[ISSUE_FIRST_RESPONSE_WEIGHT_COMMUNITY*0.5, ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY],
+    "bug_issue_open_time_avg":[BUG_ISSUE_OPEN_TIME_WEIGHT_COMMUNITY*0.5, BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY],
+    "bug_issue_open_time_mid":[BUG_ISSUE_OPEN_TIME_WEIGHT_COMMUNITY*0.5, BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY],
+    "pr_open_time_avg":[PR_OPEN_TIME_WEIGHT_COMMUNITY*0.5, PR_OPEN_TIME_THRESHOLD_COMMUNITY],
+    "pr_open_time_mid":[PR_OPEN_TIME_WEIGHT_COMMUNITY*0.5, PR_OPEN_TIME_THRESHOLD_COMMUNITY],
+    "comment_frequency":[COMMENT_FREQUENCY_WEIGHT_COMMUNITY, COMMENT_FREQUENCY_THRESHOLD_COMMUNITY],
+    "updated_issues_count":[UPDATED_ISSUES_WEIGHT_COMMUNITY, UPDATED_ISSUES_THRESHOLD_COMMUNITY],
+    "code_review_count":[CODE_REVIEW_WEIGHT_COMMUNITY, CODE_REVIEW_THRESHOLD_COMMUNITY],
+    "closed_prs_count":[CLOSED_PRS_WEIGHT_COMMUNITY, CLOSED_PRS_THRESHOLD_COMMUNITY]
+}
+
+CODE_QUALITY_PARAMS = {
+    "LOC_frequency":[LOC_FREQUENCY_WEIGHT_CODE, LOC_FREQUENCY_THRESHOLD_CODE],
+    "contributor_count":[CONTRIBUTOR_COUNT_WEIGHT_CODE, CONTRIBUTOR_COUNT_THRESHOLD_CODE],
+    "commit_frequency":[COMMIT_FREQUENCY_WEIGHT_CODE, COMMIT_FREQUENCY_THRESHOLD_CODE],
+    "is_maintained":[IS_MAINTAINED_WEIGHT_CODE, IS_MAINTAINED_THRESHOLD_CODE],
+    "code_merge_ratio":[CODE_MERGE_RATIO_WEIGHT_CODE, CODE_MERGE_RATIO_THRESHOLD_CODE],
+    "code_review_ratio":[CODE_REVIEW_RATIO_WEIGHT_CODE, CODE_REVIEW_RATIO_THRESHOLD_CODE],
+    "pr_issue_linked_ratio":[PR_ISSUE_LINKED_WEIGHT_CODE, PR_ISSUE_LINKED_THRESHOLD_CODE],
+}
+
+COMMUNITY_INCREMENT_DECAY = {
+    "issue_first_reponse_avg":ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY,
+    "issue_first_reponse_mid":ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY,
+    "bug_issue_open_time_avg":BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY,
+    "bug_issue_open_time_mid":BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY,
+    "pr_open_time_avg":PR_OPEN_TIME_THRESHOLD_COMMUNITY,
+    "pr_open_time_mid":PR_OPEN_TIME_THRESHOLD_COMMUNITY
+}
+
+COMMUNITY_DECREASE_DECAY = {
+    "comment_frequency":COMMENT_FREQUENCY_THRESHOLD_COMMUNITY,
+    "code_review_count":CODE_REVIEW_THRESHOLD_COMMUNITY
+}
+
+ACTIVITY_INCREMENT_DECAY = {
+    "comment_frequency":COMMIT_FREQUENCY_THRESHOLD_ACTIVITY,
+    "code_review_count":CODE_REVIEW_COUNT_THRESHOLD_ACTIVITY
+}
+
+CODE_QUALITY_INCREMENT_DECAY = {
+    "code_merge_ratio": CODE_MERGE_RATIO_THRESHOLD_CODE,
+    "code_review_ratio":CODE_REVIEW_RATIO_THRESHOLD_CODE,
+    "pr_issue_linked_ratio":PR_ISSUE_LINKED_THRESHOLD_CODE,
+}
+
 def get_activity_score(item):
-    param_dict = {
-        "created_since":[CREATED_SINCE_WEIGHT_ACTIVITY, CREATED_SINCE_THRESHOLD_ACTIVITY],
-        "updated_since":[UPDATED_SINCE_WEIGHT_ACTIVITY, UPDATED_SINCE_THRESHOLD_ACTIVITY],
-        "contributor_count":[CONTRIBUTOR_COUNT_WEIGHT_ACTIVITY, CONTRIBUTOR_COUNT_THRESHOLD_ACTIVITY],
-        "commit_frequency":[COMMIT_FREQUENCY_WEIGHT_ACTIVITY, COMMIT_FREQUENCY_THRESHOLD_ACTIVITY],
-        "closed_issues_count":[CLOSED_ISSUES_WEIGHT_ACTIVITY, CLOSED_ISSUES_THRESHOLD_ACTIVITY],
-        "updated_issues_count":[UPDATED_ISSUES_WEIGHT_ACTIVITY, UPDATED_ISSUES_THRESHOLD_ACTIVITY],
-        "code_review_count":[CODE_REVIEW_COUNT_WEIGHT_ACTIVITY, CODE_REVIEW_COUNT_THRESHOLD_ACTIVITY],
-        "comment_frequency":[COMMENT_FREQUENCY_WEIGHT_ACTIVITY, COMMENT_FREQUENCY_THRESHOLD_ACTIVITY],
-        "recent_releases_count":[RECENT_RELEASES_WEIGHT_ACTIVITY, RECENT_RELEASES_THRESHOLD_ACTIVITY]
-    }
-    score = get_score_ahp(item, param_dict)
+    score = get_score_ahp(item, ACTIVITY_PARAMS)
     return normalize(score, MIN_ACTIVITY_SCORE, MAX_ACTIVITY_SCORE)
 
 def community_support(item):
-    param_dict = {
-        "issue_first_reponse_avg":[ISSUE_FIRST_RESPONSE_WEIGHT_COMMUNITY*0.5, ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY],
-        "issue_first_reponse_mid":[ISSUE_FIRST_RESPONSE_WEIGHT_COMMUNITY*0.5, ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY],
-        "bug_issue_open_time_avg":[BUG_ISSUE_OPEN_TIME_WEIGHT_COMMUNITY*0.5, BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY],
-        "bug_issue_open_time_mid":[BUG_ISSUE_OPEN_TIME_WEIGHT_COMMUNITY*0.5, BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY],
-        "pr_open_time_avg":[PR_OPEN_TIME_WEIGHT_COMMUNITY*0.5, PR_OPEN_TIME_THRESHOLD_COMMUNITY],
-        "pr_open_time_mid":[PR_OPEN_TIME_WEIGHT_COMMUNITY*0.5, PR_OPEN_TIME_THRESHOLD_COMMUNITY],
-        "comment_frequency":[COMMENT_FREQUENCY_WEIGHT_COMMUNITY, COMMENT_FREQUENCY_THRESHOLD_COMMUNITY],
-        "updated_issues_count":[UPDATED_ISSUES_WEIGHT_COMMUNITY, UPDATED_ISSUES_THRESHOLD_COMMUNITY],
-        "code_review_count":[CODE_REVIEW_WEIGHT_COMMUNITY, CODE_REVIEW_THRESHOLD_COMMUNITY],
-        "closed_prs_count":[CLOSED_PRS_WEIGHT_COMMUNITY, CLOSED_PRS_THRESHOLD_COMMUNITY]
-    }
-    score = get_score_ahp(item, param_dict)
+    score = get_score_ahp(item, COMMUNITY_PARAMS)
     return normalize(score, MIN_COMMUNITY_SCORE, MAX_COMMUNITY_SCORE)
 
 def code_quality_guarantee(item):
-    param_dict = {
-        "LOC_frequency":[LOC_FREQUENCY_WEIGHT_CODE, LOC_FREQUENCY_THRESHOLD_CODE],
-        "contributor_count":[CONTRIBUTOR_COUNT_WEIGHT_CODE, CONTRIBUTOR_COUNT_THRESHOLD_CODE],
-        "commit_frequency":[COMMIT_FREQUENCY_WEIGHT_CODE, COMMIT_FREQUENCY_THRESHOLD_CODE],
-        "is_maintained":[IS_MAINTAINED_WEIGHT_CODE, IS_MAINTAINED_THRESHOLD_CODE],
-        "code_merge_ratio":[CODE_MERGE_RATIO_WEIGHT_CODE, CODE_MERGE_RATIO_THRESHOLD_CODE],
-        "code_review_ratio":[CODE_REVIEW_RATIO_WEIGHT_CODE, CODE_REVIEW_RATIO_THRESHOLD_CODE],
-        "pr_issue_linked_ratio":[PR_ISSUE_LINKED_WEIGHT_CODE, PR_ISSUE_LINKED_THRESHOLD_CODE],
-    }
-    return get_score_ahp(item, param_dict)
+    return get_score_ahp(item, CODE_QUALITY_PARAMS)
 
 def increment_decay(last_data, threshold, days):
     return min(last_data + DECAY_COEFFICIENT * threshold * days, threshold)
@@ -170,52 +199,99 @@ def increment_decay(last_data, threshold, days):
 def decrease_decay(last_data, threshold, days):
     return max(last_data - DECAY_COEFFICIENT * threshold * days, 0)
 
-def community_decay(item, last_data): 
+def get_decay_item(item, last_data, increment_decay_dict, decrease_decay_dict={}):
     decay_item = item.copy()
-    increment_decay_dict = {
-        "issue_first_reponse_avg":ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY,
-        "issue_first_reponse_mid":ISSUE_FIRST_RESPONSE_THRESHOLD_COMMUNITY,
-        "bug_issue_open_time_avg":BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY,
-        "bug_issue_open_time_mid":BUG_ISSUE_OPEN_TIME_THRESHOLD_COMMUNITY,
-        "pr_open_time_avg":PR_OPEN_TIME_THRESHOLD_COMMUNITY,
-        "pr_open_time_mid":PR_OPEN_TIME_THRESHOLD_COMMUNITY
-        }
-    decrease_decay_dict = {
-        "comment_frequency":COMMENT_FREQUENCY_THRESHOLD_COMMUNITY,
-        "code_review_count":CODE_REVIEW_THRESHOLD_COMMUNITY
-        }
-    for key, value in increment_decay_dict.items():
-        if item[key] == None and last_data.get(key) != None:
-            days = pendulum.parse(item['grimoire_creation_date']).diff(pendulum.parse(last_data[key][1])).days
-            decay_item[key] = round(increment_decay(last_data[key][0], value, days), 4)
-    for key, value in decrease_decay_dict.items():
-        if item[key] == None and last_data.get(key) != None:
-            days = pendulum.parse(item['grimoire_creation_date']).diff(pendulum.parse(last_data[key][1])).days
-            decay_item[key] = round(decrease_decay(last_data[key][0], value, days), 4)          
+    date = None
+    for decay_dict, decay in [(increment_decay_dict, increment_decay), (decrease_decay_dict, decrease_decay)]:
+        for key, value in decay_dict.items():
+            if item[key] == None and last_data.get(key) != None:
+                date = date or pendulum.parse(item['grimoire_creation_date'])
+                days = date.diff(pendulum.parse(last_data[key][1])).days
+                decay_item[key] = round(decay(last_data[key][0], value, days), 4)
     return decay_item
 
-def activity_decay(item, last_data): 
-    decay_item = item.copy()
-    increment_decay_dict = {
-        "comment_frequency":COMMIT_FREQUENCY_THRESHOLD_ACTIVITY,
-        "code_review_count":CODE_REVIEW_COUNT_THRESHOLD_ACTIVITY
-        }
-    for key, value in increment_decay_dict.items():
-        if item[key] == None and last_data.get(key) != None:
-            days = pendulum.parse(item['grimoire_creation_date']).diff(pendulum.parse(last_data[key][1])).days
-            decay_item[key] = round(increment_decay(last_data[key][0], value, days), 4)        
-    return decay_item
+def community_decay(item, last_data):
+    return get_decay_item(item, last_data, COMMUNITY_INCREMENT_DECAY, COMMUNITY_DECREASE_DECAY)
 
-def code_quality_decay(item, last_data): 
-    decay_item = item.copy()
-    increment_decay_dict = {
-        "code_merge_ratio": CODE_MERGE_RATIO_THRESHOLD_CODE,
-        "code_review_ratio":CODE_REVIEW_RATIO_THRESHOLD_CODE,
-        "pr_issue_linked_ratio":PR_ISSUE_LINKED_THRESHOLD_CODE,
-        }
-    
-    for key, value in increment_decay_dict.items():
-        if item[key] == None and last_data.get(key) != None:
-            days = pendulum.parse(item['grimoire_creation_date']).diff(pendulum.parse(last_data[key][1])).days
-            decay_item[key] = round(increment_decay(last_data[key][0], value, days), 4)        
-    return decay_item
\ No newline at end of file
+def activity_decay(item, last_data):
+    return get_decay_item(item, last_data, ACTIVITY_INCREMENT_DECAY)
+
+def code_quality_decay(item, last_data):
+    return get_decay_item(item, last_data, CODE_QUALITY_INCREMENT_DECAY)
+
+
+# Batch versions of the functions above, taking the rows of a label in date order.
+# math.log and round are mapped over the arrays instead of np.log and np.round,
+# whose results differ from them in the last digit for some values.
+_log = np.frompyfunc(math.log, 1, 1)
+_round = np.frompyfunc(round, 2, 1)
+
+
+def round_array(values, digits):
+    return _round(values, digits).astype(float)
+
+def get_column(items, key):
+    '''Values of key in items, nan for None'''
+    return np.array([np.nan if item[key] is None else item[key] for item in items], dtype=float)
+
+def get_timestamps(dates):
+    return np.array([pendulum.parse(date).timestamp() for date in dates], dtype=float)
+
+def get_param_score_batch(params, max_value, weight=1):
+    return (_log(1 + params) / _log(1 + np.maximum(params, max_value))).astype(float) * weight
+
+def get_score_ahp_batch(columns, param_dict):
+    '''get_score_ahp of every row of columns, {key: values with nan for None}'''
+    total_weight = 0
+    total_param_score = 0
+    for key, value in param_dict.items():
+        total_weight += value[0]
+        param = np.where(np.isnan(columns[key]), value[1] if value[0] < 0 else 0, columns[key])
+        total_param_score = total_param_score + get_param_score_batch(param, value[1], value[0])
+    if total_weight == 0:
+        return np.zeros(len(columns[key]))
+    return round_array(total_param_score / total_weight, 5)
+
+def decay_batch(items, last_data, increment_decay_dict, decrease_decay_dict={}):
+    '''Decayed values of the decay keys of every row, starting from last_data. A missing
+    value decays from the last present value of the key, carried forward over the rows.'''
+    times = get_timestamps([item['grimoire_creation_date'] for item in items])
+    positions = np.arange(len(items))
+    columns = {}
+    for decay_dict, decay in [(increment_decay_dict, np.minimum), (decrease_decay_dict, np.maximum)]:
+        for key, value in decay_dict.items():
+            values = get_column(items, key)
+            present = ~np.isnan(values)
+            last = np.maximum.accumulate(np.where(present, positions, -1))
+            last_value = np.where(last >= 0, values[last], np.nan)
+            last_time = np.where(last >= 0, times[last], np.nan)
+            if last_data.get(key) != None:
+                last_value = np.where(last >= 0, last_value, last_data[key][0])
+                last_time = np.where(last >= 0, last_time, pendulum.parse(last_data[key][1]).timestamp())
+            days = np.floor(np.abs(times - last_time) / 86400)
+            if decay is np.minimum:
+                decayed = np.minimum(last_value + DECAY_COEFFICIENT * value * days, value)
+            else:
+                decayed = np.maximum(last_value - DECAY_COEFFICIENT * value * days, 0)
+            decayed_rows = ~present & ~np.isnan(last_value)
+            values[decayed_rows] = round_array(decayed[decayed_rows], 4)
+            columns[key] = values
+    return columns
+
+def get_scores_batch(items, last_data, param_dict, increment_decay_dict, decrease_decay_dict={}):
+    columns = {key: get_column(items, key) for key in param_dict}
+    columns.update(decay_batch(items, last_data, increment_decay_dict, decrease_decay_dict))
+    return get_score_ahp_batch(columns, param_dict)
+
+def get_activity_scores(items, last_data={}):
+    '''get_activity_score(activity_decay(item, last_data)) of every row, last_data
+    being updated with each row as write_metrics_data does'''
+    scores = get_scores_batch(items, last_data, ACTIVITY_PARAMS, ACTIVITY_INCREMENT_DECAY)
+    return normalize(scores, MIN_ACTIVITY_SCORE, MAX_ACTIVITY_SCORE).tolist()
+
+def community_support_scores(items, last_data={}):
+    scores = get_scores_batch(items, last_data, COMMUNITY_PARAMS, COMMUNITY_INCREMENT_DECAY, COMMUNITY_DECREASE_DECAY)
+    return normalize(scores, MIN_COMMUNITY_SCORE, MAX_COMMUNITY_SCORE).tolist()
+
+def code_quality_guarantee_scores(items, last_data={}):
+    return get_scores_batch(items, last_data, CODE_QUALITY_PARAMS, CODE_QUALITY_INCREMENT_DECAY).tolist()
@@ -22,7 +22,7 @@ setup(name="compass_metrics_model",
           'Programming Language :: Python :: 3.4',
           'Programming Language :: Python :: 3.5'],
       keywords="Metric Model",
-      packages=['compass_metrics_model'],
+      packages=['compass_metrics_model', 'compass_metrics_model.benchmark'],
       python_requires='>=3.4',
       setup_requires=['wheel'],
       zip_safe=False
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import contextlib
+import io
+from urllib.parse import unquote
+import pytest
+from elasticsearch import Elasticsearch
+from compass_metrics_model import async_engine
+from compass_metrics_model.benchmark.corpus import CorpusGenerator
+from compass_metrics_model.benchmark.scenarios import (STAND_IN_URL, RunStats, Scenario, StandInWriter,
+                                                       load_stand_in)
+from compass_metrics_model.benchmark.stand_in import StandInElasticsearch
+from compass_metrics_model.cassette import get_body_lines, record_client
+from compass_metrics_model.multi_model import MultiModelRunner
+
+
+class StandInAsync:
+    '''AsyncElasticsearch answering from a StandInElasticsearch'''
+    def __init__(self, es):
+        self.es = es
+
+    async def search(self, index=None, body=None, **kwargs):
+        return self.es.search(index=index, body=body, **kwargs)
+
+    async def close(self):
+        pass
+
+
+class StandInTransport:
+    def __init__(self, es, serializer):
+        """Transport of an Elasticsearch client sending its searches to a StandInElasticsearch.
+        :param es: StandInElasticsearch answering the searches.
+        :param serializer: serializer of the client.
+        """
+        self.es = es
+        self.serializer = serializer
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        params = {name: value for name, value in (params or {}).items() if name not in ("request_timeout", "ignore")}
+        path = url.split("?")[0].strip("/").split("/")
+        index = unquote(path[0]) if len(path) == 2 else None
+        if path[-1] == "_search":
+            if "size" in params:
+                params["size"] = int(params["size"])
+            return self.es.search(index=index, body=body, **params)
+        if path[-1] == "_msearch":
+            return self.es.msearch(get_body_lines(body), index=index)
+        if path[-1] == "scroll":
+            if method == "DELETE":
+                return self.es.clear_scroll(body=body)
+            return self.es.scroll(body=body)
+        raise NotImplementedError(method + " " + url)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope="module")
+def corpus():
+    return CorpusGenerator(docs=1200, repos=3, days=150)
+
+
+@pytest.fixture(scope="module")
+def json_file(corpus, tmp_path_factory):
+    return corpus.write_json_file(str(tmp_path_factory.mktemp("parity") / "projects.json"))
+
+
+def build_model(corpus, json_file, es, model, level, options=None):
+    '''Model of the scenario on es, options are set without the checks of Scenario'''
+    scenario = Scenario(model, level)
+    scenario.options = options or {}
+    return scenario.build_model(corpus, json_file, es, RunStats(es))
+
+
+def run(model):
+    with contextlib.redirect_stdout(io.StringIO()):
+        model.metrics_model_metrics(STAND_IN_URL)
+
+
+def get_rows(es, model):
+    '''Rows of model in its out index by label and date, without their enrich date'''
+    rows = [{field: value for field, value in row.items() if field not in ("metadata__enriched_on", "_index")}
+            for row in es.indexes.get(model.out_index, [])]
+    return sorted(rows, key=lambda row: (row["label"], row["grimoire_creation_date"]))
+
+
+def assert_same_rows(rows, expected):
+    assert expected
+    assert len(rows) == len(expected)
+    for row, expected_row in zip(rows, expected):
+        assert row == pytest.approx(expected_row, rel=1e-9)
+
+
+@pytest.fixture(scope="module")
+def default_rows(corpus, json_file):
+    '''Rows of the default run of every (model, level)'''
+    rows = {}
+
+    def get(model, level):
+        if (model, level) not in rows:
+            es = load_stand_in(corpus)
+            default = build_model(corpus, json_file, es, model, level)
+            run(default)
+            rows[(model, level)] = get_rows(es, default)
+        return rows[(model, level)]
+    return get
+
+
+@pytest.mark.parametrize("model, level, options", [
+    ("activity", "project", {"backfill": True}),
+    ("community", "repo", {"backfill": True}),
+    ("activity", "project", {"columnar": True}),
+    ("code_quality", "repo", {"columnar": True}),
+    ("activity", "repo", {"msearch_dates": 8}),
+    ("activity", "repo", {"async_concurrency": 4}),
+    ("activity", "repo", {"processes": 2, "chunk_dates": 4}),
+    ("code_quality", "repo", {"processes": 2, "chunk_dates": 4}),
+])
+def test_option_rows_equal_the_default(corpus, json_file, default_rows, monkeypatch, model, level, options):
+    es = load_stand_in(corpus)
+    monkeypatch.setattr(async_engine, "AsyncElasticsearch", lambda url, **kwargs: StandInAsync(es))
+    option_model = build_model(corpus, json_file, es, model, level, options)
+    run(option_model)
+    assert_same_rows(get_rows(es, option_model), default_rows(model, level))
+
+
+def test_multi_model_rows_equal_the_default(corpus, json_file, default_rows):
+    es = load_stand_in(corpus)
+    models = [build_model(corpus, json_file, es, model, "project") for model in ("activity", "community")]
+    with contextlib.redirect_stdout(io.StringIO()):
+        MultiModelRunner(models).run(STAND_IN_URL)
+    for name, model in zip(("activity", "community"), models):
+        assert_same_rows(get_rows(es, model), default_rows(name, "project"))
+
+
+def test_incremental_resume_equals_a_full_run(corpus, json_file, default_rows):
+    es = load_stand_in(corpus)
+    model = build_model(corpus, json_file, es, "activity", "repo")
+    run(model)
+    rows = get_rows(es, model)
+    # the run stopped half way: the rows of the second half of every label are lost
+    cutoff = sorted(row["grimoire_creation_date"] for row in rows)[len(rows) // 2]
+    es.bulk([{"delete": {"_index": model.out_index, "_id": row["_id"]}}
+             for row in rows if row["grimoire_creation_date"] >= cutoff])
+    resumed = build_model(corpus, json_file, es, "activity", "repo", {"incremental": True})
+    run(resumed)
+    assert_same_rows(get_rows(es, resumed), default_rows("activity", "repo"))
+
+
+def test_rescore_equals_fresh_scoring(corpus, json_file, default_rows):
+    es = load_stand_in(corpus)
+    model = build_model(corpus, json_file, es, "community", "project")
+    run(model)
+    es.bulk([line for row in get_rows(es, model) for line in (
+        {"update": {"_index": model.out_index, "_id": row["_id"]}}, {"doc": {model.score_field: 0}})])
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert model.metrics_model_rescore(STAND_IN_URL) > 0
+    assert_same_rows(get_rows(es, model), default_rows("community", "project"))
+
+
+def test_cassette_replay_equals_its_recording(corpus, json_file, tmp_path):
+    path = str(tmp_path / "cassette.jsonl.gz")
+    es = load_stand_in(corpus)
+    recorded = build_model(corpus, json_file, es, "community", "project", {"record_cassette": path})
+
+    def get_recording_client(elastic_url):
+        es_client = Elasticsearch(elastic_url)
+        es_client.transport = StandInTransport(es, es_client.transport.serializer)
+        return record_client(es_client, path)
+    recorded.get_es_client = get_recording_client
+    run(recorded)
+    # the replay has no docs to query, only the rows it writes
+    replay_es = StandInElasticsearch()
+    replayed = build_model(corpus, json_file, replay_es, "community", "project", {"replay_cassette": path})
+    replayed.get_es_out = lambda elastic_url: StandInWriter(replay_es, replayed.out_index)
+    run(replayed)
+    assert_same_rows(get_rows(replay_es, replayed), get_rows(es, recorded))
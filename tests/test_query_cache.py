@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021-2022 Yehui Wang, Chenqi Shan
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# Authors:
+#     Yehui Wang <yehui.wang.mdh@gmail.com>
+#     Chenqi Shan <chenqishan337@gmail.com>
+
+import contextlib
+import io
+from compass_metrics_model import query_cache
+from compass_metrics_model.benchmark.corpus import CorpusGenerator, INDEX_NAMES, KINDS
+from compass_metrics_model.benchmark.scenarios import Scenario
+from compass_metrics_model.benchmark.stand_in import StandInElasticsearch
+
+
+def run_rows(scenario, corpus, json_file, es, label):
+    '''Rows of label the scenario writes to its out index, without their enrich date'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        scenario.run(corpus, json_file, es)
+    rows = [dict(row) for row in es.indexes["bench_out_" + scenario.name.replace("-", "_")] if row["label"] == label]
+    for row in rows:
+        row.pop("metadata__enriched_on", None)
+        row.pop("_index", None)
+    return sorted(rows, key=lambda row: row["grimoire_creation_date"])
+
+
+def load_docs(es, corpus, keep):
+    for kind in KINDS:
+        es.add_docs(INDEX_NAMES[kind], [doc for doc in corpus.iter_docs(kind) if keep(doc)])
+
+
+def test_late_repo_is_not_served_from_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(query_cache, "query_caches", {})
+    corpus = CorpusGenerator(docs=600, repos=2, days=60)
+    json_file = corpus.write_json_file(str(tmp_path / "projects.json"))
+    late = corpus.repos[1]
+
+    def is_late(doc):
+        return doc.get("tag", "").startswith(late)
+
+    cached, fresh = StandInElasticsearch(), StandInElasticsearch()
+    for es in (cached, fresh):
+        load_docs(es, corpus, lambda doc: not is_late(doc))
+    scenario = Scenario("community", "repo", {"query_cache": {"ttl": 0, "cache_dir": str(tmp_path / "cache")}})
+    assert run_rows(scenario, corpus, json_file, cached, late) == []
+    # the repo is ingested between the two runs
+    for es in (cached, fresh):
+        load_docs(es, corpus, is_late)
+    expected = run_rows(Scenario("community", "repo"), corpus, json_file, fresh, late)
+    assert expected
+    assert run_rows(scenario, corpus, json_file, cached, late) == expected
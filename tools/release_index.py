@@ -1,7 +1,9 @@
 from opensearchpy import OpenSearch
-from opensearchpy import helpers
-from perceval.backend import uuid
 import json
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from compass_metrics_model.release_ingest import create_release_index
 
 
 def get_opensearch_client(opensearch_conn_infos):
@@ -19,54 +21,8 @@ def get_opensearch_client(opensearch_conn_infos):
     return client
 
 
-def opensearch_search(opensearch_client, index, query):
-    results = opensearch_client.search(index=index,body=query)
-
-    return results
-
-
-def newest_message(repo_url):
-    query = {"query": {
-                    "match": {
-                        "tag": repo_url
-                    }},
-                    "sort": 
-                    [{
-                        "metadata__updated_on": {"order": "desc"}
-                    }]
-            }
-    return query
-
-
-def add_release_message(opensearch_client, out_index, repo_url, releases,):
-    all_bulk_data = []
-    for item in releases:
-        release_data = {"_index": out_index,
-                        "_id": uuid(str(item["id"])),
-                        "_source": {
-                            "uuid": uuid(str(item["id"])),
-                            "id": item["id"],
-                            "tag": repo_url,
-                            "tag_name": item["tag_name"],
-                            "target_commitish": item["target_commitish"],
-                            "prerelease": item["prerelease"],
-                            "name": item["name"],
-                            "body": item["body"],
-                            "author_login": item["author"]["login"],
-                            "author_name": item["author"]["name"],
-                            "grimoire_creation_date": item["created_at"]}}
-        all_bulk_data.append(release_data)
-        if len(all_bulk_data) > 10:
-            helpers.bulk(client=opensearch_client, actions=all_bulk_data)
-            all_bulk_data = []
-    helpers.bulk(client=opensearch_client, actions=all_bulk_data)
-    all_bulk_data = []
-
-
 if __name__ == "__main__":
     repo_url = "https://gitee.com/mindspore/mindspore"
     opensearch_conn_infos = json.load(open("opensearch_message.json"))
     opensearch_client = get_opensearch_client(opensearch_conn_infos)
-    query = newest_message(opensearch_client, repo_url)
-    items = opensearch_search(opensearch_client, "gitee_repo-enriched",query)["hits"]["hits"][0]["_source"]["releases"]
-    add_release_message("repo_release_enriched", repo_url, items)
+    create_release_index(opensearch_client, [repo_url], "gitee_repo-enriched", "repo_release_enriched")